@@ -0,0 +1,331 @@
+"""
+Benchmarks and sanity checks for the slower parts of the system.
+Needs the same config files as the site itself.  Run from the project folder with the names of the ones you want:
+    python benchmarks.py eligibility matrix indexes meal_save label_backends
+"""
+import io
+import os
+import random
+from sys import argv
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+
+import cherrypy
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import sessionmaker
+
+from config import dec_base, env
+import decorators
+import label_render
+import labels
+import migrate
+from shared_functions import HTTPRedirect, Shift, MealIndex, carryout_eligible, eligibility_matrix
+
+
+class FakeMeal:
+    def __init__(self, id, start_time, end_time):
+        self.id = id
+        self.start_time = start_time
+        self.end_time = end_time
+
+
+class FakeAttendee:
+    def __init__(self, badge_num):
+        self.badge_num = badge_num
+
+
+class FakeOrder:
+    """
+    An order the way shared_functions.bundle_orders leaves it, ready for printing
+    """
+    def __init__(self, badge_num, toggles, toppings, allergies, notes):
+        self.attendee = FakeAttendee(badge_num)
+        self.toggle1 = [(1, toggles[0], '', 0)]
+        self.toggle2 = [(1, toggles[1], '', 0)]
+        self.toggle3 = [(1, toggles[2], '', 0)]
+        self.toppings = [(0, topping, '', 0) for topping in toppings]
+        self.allergies = allergies
+        self.notes = notes
+
+
+class FakeLabelMeal:
+    meal_name = 'Benchmark Lunch'
+    toggle1_title = 'Meat'
+    toggle2_title = 'Bread'
+    toggle3_title = 'Side'
+    toppings_title = 'Toppings'
+
+
+def random_time(start, days=4, step_minutes=15):
+    """random time within the event, lined up on step_minutes so plenty of shifts and meals touch exactly"""
+    return start + timedelta(minutes=step_minutes * random.randrange(days * 1440 // step_minutes))
+
+
+def random_meals(start, count):
+    meals = list()
+    for i in range(count):
+        meal_start = random_time(start)
+        meals.append(FakeMeal(i, meal_start, meal_start + timedelta(minutes=random.choice([30, 60, 90, 120, 180]))))
+    return meals
+
+
+def random_shifts(start, count):
+    shifts = list()
+    for i in range(count):
+        shift_start = random_time(start)
+        # mostly normal shifts, with some exactly a day long or longer to hit the edge cases
+        length = random.choice([60, 120, 180, 240, 360, 1440, 1455, 1800])
+        shifts.append(Shift(shift_start, shift_start + timedelta(minutes=length), extra_15=random.random() < 0.3))
+    return sorted(shifts)
+
+
+def eligibility(attendees=2000, meals=40):
+    """
+    Compares how long carryout_eligible meal by meal and MealIndex take for a meal list page worth of work per
+    attendee.  That they give the same answers as the old relativedelta version is checked by
+    tests/test_carryout_eligible.py
+    """
+    random.seed(2020)
+    event_start = datetime(2020, 1, 2, 6, 0)
+    meal_list = random_meals(event_start, meals)
+    attendee_shifts = [random_shifts(event_start, random.randint(0, 6)) for i in range(attendees)]
+    
+    start = time.perf_counter()
+    for shifts in attendee_shifts:
+        for meal in meal_list:
+            carryout_eligible(shifts, meal.start_time, meal.end_time)
+    single_time = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    for shifts in attendee_shifts:
+        MealIndex(meal_list).eligible_meals(shifts)
+    index_time = time.perf_counter() - start
+    
+    print('eligibility: {} attendees x {} meals, carryout_eligible {:.3f}s, MealIndex {:.3f}s ({:.1f}x)'.format(
+        attendees, meals, single_time, index_time, single_time / index_time))
+    return single_time, index_time
+
+
+def matrix(attendees=10000, meals=40, check=500):
+    """
+    Times eligibility_matrix for a whole event's worth of staffers and checks a sample of attendees
+    against carryout_eligible
+    """
+    random.seed(2020)
+    event_start = datetime(2020, 1, 2, 6, 0)
+    meal_list = random_meals(event_start, meals)
+    attendee_shifts = [random_shifts(event_start, random.randint(0, 6)) for i in range(attendees)]
+    
+    start = time.perf_counter()
+    result = eligibility_matrix(attendee_shifts, meal_list)
+    elapsed = time.perf_counter() - start
+    
+    mismatches = 0
+    for row in random.sample(range(attendees), check):
+        for column, meal in enumerate(meal_list):
+            if result[row, column] != carryout_eligible(attendee_shifts[row], meal.start_time, meal.end_time):
+                mismatches += 1
+    
+    print('matrix: {} attendees x {} meals in {:.3f}s, {} mismatches in {} sampled attendees'.format(
+        attendees, meals, elapsed, mismatches, check))
+    return mismatches
+
+
+def indexes(orders=100000, meals=40, departments=60, repeats=2000):
+    """
+    Builds a scratch database with the old, unindexed tables and orders worth of rows (and as many dine-in
+    checkins, plus a dept order for every meal and department), times the lookups the site does all the time,
+    then runs migrate.add_missing_indexes and times them again.
+    Uses a temporary file, never touches the event database.
+    """
+    random.seed(2020)
+    folder = tempfile.mkdtemp()
+    engine = create_engine('sqlite:///' + os.path.join(folder, 'indexes.db'))
+    dec_base.metadata.create_all(bind=engine)
+    index_names = [index.name for table in dec_base.metadata.sorted_tables for index in table.indexes]
+    with engine.begin() as conn:
+        for name in index_names:
+            conn.execute(text('DROP INDEX IF EXISTS "{}"'.format(name)))
+    
+    attendees = orders // meals
+    order_table = dec_base.metadata.tables['order']
+    attendee_table = dec_base.metadata.tables['attendee']
+    checkin_table = dec_base.metadata.tables['checkin']
+    dept_order_table = dec_base.metadata.tables['dept_order']
+    event_start = datetime(2020, 1, 2, 6, 0)
+    with engine.begin() as conn:
+        conn.execute(attendee_table.insert(), [{'public_id': 'attendee{}'.format(i), 'badge_num': i}
+                                              for i in range(attendees)])
+        conn.execute(order_table.insert(), [{'attendee_id': 'attendee{}'.format(i % attendees),
+                                             'meal_id': i // attendees,
+                                             'department_id': 'dept{}'.format(random.randrange(departments))}
+                                            for i in range(orders)])
+        conn.execute(checkin_table.insert(), [{'attendee_id': 'attendee{}'.format(i % attendees),
+                                               'meal_id': i // attendees,
+                                               'timestamp': event_start + timedelta(seconds=i)}
+                                              for i in range(orders)])
+        conn.execute(dept_order_table.insert(), [{'meal_id': meal, 'dept_id': 'dept{}'.format(dept)}
+                                                 for meal in range(meals) for dept in range(departments)])
+    
+    queries = [('order by meal and department',
+                'SELECT id FROM "order" WHERE meal_id = :meal AND department_id = :dept'),
+               ('order by meal and attendee',
+                'SELECT id FROM "order" WHERE meal_id = :meal AND attendee_id = :attendee'),
+               ('attendee by badge',
+                'SELECT public_id FROM attendee WHERE badge_num = :badge'),
+               ('checkin by attendee and meal',
+                'SELECT id FROM checkin WHERE attendee_id = :attendee AND meal_id = :meal'),
+               ('dept_order by meal and department',
+                'SELECT id FROM dept_order WHERE meal_id = :meal AND dept_id = :dept')]
+    params = [{'meal': random.randrange(meals), 'dept': 'dept{}'.format(random.randrange(departments)),
+               'attendee': 'attendee{}'.format(random.randrange(attendees)), 'badge': random.randrange(attendees)}
+              for i in range(repeats)]
+    
+    def run():
+        timings = list()
+        with engine.connect() as conn:
+            for name, query in queries:
+                start = time.perf_counter()
+                for param in params:
+                    conn.execute(text(query), param).fetchall()
+                timings.append((time.perf_counter() - start) * 1000 / repeats)
+        return timings
+    
+    before = run()
+    start = time.perf_counter()
+    messages = migrate.add_missing_indexes(engine)
+    migrate_time = time.perf_counter() - start
+    after = run()
+    
+    print('indexes: {} orders, migration took {:.2f}s:'.format(orders, migrate_time))
+    for message in messages:
+        print('    ' + message)
+    for (name, query), old, new in zip(queries, before, after):
+        print('indexes: {} {:.3f}ms before, {:.3f}ms after ({:.0f}x)'.format(name, old, new, old / new))
+    
+    engine.dispose()
+    os.remove(os.path.join(folder, 'indexes.db'))
+    os.rmdir(folder)
+    return len(messages)
+
+
+def meal_form(meal_id='', ingredient_ids=None, suffix=''):
+    """form parameters meal_edit gets when saving a meal with 8 toppings and 3 toggles of 3 options each"""
+    params = {'id': meal_id, 'meal_name': 'Lunch', 'start_time': '2020-01-02 12:00', 'end_time': '2020-01-02 13:00',
+              'cutoff': '2020-01-02 10:00', 'description': '', 'toppings_title': 'Toppings',
+              'toggle1_title': 'Meat', 'toggle2_title': 'Bread', 'toggle3_title': 'Side'}
+    fields = [('toppings', 8), ('toggle1', 3), ('toggle2', 3), ('toggle3', 3)]
+    position = 0
+    for field, count in fields:
+        for number in range(1, count + 1):
+            params[field + str(number)] = '{} {}{}'.format(field, number, suffix)
+            params[field + 'desc' + str(number)] = ''
+            params[field + 'id' + str(number)] = ingredient_ids[position] if ingredient_ids else ''
+            position += 1
+    return params
+
+
+def meal_save():
+    """
+    Saves a new meal and then edits every ingredient label on it through the real meal_edit handler,
+    counting how many times the database commits for each save.  Uses a scratch database.
+    """
+    import webcode
+    from models.meal import Meal
+    
+    folder = tempfile.mkdtemp()
+    engine = create_engine('sqlite:///' + os.path.join(folder, 'meal_save.db'))
+    dec_base.metadata.create_all(bind=engine)
+    make_session = sessionmaker(bind=engine)
+    commits = [0]
+    
+    @event.listens_for(engine, 'commit')
+    def count_commit(conn):
+        commits[0] += 1
+    
+    def save(params):
+        commits[0] = 0
+        cherrypy.request.db = make_session()
+        start = time.perf_counter()
+        try:
+            webcode.Root.meal_edit.__wrapped__(webcode.Root(), **params)
+        except HTTPRedirect:
+            pass
+        # same as the db tool does at the end of a request
+        decorators.DatabaseSession.close_session()
+        return commits[0], (time.perf_counter() - start) * 1000
+    
+    new_commits, new_ms = save(meal_form())
+    session = make_session()
+    meal = session.query(Meal).one()
+    ids = meal.toppings.split(',') + meal.toggle1.split(',') + meal.toggle2.split(',') + meal.toggle3.split(',')
+    meal_id = meal.id
+    session.close()
+    edit_commits, edit_ms = save(meal_form(meal_id, ids, suffix=' edited'))
+    
+    print('meal_save: new meal with 17 ingredients, {} commits, {:.1f}ms'.format(new_commits, new_ms))
+    print('meal_save: editing all 17 ingredient labels, {} commits, {:.1f}ms'.format(edit_commits, edit_ms))
+    
+    engine.dispose()
+    os.remove(os.path.join(folder, 'meal_save.db'))
+    os.rmdir(folder)
+    return new_commits + edit_commits
+
+
+def label_backends(count=200):
+    """
+    Renders the same bundle of labels with wkhtmltopdf through pdfkit and with reportlab,
+    checks both make a page per label and compares labels per second
+    """
+    from PyPDF2 import PdfReader
+    random.seed(2020)
+    toppings = ['Lettuce', 'Tomato', 'Onion', 'Pickles', 'Mayo', 'Mustard']
+    orders = list()
+    for badge in range(count):
+        allergies = ''
+        if random.random() < 0.2:
+            allergies = {'standard_labels': ['Gluten Free', 'Nut Allergy'], 'freeform': 'no shellfish please'}
+        orders.append(FakeOrder(1000 + badge,
+                                [random.choice(['Turkey', 'Ham', 'Veggie']), random.choice(['White', 'Wheat']),
+                                 random.choice(['Chips', 'Fruit'])],
+                                random.sample(toppings, random.randint(0, 4)),
+                                allergies,
+                                'extra napkins' if random.random() < 0.1 else ''))
+    meal = FakeLabelMeal()
+    
+    results = dict()
+    
+    start = time.perf_counter()
+    html = env.get_template('print_labels.html').render(orders=orders, meal=meal, dept_name='Benchmarks')
+    try:
+        pdf = label_render.html_to_pdf(html, labels.PDF_OPTIONS, labels.wkhtmltopdf_path())
+    except OSError as e:
+        print('label_backends: pdfkit skipped, wkhtmltopdf not found: {}'.format(e))
+    else:
+        results['pdfkit'] = (time.perf_counter() - start, len(PdfReader(io.BytesIO(pdf)).pages))
+    
+    start = time.perf_counter()
+    pdf = label_render.draw_labels(labels.label_fields(orders, meal, 'Benchmarks'))
+    results['reportlab'] = (time.perf_counter() - start, len(PdfReader(io.BytesIO(pdf)).pages))
+    
+    for backend, (seconds, pages) in results.items():
+        print('label_backends: {} {} labels, {} pages in {:.3f}s, {:.0f} labels/sec'.format(
+            backend, count, pages, seconds, count / seconds))
+    if len(results) == 2:
+        print('label_backends: reportlab {:.1f}x faster'.format(results['pdfkit'][0] / results['reportlab'][0]))
+    return results
+
+
+BENCHMARKS = {'eligibility': eligibility,
+              'matrix': matrix,
+              'indexes': indexes,
+              'meal_save': meal_save,
+              'label_backends': label_backends}
+
+
+if __name__ == '__main__':
+    for name in argv[1:]:
+        if name in BENCHMARKS:
+            BENCHMARKS[name]()
@@ -0,0 +1,129 @@
+"""
+Rolling counters for the dine-in checkin line: how many scans a minute each meal gets, why scans are turned away,
+and how long each part of answering a scan takes.
+Everything is kept in fixed size ring buffers, one bucket per minute and a capped number of timing samples per
+phase, so memory use stays flat no matter how long the server runs.
+"""
+from collections import Counter, deque
+import math
+import threading
+import time
+
+# parts of answering a scan that get timed
+PHASES = ['barcode', 'meal', 'attendee', 'uber', 'checks', 'db', 'scan', 'batch']
+# result codes of scans that let someone in, anything else is a reason they were turned away
+SUCCESS_CODES = ('checked_in', 'replayed', 'recent_checkin')
+
+
+def percentile(ordered, fraction):
+    """
+    Nearest rank percentile
+    :param ordered: sorted list of numbers
+    :param fraction: 0.5 for the median, 0.95 for p95 and so on
+    """
+    if not ordered:
+        return 0
+    rank = math.ceil(fraction * len(ordered)) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+
+class MinuteBucket:
+    """
+    Scan results for one minute, counted by meal and result code
+    """
+
+    def __init__(self, minute):
+        self.minute = minute
+        self.results = Counter()
+
+
+class CheckinMetrics:
+    """
+    Scan counts for the last window minutes, and the most recent timing samples for each phase
+    that fall within the same window.
+    """
+
+    def __init__(self, window=60, samples=2000):
+        """
+        :param window: minutes of history to keep
+        :param samples: timing samples kept per phase, older ones are dropped first
+        """
+        self.window = window
+        self.samples = samples
+        self._buckets = [MinuteBucket(-1) for i in range(window)]
+        self._timings = dict((phase, deque(maxlen=samples)) for phase in PHASES)
+        self._lock = threading.Lock()
+
+    def record_scan(self, meal_id, code):
+        """
+        :param meal_id: meal the scan was for, None outside of meals
+        :param code: short result code, one of SUCCESS_CODES or why it was turned away
+        """
+        minute = int(time.time() // 60)
+        with self._lock:
+            bucket = self._buckets[minute % self.window]
+            if bucket.minute != minute:
+                bucket.minute = minute
+                bucket.results = Counter()
+            bucket.results[(meal_id, code)] += 1
+
+    def record_time(self, phase, seconds):
+        with self._lock:
+            self._timings[phase].append((time.time(), seconds * 1000))
+
+    def clear(self):
+        with self._lock:
+            self._buckets = [MinuteBucket(-1) for i in range(self.window)]
+            for timings in self._timings.values():
+                timings.clear()
+
+    def stats(self):
+        """
+        :return: dict with
+            meals: meal_id to scans, checked_in, rejected, per_minute (oldest first, ending with the current minute),
+                   last_minute, last_5_minutes (scans a minute, averaged) and results (result code to count)
+            latency: phase to count, p50, p95, p99 and max, in milliseconds
+        """
+        now = time.time()
+        minute = int(now // 60)
+        cutoff = now - self.window * 60
+        with self._lock:
+            buckets = [(bucket.minute, Counter(bucket.results)) for bucket in self._buckets
+                       if minute - self.window < bucket.minute <= minute]
+            timings = dict((phase, [ms for when, ms in samples if when > cutoff])
+                           for phase, samples in self._timings.items())
+
+        meals = dict()
+        for bucket_minute, results in buckets:
+            for (meal_id, code), count in results.items():
+                meal = meals.get(meal_id)
+                if meal is None:
+                    meal = {'scans': 0, 'checked_in': 0, 'rejected': 0, 'per_minute': [0] * self.window,
+                            'results': Counter()}
+                    meals[meal_id] = meal
+                meal['scans'] += count
+                if code in SUCCESS_CODES:
+                    meal['checked_in'] += count
+                else:
+                    meal['rejected'] += count
+                meal['per_minute'][self.window - 1 - (minute - bucket_minute)] += count
+                meal['results'][code] += count
+
+        for meal in meals.values():
+            meal['last_minute'] = meal['per_minute'][-1]
+            meal['last_5_minutes'] = round(sum(meal['per_minute'][-5:]) / 5.0, 1)
+            meal['results'] = dict(meal['results'].most_common())
+
+        latency = dict()
+        for phase in PHASES:
+            ordered = sorted(timings[phase])
+            latency[phase] = {'count': len(ordered),
+                              'p50': round(percentile(ordered, 0.5), 2),
+                              'p95': round(percentile(ordered, 0.95), 2),
+                              'p99': round(percentile(ordered, 0.99), 2),
+                              'max': round(ordered[-1], 2) if ordered else 0}
+
+        return {'window_minutes': self.window,
+                'samples': self.samples,
+                'meals': meals,
+                'latency': latency}
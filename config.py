@@ -1,6 +1,5 @@
 import json
 import os
-import requests
 from sys import argv
 
 from datetime import datetime
@@ -11,6 +10,9 @@ from jinja2 import Environment, FileSystemLoader
 import pytz
 from sqlalchemy.ext.declarative import declarative_base
 
+from print_spooler import PrintSpooler
+from uber_client import UberClient
+
 
 class Config:
     """
@@ -94,6 +96,63 @@ class Config:
         self.schedule_tolerance = int(cdata['schedule_tolerance'])
         self.date_format = cdata['date_format']
         self.ss_hours = int(cdata['ss_hours'])
+        # how long (seconds) and how many Uber attendee lookups are kept in memory
+        self.attendee_cache_ttl = int(cdata.get('attendee_cache_ttl', 300))
+        self.attendee_cache_size = int(cdata.get('attendee_cache_size', 2000))
+        # connection pool and timeouts (seconds) for talking to Uber
+        self.uber_pool_size = int(cdata.get('uber_pool_size', 10))
+        self.uber_connect_timeout = float(cdata.get('uber_connect_timeout', 3.05))
+        self.uber_read_timeout = float(cdata.get('uber_read_timeout', 10))
+        self.uber_retries = int(cdata.get('uber_retries', 2))
+        self.uber_retry_backoff = float(cdata.get('uber_retry_backoff', 0.5))
+        # how many attendee lookups to run at once when loading a list of orders
+        self.prefetch_workers = int(cdata.get('prefetch_workers', 8))
+        # local shift mirror: seconds between sync runs, minutes until data is stale, attendees per run
+        self.shift_sync_interval = int(cdata.get('shift_sync_interval', 60))
+        self.shift_sync_stale = int(cdata.get('shift_sync_stale', 30))
+        self.shift_sync_batch = int(cdata.get('shift_sync_batch', 200))
+        # database connection pool, and how long (milliseconds) SQLite waits on a locked database before giving up
+        self.db_pool_size = int(cdata.get('db_pool_size', 10))
+        self.db_max_overflow = int(cdata.get('db_max_overflow', 10))
+        self.db_pool_timeout = int(cdata.get('db_pool_timeout', 30))
+        self.db_busy_timeout = int(cdata.get('db_busy_timeout', 5000))
+        # how many bundle label PDFs can be rendered at once in the background
+        self.label_workers = int(cdata.get('label_workers', 2))
+        # rendered label PDFs are kept for reuse until the cache folder reaches this many megabytes
+        self.label_cache_mb = int(cdata.get('label_cache_mb', 200))
+        # how many threads render departments at once when printing every department's labels for a meal.  Only
+        # helps the pdfkit backend, where each thread waits on its own wkhtmltopdf; reportlab renders one at a time.
+        # label_processes is the old name for it
+        self.label_render_threads = int(cdata.get('label_render_threads', cdata.get('label_processes', 4)))
+        # 'pdfkit' renders print_labels.html with wkhtmltopdf, 'reportlab' draws the labels directly, much faster
+        self.label_backend = cdata.get('label_backend', 'pdfkit')
+        # label printers for remote printing, name: {"target": "tcp://host:9100" or device path,
+        # "language": "zpl" or "escpos"}, and how sends to them are retried
+        self.printers = cdata.get('printers', {})
+        self.print_retries = int(cdata.get('print_retries', 3))
+        self.print_retry_backoff = float(cdata.get('print_retry_backoff', 2))
+        self.print_timeout = float(cdata.get('print_timeout', 10))
+        # seconds between reloads of the in-memory roster the checkin kiosk answers scans from
+        self.checkin_roster_refresh = int(cdata.get('checkin_roster_refresh', 60))
+        # minutes of checkin counts and timings kept for the checkin stats page, and timing samples kept per phase
+        self.checkin_metrics_window = int(cdata.get('checkin_metrics_window', 60))
+        self.checkin_metrics_samples = int(cdata.get('checkin_metrics_samples', 2000))
+        # background sending of Slack messages and webhooks: worker threads, how many sends to one destination
+        # at once, seconds before a send times out, tries before giving up, seconds to wait before the first
+        # retry (doubling each time), and seconds between checks for retries that are due
+        self.notify_workers = int(cdata.get('notify_workers', 4))
+        self.notify_per_destination = int(cdata.get('notify_per_destination', 2))
+        self.notify_timeout = float(cdata.get('notify_timeout', 10))
+        self.notify_max_attempts = int(cdata.get('notify_max_attempts', 6))
+        self.notify_retry_backoff = float(cdata.get('notify_retry_backoff', 30))
+        self.notify_poll_interval = float(cdata.get('notify_poll_interval', 5))
+        # Slack Web API to post to, point it at a local stub for testing (python slack_bot.py stub), messages a
+        # second and burst allowed per channel, longest a send waits for its channel, and connections kept open
+        self.slack_api_url = cdata.get('slack_api_url', 'https://slack.com/api/')
+        self.slack_rate = float(cdata.get('slack_rate', 1))
+        self.slack_burst = int(cdata.get('slack_burst', 3))
+        self.slack_max_wait = float(cdata.get('slack_max_wait', 5))
+        self.slack_pool_size = int(cdata.get('slack_pool_size', 4))
         self.cherrypy = cdata['cherrypy']
         self.cherrypy['/']['tools.staticdir.root'] = os.path.abspath(os.getcwd())
 
@@ -119,6 +178,43 @@ class Config:
             'schedule_tolerance': self.schedule_tolerance,
             'date_format': self.date_format,
             'ss_hours': self.ss_hours,
+            'attendee_cache_ttl': self.attendee_cache_ttl,
+            'attendee_cache_size': self.attendee_cache_size,
+            'uber_pool_size': self.uber_pool_size,
+            'uber_connect_timeout': self.uber_connect_timeout,
+            'uber_read_timeout': self.uber_read_timeout,
+            'uber_retries': self.uber_retries,
+            'uber_retry_backoff': self.uber_retry_backoff,
+            'prefetch_workers': self.prefetch_workers,
+            'shift_sync_interval': self.shift_sync_interval,
+            'shift_sync_stale': self.shift_sync_stale,
+            'shift_sync_batch': self.shift_sync_batch,
+            'db_pool_size': self.db_pool_size,
+            'db_max_overflow': self.db_max_overflow,
+            'db_pool_timeout': self.db_pool_timeout,
+            'db_busy_timeout': self.db_busy_timeout,
+            'label_workers': self.label_workers,
+            'label_cache_mb': self.label_cache_mb,
+            'label_render_threads': self.label_render_threads,
+            'label_backend': self.label_backend,
+            'printers': self.printers,
+            'print_retries': self.print_retries,
+            'print_retry_backoff': self.print_retry_backoff,
+            'print_timeout': self.print_timeout,
+            'checkin_roster_refresh': self.checkin_roster_refresh,
+            'checkin_metrics_window': self.checkin_metrics_window,
+            'checkin_metrics_samples': self.checkin_metrics_samples,
+            'notify_workers': self.notify_workers,
+            'notify_per_destination': self.notify_per_destination,
+            'notify_timeout': self.notify_timeout,
+            'notify_max_attempts': self.notify_max_attempts,
+            'notify_retry_backoff': self.notify_retry_backoff,
+            'notify_poll_interval': self.notify_poll_interval,
+            'slack_api_url': self.slack_api_url,
+            'slack_rate': self.slack_rate,
+            'slack_burst': self.slack_burst,
+            'slack_max_wait': self.slack_max_wait,
+            'slack_pool_size': self.slack_pool_size,
             'cherrypy': self.cherrypy
         }
         
@@ -148,6 +244,18 @@ class Config:
 
 cfg = Config()
 
+uber = UberClient(cfg.api_endpoint, cfg.uber_authkey,
+                  pool_size=cfg.uber_pool_size,
+                  connect_timeout=cfg.uber_connect_timeout,
+                  read_timeout=cfg.uber_read_timeout,
+                  retries=cfg.uber_retries,
+                  backoff=cfg.uber_retry_backoff)
+
+spooler = PrintSpooler(cfg.printers,
+                       retries=cfg.print_retries,
+                       backoff=cfg.print_retry_backoff,
+                       timeout=cfg.print_timeout)
+
 
 class Uberconfig:
     """
@@ -155,13 +263,7 @@ class Uberconfig:
     """
     def __init__(self):
         # runs API request
-        REQUEST_HEADERS = {'X-Auth-Token': cfg.uber_authkey}
-        # data being sent to API
-        request_data = {'method': 'config.info'}
-        request = requests.post(url=cfg.api_endpoint, json=request_data, headers=REQUEST_HEADERS)
-        # print("------printing request before json load")
-        # print(request.text)
-        response = json.loads(request.text)
+        response = uber.call('config.info')
         
         try:
             response = response['error']
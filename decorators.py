@@ -5,6 +5,7 @@ import cherrypy
 
 from shared_functions import HTTPRedirect, is_admin, is_ss_staffer, is_dh
 from config import cfg
+import models
 
 def restricted(func):
     """
@@ -119,3 +120,32 @@ def dh_or_staffer(func):
         return func(*args, **kwargs)
     
     return with_dh_staffer
+
+
+class DatabaseSession(cherrypy.Tool):
+    """
+    Gives every request its own database session as cherrypy.request.db.
+    Nothing is committed for the handler, only its own session.commit() calls are saved.  The session is always
+    closed at the end so its connection goes back to the pool, which rolls back anything left uncommitted.
+    Turn on with 'tools.db.on': True, it is on for everything under Root.
+    """
+    def __init__(self):
+        cherrypy.Tool.__init__(self, 'on_start_resource', self.open_session, priority=20)
+
+    def _setup(self):
+        cherrypy.Tool._setup(self)
+        cherrypy.request.hooks.attach('on_end_resource', self.close_session, priority=80)
+
+    @staticmethod
+    def open_session():
+        cherrypy.request.db = models.new_sesh()
+
+    @staticmethod
+    def close_session():
+        session = getattr(cherrypy.request, 'db', None)
+        if session is not None:
+            session.close()
+            cherrypy.request.db = None
+
+
+cherrypy.tools.db = DatabaseSession()
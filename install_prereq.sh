@@ -7,7 +7,10 @@ pip3 install python-dateutil
 pip3 install jinja2
 pip3 install requests
 pip3 install pdfkit
+pip3 install PyPDF2
+pip3 install reportlab
 pip3 install sqlalchemy
+pip3 install numpy
 git clone https://github.com/KamikazeWombat/StaffSuiteOrdering
 apt-get update
 apt-get install software-properties-common
@@ -0,0 +1,125 @@
+"""
+The parts of label printing that turn label documents into PDFs.
+Only the PDF libraries are imported here, never the config, database or Uber, and everything works on plain data
+passed in, so these can run on any worker thread.
+"""
+import io
+
+import pdfkit
+from PyPDF2 import PdfReader, PdfWriter
+from reportlab.lib.units import inch
+from reportlab.lib.utils import simpleSplit
+from reportlab.pdfgen import canvas
+
+# size of one sticker, the same as the pdfkit page options
+LABEL_WIDTH = 4.0 * inch
+LABEL_HEIGHT = 2.0 * inch
+FONT = 'Helvetica'
+FONT_SIZE = 10
+
+
+def html_to_pdf(html, options, wkhtmltopdf=''):
+    """
+    Runs wkhtmltopdf on one HTML document
+    :param html: label HTML
+    :param options: pdfkit options, page size and margins
+    :param wkhtmltopdf: path to wkhtmltopdf, left blank it is found automatically
+    :return: the PDF as bytes
+    """
+    configuration = None
+    if wkhtmltopdf:
+        configuration = pdfkit.configuration(wkhtmltopdf=wkhtmltopdf)
+    return pdfkit.from_string(html, False, options=options, configuration=configuration)
+
+
+def draw_labels(labels):
+    """
+    Draws labels straight to PDF with reportlab, one 2" x 4" sticker per page, laid out like print_labels.html.
+    Much faster than wkhtmltopdf since there is no HTML to lay out and no outside program to start.
+    :param labels: list of dicts from labels.label_fields
+    :return: the PDF as bytes
+    """
+    pdf_file = io.BytesIO()
+    pdf = canvas.Canvas(pdf_file, pagesize=(LABEL_WIDTH, LABEL_HEIGHT))
+    margin = 0.15 * inch
+    width = LABEL_WIDTH - 2 * margin
+    line_height = FONT_SIZE + 2
+
+    for label in labels:
+        if label.get('separator'):
+            pdf.setLineWidth(2)
+            pdf.roundRect(margin / 2, margin / 2, LABEL_WIDTH - margin, LABEL_HEIGHT - margin, 3)
+            pdf.setFont(FONT + '-Bold', 20)
+            pdf.drawCentredString(LABEL_WIDTH / 2, LABEL_HEIGHT / 2 + 6, label['dept_name'])
+            pdf.setFont(FONT, FONT_SIZE)
+            pdf.drawCentredString(LABEL_WIDTH / 2, LABEL_HEIGHT / 2 - 18,
+                                  '{} - {} labels'.format(label['meal_name'], label['count']))
+            pdf.showPage()
+            continue
+
+        if label['border']:
+            pdf.setLineWidth(2)
+            pdf.roundRect(margin / 2, margin / 2, LABEL_WIDTH - margin, LABEL_HEIGHT - margin, 3)
+
+        y = LABEL_HEIGHT - margin - FONT_SIZE
+        pdf.setFont(FONT + '-Bold', FONT_SIZE)
+        pdf.drawString(margin, y, '# {}'.format(label['badge']))
+        pdf.drawRightString(LABEL_WIDTH - margin, y, label['dept_name'])
+        pdf.setFont(FONT, FONT_SIZE)
+
+        lines = list()
+        if label['allergies']:
+            lines.append((FONT + '-Bold', 'Allergies: ' + label['allergies']))
+        if label['toggles']:
+            lines.append((FONT, ', '.join(label['toggles'])))
+        if label['toppings']:
+            lines.append((FONT, ', '.join('no ' + topping for topping in label['toppings'])))
+        if label['notes']:
+            lines.append((FONT, label['notes']))
+
+        y -= line_height * 1.5
+        for font, text in lines:
+            for line in simpleSplit(text, font, FONT_SIZE, width):
+                if y < margin:
+                    break
+                pdf.setFont(font, FONT_SIZE)
+                pdf.drawString(margin, y, line)
+                y -= line_height
+            y -= line_height / 2
+        pdf.showPage()
+
+    pdf.save()
+    return pdf_file.getvalue()
+
+
+def render_pdf(document, backend, options, wkhtmltopdf=''):
+    """
+    Makes a label PDF with whichever backend is configured
+    :param document: label HTML for pdfkit, or a list of label dicts for reportlab
+    :return: the PDF as bytes
+    """
+    if backend == 'reportlab':
+        return draw_labels(document)
+    return html_to_pdf(document, options, wkhtmltopdf)
+
+
+def merge_pdfs(paths, output):
+    """
+    Joins PDFs into one file, in the order given
+    :param paths: list of PDF paths
+    :param output: path to write the combined PDF to
+    :return: number of pages in the combined PDF
+    """
+    writer = PdfWriter()
+    pages = 0
+    for path in paths:
+        for page in PdfReader(path).pages:
+            writer.add_page(page)
+            pages += 1
+    with open(output, 'wb') as pdf_file:
+        writer.write(pdf_file)
+    return pages
+
+
+def page_count(path):
+    return len(PdfReader(path).pages)
@@ -0,0 +1,505 @@
+"""
+Renders bundle label PDFs in the background.
+wkhtmltopdf takes seconds per bundle, so fulfilment pages hand rendering to a small pool of worker threads and show
+how far along it is instead of waiting on it.  Each bundle has one job record, kept until the server restarts.
+Finished PDFs are kept in a cache keyed by a hash of the label HTML, so a bundle that hasn't changed is never
+rendered twice.
+A job for a whole meal prints every department's labels into one file, rendering several departments at once.
+PDFs come from print_labels.html through wkhtmltopdf, or with label_backend set to 'reportlab' they are drawn
+directly in Python, which is much faster.
+"""
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import threading
+import time
+import traceback
+
+from config import cfg, env
+import label_render
+import models
+from models.department import Department
+from models.dept_order import DeptOrder
+from models.meal import Meal
+from models.order import Order
+import shared_functions
+
+
+LABEL_FOLDER = 'pdfs'
+
+# one 2" x 4" sticker per page
+PDF_OPTIONS = {
+    'page-height': '2.0in',
+    'page-width': '4.0in',
+    'margin-top': '0.0in',
+    'margin-right': '0.0in',
+    'margin-bottom': '0.0in',
+    'margin-left': '0.0in',
+    'encoding': "UTF-8",
+    'print-media-type': None
+}
+
+
+def wkhtmltopdf_path():
+    if cfg.devenv:  # todo: change this to detect OS instead
+        # for some reason the silly system decided to not find it automatically anymore
+        return r'C:\Program Files\wkhtmltopdf\bin\wkhtmltopdf.exe'
+    return ''
+
+
+class LabelCache:
+    """
+    Folder of rendered label PDFs named by the sha256 of the HTML (or reportlab label fields) they were made from.
+    Everything on a label is in there, so the same hash means the same PDF and rendering can be skipped.
+    Once the folder is bigger than max_bytes the least recently used files are deleted, using file modified times
+    which are bumped on every hit.  Files a job still needs can be pinned so they are never the ones deleted.
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # path to how many jobs have it pinned
+        self._pinned = Counter()
+        self._lock = threading.Lock()
+
+    def key(self, document):
+        # the options change the output as much as the HTML does
+        data = document + repr(sorted(PDF_OPTIONS.items()))
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.folder, key + '.pdf')
+
+    def pin(self, keys):
+        """
+        Stops cleanup deleting these PDFs, whether they are cached yet or not, until they are unpinned.
+        Pin before looking them up so nothing can be deleted in between.
+        """
+        with self._lock:
+            for key in keys:
+                self._pinned[self.path(key)] += 1
+
+    def unpin(self, keys):
+        with self._lock:
+            for key in keys:
+                path = self.path(key)
+                self._pinned[path] -= 1
+                if self._pinned[path] <= 0:
+                    del self._pinned[path]
+
+    def lookup(self, key):
+        """
+        :return: path of the cached PDF, or None if it has to be rendered
+        """
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def store(self, key, temp_path):
+        """
+        Moves a freshly rendered PDF into the cache, then trims the cache back under max_bytes
+        :return: path of the cached PDF
+        """
+        path = self.path(key)
+        os.replace(temp_path, path)
+        self.cleanup(keep=path)
+        return path
+
+    def _files(self):
+        files = list()
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith('.pdf'):
+                try:
+                    info = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((info.st_mtime, info.st_size, entry.path))
+        return files
+
+    def cleanup(self, keep=''):
+        """
+        Deletes least recently used PDFs until the cache fits in max_bytes, leaving pinned ones alone
+        :param keep: path that is never deleted, the file that was just added
+        :return: number of files deleted
+        """
+        with self._lock:
+            pinned = set(self._pinned)
+        files = sorted(self._files())
+        total = sum(size for mtime, size, path in files)
+        removed = 0
+        for mtime, size, path in files:
+            if total <= self.max_bytes:
+                break
+            if path == keep or path in pinned:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self):
+        for mtime, size, path in self._files():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        files = self._files() if os.path.isdir(self.folder) else []
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'files': len(files),
+                    'mb': round(sum(size for mtime, size, path in files) / 1048576, 1),
+                    'max_mb': round(self.max_bytes / 1048576, 1)}
+
+
+label_cache = LabelCache(os.path.join(LABEL_FOLDER, 'cache'), cfg.label_cache_mb * 1048576)
+
+
+def store_pdf(key, data):
+    """
+    Saves a rendered PDF in the label cache.
+    It is written under a temporary name and then moved into place, so nobody ever downloads half a PDF.
+    :return: path of the cached PDF
+    """
+    os.makedirs(label_cache.folder, exist_ok=True)
+    temp_path = '{}.{}.tmp'.format(label_cache.path(key), threading.get_ident())
+    try:
+        with open(temp_path, 'wb') as pdf_file:
+            pdf_file.write(data)
+        return label_cache.store(key, temp_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def label_fields(orders, meal, dept_name, separator=False):
+    """
+    The text print_labels.html puts on each label, as plain data for label_render.draw_labels
+    :return: list of dicts, one per label
+    """
+    if separator:
+        return [{'separator': True, 'dept_name': dept_name, 'meal_name': meal.meal_name, 'count': len(orders)}]
+
+    fields = list()
+    for order in orders:
+        toggles = list()
+        for title, selected in ((meal.toggle1_title, order.toggle1),
+                                (meal.toggle2_title, order.toggle2),
+                                (meal.toggle3_title, order.toggle3)):
+            if not title == "" and selected:
+                toggles.append(selected[0][1])
+
+        toppings = list()
+        if not meal.toppings_title == "":
+            toppings = [topping[1] for topping in order.toppings]
+
+        allergies = ''
+        if order.allergies:
+            allergies = ', '.join(order.allergies['standard_labels'])
+            if order.allergies['freeform']:
+                allergies = (allergies + ' ' + order.allergies['freeform']).strip()
+
+        fields.append({'badge': order.attendee.badge_num,
+                       'dept_name': dept_name,
+                       'allergies': allergies,
+                       'toggles': toggles,
+                       'toppings': toppings,
+                       'notes': order.notes or '',
+                       'border': bool(order.allergies or order.notes)})
+    return fields
+
+
+def label_document(orders, meal, dept_name, separator=False):
+    """
+    Whatever the configured backend makes a label PDF from: the print_labels.html HTML for pdfkit,
+    or the label fields for reportlab.
+    :return: label cache key, document
+    """
+    if cfg.label_backend == 'reportlab':
+        document = label_fields(orders, meal, dept_name, separator)
+        return label_cache.key('reportlab' + json.dumps(document, sort_keys=True)), document
+    html = env.get_template('print_labels.html').render(separator=separator, orders=orders, meal=meal,
+                                                         dept_name=dept_name)
+    return label_cache.key(html), html
+
+
+def render_labels(session, meal_id, dept_id):
+    """
+    Makes the label PDF for one department's bundle, only rendering it if the labels have changed since they
+    were last rendered.
+    :return: (path of the PDF, name to download it as), report of what was done
+    """
+    meal = session.query(Meal).filter_by(id=meal_id).one()
+    dept = session.query(Department).filter_by(id=dept_id).one()
+    orders = shared_functions.bundle_orders(session, meal, dept_id)
+
+    key, document = label_document(orders, meal, dept.name)
+    path = label_cache.lookup(key)
+    if not path:
+        path = store_pdf(key, label_render.render_pdf(document, cfg.label_backend, PDF_OPTIONS, wkhtmltopdf_path()))
+    return (path, dept.name + '.pdf'), {'labels': len(orders)}
+
+
+def render_meal_labels(session, meal_id):
+    """
+    Makes one PDF with every department's labels for a meal, ready to print in a single go.
+    Departments are in name order, each one starts with a separator label, and labels within a department are in
+    badge number order.  Departments are the same PDFs the bundle screens print, so any already in the label cache
+    are reused, and with the pdfkit backend the rest are rendered label_render_threads at a time.  That's done on
+    threads rather than forked processes, which aren't safe to start from a threaded server; wkhtmltopdf is its own
+    process anyway so the threads only wait on it.  reportlab draws in Python and holds the GIL, so extra threads
+    wouldn't speed it up and it renders one at a time.
+    :return: (path of the PDF, name to download it as), report of pages, timing and cache use
+    """
+    start = time.monotonic()
+    meal = session.query(Meal).filter_by(id=meal_id).one()
+    dept_ids = session.query(Order.department_id).filter_by(meal_id=meal_id).distinct()
+    depts = session.query(Department).filter(Department.id.in_(dept_ids)).order_by(Department.name).all()
+
+    keys = list()
+    documents = list()
+    label_count = 0
+    for dept in depts:
+        orders = shared_functions.bundle_orders(session, meal, dept.id)
+        if not orders:
+            continue
+        label_count += len(orders)
+        for separator in (True, False):
+            key, document = label_document(orders, meal, dept.name, separator)
+            keys.append(key)
+            documents.append(document)
+    if not documents:
+        raise ValueError('There are no orders to print for this meal.')
+
+    # the combined file is cached too, by the documents that went into it
+    meal_key = hashlib.sha256(','.join(keys).encode('utf-8')).hexdigest()
+    # storing each part trims the cache, which mustn't take the parts this job has yet to merge
+    label_cache.pin(keys + [meal_key])
+    path = None
+    missing = dict()
+    try:
+        path = label_cache.lookup(meal_key)
+        pages = 0
+        if not path:
+            for key, document in zip(keys, documents):
+                if key not in missing and not label_cache.lookup(key):
+                    missing[key] = document
+
+            if missing:
+                if cfg.label_backend == 'reportlab':
+                    workers = 1
+                else:
+                    workers = min(cfg.label_render_threads, len(missing))
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='label-render') as pool:
+                    futures = dict((key, pool.submit(label_render.render_pdf, document, cfg.label_backend,
+                                                     PDF_OPTIONS, wkhtmltopdf_path()))
+                                   for key, document in missing.items())
+                    for key, future in futures.items():
+                        store_pdf(key, future.result())
+
+            os.makedirs(label_cache.folder, exist_ok=True)
+            temp_path = '{}.{}.tmp'.format(label_cache.path(meal_key), threading.get_ident())
+            try:
+                pages = label_render.merge_pdfs([label_cache.path(key) for key in keys], temp_path)
+                path = label_cache.store(meal_key, temp_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        else:
+            pages = label_render.page_count(path)
+    finally:
+        label_cache.unpin(keys + [meal_key])
+        # catch up on the trimming the pins held off
+        label_cache.cleanup(keep=path or '')
+
+    seconds = time.monotonic() - start
+    report = {'departments': len(documents) // 2,
+              'labels': label_count,
+              'pages': pages,
+              'rendered': len(missing),
+              'cached': len(set(keys)) - len(missing),
+              'seconds': round(seconds, 2),
+              'pages_per_second': round(pages / seconds, 1) if seconds else 0}
+    return (path, meal.meal_name + ' labels.pdf'), report
+
+
+class LabelJob:
+    """
+    State of label rendering for one bundle, or for a whole meal when dept_id is blank.
+    path stays set to the last good PDF while a new one renders.
+    """
+
+    def __init__(self, meal_id, dept_id):
+        self.meal_id = meal_id
+        self.dept_id = dept_id
+        self.status = 'new'
+        self.path = ''
+        # file name the PDF is downloaded as
+        self.name = ''
+        self.report = dict()
+        self.error = ''
+        self.runs = 0
+        self.queued_time = None
+        self.started_time = None
+        self.finished_time = None
+        # set when the bundle changes while it is rendering, so it renders again straight after
+        self.rerun = False
+
+    @property
+    def pending(self):
+        return self.status in ('queued', 'running')
+
+    @property
+    def seconds(self):
+        """
+        How long the last render took, or has been running
+        """
+        if not self.started_time:
+            return 0
+        return round((self.finished_time or time.time()) - self.started_time, 1)
+
+
+class LabelJobQueue:
+    """
+    Queue of label rendering jobs run by a bounded pool of worker threads.
+    A bundle only ever has one job waiting, asking again while it waits does nothing since it will read the latest
+    orders when it starts.  Asking while it is running makes it run once more when it finishes.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._executor = None
+        self._jobs = dict()
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='labels')
+        return self._executor
+
+    def submit(self, meal_id, dept_id=''):
+        """
+        Queues a bundle's labels to be rendered, returns straight away
+        :param dept_id: department of the bundle, leave out for every department's labels in one file
+        :return: the bundle's LabelJob
+        """
+        key = (int(meal_id), str(dept_id))
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None:
+                job = LabelJob(*key)
+                self._jobs[key] = job
+
+            if job.status == 'queued':
+                return job
+            if job.status == 'running':
+                job.rerun = True
+                return job
+
+            job.status = 'queued'
+            job.queued_time = time.time()
+            self._pool().submit(self._run, job)
+            return job
+
+    def _run(self, job):
+        while True:
+            with self._lock:
+                job.status = 'running'
+                job.rerun = False
+                job.started_time = time.time()
+                job.finished_time = None
+
+            session = models.new_sesh()
+            try:
+                if job.dept_id:
+                    (path, name), report = render_labels(session, job.meal_id, job.dept_id)
+                else:
+                    (path, name), report = render_meal_labels(session, job.meal_id)
+                error = ''
+            except Exception as e:
+                print('Label rendering failed for meal {} dept {}'.format(job.meal_id, job.dept_id))
+                traceback.print_exc()
+                path = name = ''
+                report = dict()
+                error = str(e)
+            finally:
+                session.close()
+
+            with self._lock:
+                job.finished_time = time.time()
+                job.runs += 1
+                if error:
+                    job.status = 'failed'
+                    job.error = error
+                else:
+                    job.status = 'done'
+                    job.error = ''
+                    job.path = path
+                    job.name = name
+                    job.report = report
+                if not job.rerun:
+                    return
+
+    def status(self, meal_id, dept_id=''):
+        """
+        :return: the bundle's LabelJob, or None if its labels were never asked for
+        """
+        with self._lock:
+            return self._jobs.get((int(meal_id), str(dept_id)))
+
+    def stats(self):
+        with self._lock:
+            counts = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            counts['workers'] = self.workers
+            counts['runs'] = sum(job.runs for job in self._jobs.values())
+            return counts
+
+    def shutdown(self):
+        """
+        Lets the worker threads exit once the jobs already queued are done.  Another submit starts a new pool.
+        """
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+def orders_changed(session, meal_id, dept_ids=None):
+    """
+    Call after changing a meal's orders or its choices.  Bundles that are already locked get their labels rendered
+    again, and so does the all-departments file if it was made; open bundles get theirs when they are locked.
+    :param session: SQLAlchemy session, with the changes committed
+    :param dept_ids: departments whose orders changed, None for every department
+    """
+    if not cfg.local_print:
+        return
+    query = session.query(DeptOrder.dept_id).filter(DeptOrder.meal_id == meal_id, DeptOrder.started == True)
+    if dept_ids is not None:
+        query = query.filter(DeptOrder.dept_id.in_(dept_ids))
+    started = [dept_id for dept_id, in query]
+    for dept_id in started:
+        label_queue.submit(meal_id, dept_id)
+    if started and label_queue.status(meal_id) is not None:
+        label_queue.submit(meal_id)
+
+
+label_queue = LabelJobQueue(cfg.label_workers)
@@ -1,8 +1,12 @@
 
 import cherrypy
+from cherrypy.process.plugins import Monitor
 
-from config import cfg, c
-from shared_functions import load_departments
+from config import cfg, c, spooler
+from labels import label_queue
+from notifications import notifier
+from roster import checkin_roster
+from shared_functions import load_departments, sync_stale_shifts
 import webcode
 
 # force_tls and load_http_server both copied from this guy's blog post.  thanks much for showing me how to do this!
@@ -28,6 +32,15 @@ def load_http_server():
 def main():
     load_departments()
     load_http_server()
+    # keeps the local copy of everyone's shifts fresh so order lists don't have to ask Uber
+    Monitor(cherrypy.engine, sync_stale_shifts, frequency=cfg.shift_sync_interval, name='ShiftSync').subscribe()
+    Monitor(cherrypy.engine, checkin_roster.refresh, frequency=cfg.checkin_roster_refresh,
+            name='CheckinRoster').subscribe()
+    cherrypy.engine.subscribe('stop', label_queue.shutdown)
+    cherrypy.engine.subscribe('stop', spooler.stop)
+    # picks up notifications left queued from before a restart
+    cherrypy.engine.subscribe('start', notifier.start)
+    cherrypy.engine.subscribe('stop', notifier.stop)
     cherrypy.quickstart(webcode.Root(), '/', cfg.cherrypy)
 
 
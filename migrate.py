@@ -0,0 +1,137 @@
+"""
+Brings an existing event database up to date with the current models without losing any data.
+dec_base.metadata.create_all only creates tables that are missing, it never changes tables that already exist,
+so this adds any missing columns and indexes to them, and fills in data for new tables that is worked out from
+existing rows.  Safe to run as many times as you like.
+Run from the project folder, with the site stopped:
+    python migrate.py          (add -dev to use devconfig.json)
+"""
+from sqlalchemy import exists, inspect, literal, text
+from sqlalchemy.orm import sessionmaker
+
+from config import dec_base
+import models
+from models.order import Order
+from models.order_selection import OrderSelection
+import shared_functions
+
+
+def add_missing_columns(engine):
+    """
+    Adds columns that are in the models but not in the database.
+    New columns get the model's default as their SQL default so existing rows are filled in.
+    :return: list of messages about what was done
+    """
+    messages = list()
+    inspector = inspect(engine)
+    existing_tables = inspector.get_table_names()
+
+    for table in dec_base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = [column['name'] for column in inspector.get_columns(table.name)]
+        for column in table.columns:
+            if column.name in existing:
+                continue
+
+            ddl = 'ALTER TABLE "{}" ADD COLUMN "{}" {}'.format(table.name, column.name,
+                                                              column.type.compile(dialect=engine.dialect))
+            if column.default is not None and column.default.is_scalar:
+                default = literal(column.default.arg, column.type).compile(dialect=engine.dialect,
+                                                                          compile_kwargs={'literal_binds': True})
+                ddl += ' DEFAULT ' + str(default)
+            with engine.begin() as conn:
+                conn.execute(text(ddl))
+            messages.append('Added column {}.{}'.format(table.name, column.name))
+
+    return messages
+
+
+def find_duplicates(engine, index):
+    """
+    Counts rows that would break a unique index
+    :return: number of distinct values that appear more than once
+    """
+    columns = ', '.join('"{}"'.format(column.name) for column in index.columns)
+    not_null = ' AND '.join('"{}" IS NOT NULL'.format(column.name) for column in index.columns)
+    query = 'SELECT COUNT(*) FROM (SELECT {0} FROM "{1}" WHERE {2} GROUP BY {0} HAVING COUNT(*) > 1)'.format(
+        columns, index.table.name, not_null)
+    with engine.connect() as conn:
+        return conn.execute(text(query)).scalar()
+
+
+def add_missing_indexes(engine):
+    """
+    Creates indexes and unique indexes that are in the models but not in the database.
+    A unique index is skipped, not forced, if existing rows already break it, so nothing ever gets deleted.
+    :return: list of messages about what was done
+    """
+    messages = list()
+    inspector = inspect(engine)
+
+    for table in dec_base.metadata.sorted_tables:
+        existing = [index['name'] for index in inspector.get_indexes(table.name)]
+        for index in sorted(table.indexes, key=lambda item: item.name):
+            if index.name in existing:
+                continue
+
+            if index.unique:
+                duplicates = find_duplicates(engine, index)
+                if duplicates:
+                    messages.append('Skipped unique index {}: {} values of ({}) appear more than once in {}, '
+                                    'clean those up and run this again'.format(
+                                        index.name, duplicates, ', '.join(column.name for column in index.columns),
+                                        table.name))
+                    continue
+
+            index.create(bind=engine)
+            messages.append('Created index ' + index.name)
+
+    return messages
+
+
+def backfill_order_selections(engine):
+    """
+    Creates the OrderSelection rows for orders saved before that table existed, from their ID fields
+    :return: list of messages about what was done
+    """
+    session = sessionmaker(bind=engine)()
+    try:
+        orders = session.query(Order.id, Order.toggle1, Order.toggle2, Order.toggle3, Order.toppings)\
+            .filter(~exists().where(OrderSelection.order_id == Order.id)).all()
+        mappings = list()
+        for order in orders:
+            mappings.extend(shared_functions.selection_mappings(order.id, order))
+        if not mappings:
+            return []
+        session.bulk_insert_mappings(OrderSelection, mappings)
+        session.commit()
+        return ['Added {} order selections for {} orders'.format(len(mappings),
+                                                                 len(set(item['order_id'] for item in mappings)))]
+    finally:
+        session.close()
+
+
+def migrate(engine):
+    """
+    Runs every migration step against the given engine
+    :return: list of messages about what was done
+    """
+    # creates any tables that are missing entirely
+    dec_base.metadata.create_all(bind=engine)
+    messages = add_missing_columns(engine)
+    messages += add_missing_indexes(engine)
+    messages += backfill_order_selections(engine)
+    return messages
+
+
+def main():
+    messages = migrate(models.engine)
+    for message in messages:
+        print(message)
+    if not messages:
+        print('Database is already up to date.')
+
+
+if __name__ == '__main__':
+    main()
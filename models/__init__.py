@@ -1,11 +1,43 @@
-
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from config import cfg, dec_base
-from models import meal, attendee, order, ingredient, department, dept_order, checkin
-
-engine = create_engine(cfg.database_location)
+from models import meal, attendee, order, ingredient, department, dept_order, checkin, shift, shift_sync, \
+    order_selection, notification
+
+
+def make_engine(database_location):
+    """
+    Creates the database engine.  For SQLite this keeps a pool of connections shared between CherryPy threads,
+    and turns on WAL so staffers can read while an order is being saved, with a busy timeout so two saves at once
+    wait their turn instead of failing with 'database is locked'
+    :param database_location: SQLAlchemy database URL
+    :return: engine
+    """
+    if make_url(database_location).get_backend_name() != 'sqlite':
+        return create_engine(database_location, pool_size=cfg.db_pool_size, max_overflow=cfg.db_max_overflow,
+                             pool_timeout=cfg.db_pool_timeout, pool_pre_ping=True)
+
+    new_engine = create_engine(database_location, poolclass=QueuePool, pool_size=cfg.db_pool_size,
+                               max_overflow=cfg.db_max_overflow, pool_timeout=cfg.db_pool_timeout,
+                               connect_args={'check_same_thread': False,
+                                             'timeout': cfg.db_busy_timeout / 1000})
+
+    @event.listens_for(new_engine, 'connect')
+    def sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA busy_timeout={}'.format(cfg.db_busy_timeout))
+        # safe with WAL, only the last few commits can be lost in a power cut, never corrupts the database
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+    return new_engine
+
+
+engine = make_engine(cfg.database_location)
 new_sesh = sessionmaker(bind=engine)
 
 
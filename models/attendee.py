@@ -7,7 +7,7 @@ from config import dec_base
 
 class Attendee(dec_base):
     __tablename__ = "attendee"
-    badge_num = Column('badge_num', Integer)
+    badge_num = Column('badge_num', Integer, index=True)
     public_id = Column('public_id', String, primary_key=True)
     full_name = Column('full_name', String)
     webhook_url = Column('webhook_url', String, default='')
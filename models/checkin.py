@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Index
 from sqlalchemy.orm import relationship
 import datetime
 
@@ -7,6 +7,9 @@ from config import dec_base
 
 class Checkin(dec_base):
     __tablename__ = "checkin"
+    __table_args__ = (
+        Index('ix_checkin_attendee_meal', 'attendee_id', 'meal_id'),
+    )
 
     id = Column('id', Integer, primary_key=True)
     attendee_id = Column(String, ForeignKey('attendee.public_id'))
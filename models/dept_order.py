@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, ForeignKey, Boolean, DateTime
+from sqlalchemy import Column, String, Integer, ForeignKey, Boolean, DateTime, Index
 from sqlalchemy.orm import relationship
 
 from config import dec_base
@@ -6,6 +6,10 @@ from config import dec_base
 
 class DeptOrder(dec_base):
     __tablename__ = "dept_order"
+    __table_args__ = (
+        # one bundle per department per meal
+        Index('ix_dept_order_meal_dept', 'meal_id', 'dept_id', unique=True),
+    )
     
     id = Column('id', Integer, primary_key=True)
     dept_id = Column(String, ForeignKey('department.id'))
@@ -0,0 +1,28 @@
+from sqlalchemy import Column, Integer, String, DateTime, Index
+import datetime
+
+from config import dec_base
+
+
+class Notification(dec_base):
+    """
+    One outbound Slack message or webhook call, waiting to be sent or kept as a record of how it went.
+    Saved with the change that caused it, so nothing is lost if the server stops before it goes out.
+    """
+    __tablename__ = "notification"
+    __table_args__ = (
+        # the sender looks for queued notifications that are due
+        Index('ix_notification_status_next', 'status', 'next_attempt'),
+    )
+
+    id = Column('id', Integer, primary_key=True)
+    kind = Column('kind', String)  # 'slack' or 'webhook'
+    destination = Column('destination', String)  # Slack channel or webhook URL
+    payload = Column('payload', String)  # message text for Slack, JSON for webhooks
+    description = Column('description', String, default='')  # what it's about, for the notification list
+    status = Column('status', String, default='queued')  # queued, sending, sent or dead
+    attempts = Column('attempts', Integer, default=0)
+    last_error = Column('last_error', String, default='')
+    created = Column('created', DateTime, default=datetime.datetime.utcnow)
+    next_attempt = Column('next_attempt', DateTime, default=datetime.datetime.utcnow)
+    sent_time = Column('sent_time', DateTime)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Index
 from sqlalchemy.orm import relationship
 
 from config import dec_base
@@ -6,6 +6,11 @@ from config import dec_base
 
 class Order(dec_base):
     __tablename__ = "order"
+    __table_args__ = (
+        Index('ix_order_meal_dept', 'meal_id', 'department_id'),
+        # one order per attendee per meal
+        Index('ix_order_meal_attendee', 'meal_id', 'attendee_id', unique=True),
+    )
 
     id = Column('id', Integer, primary_key=True)
     attendee_id = Column(String, ForeignKey('attendee.public_id'))
@@ -21,6 +26,7 @@ class Order(dec_base):
     toggle3 = Column('toggle3', String)
     toppings = Column('toppings', String)
     notes = Column('notes', String(120))  # todo: figure out how long the limit should be
+    selections = relationship('OrderSelection', back_populates='order', cascade='all, delete-orphan')
 
     eligible = False
     allergies = ''
@@ -0,0 +1,22 @@
+from sqlalchemy import Column, Integer, String, ForeignKey, Index
+from sqlalchemy.orm import relationship
+
+from config import dec_base
+
+
+class OrderSelection(dec_base):
+    """
+    One ingredient picked on an order, eg the 'Turkey' toggle or the 'Tomato' topping.
+    Same information as the comma separated ID lists on Order, kept as rows so the database can count them
+    for the kitchen.  Written every time an order is saved.
+    """
+    __tablename__ = "order_selection"
+    __table_args__ = (
+        Index('ix_order_selection_ingredient', 'ingredient_id', 'group'),
+    )
+
+    id = Column('id', Integer, primary_key=True)
+    order_id = Column(Integer, ForeignKey('order.id'), index=True)
+    order = relationship('Order', back_populates='selections')
+    ingredient_id = Column(Integer, ForeignKey('ingredient.id'))
+    group = Column('group', String)  # which field on Order it came from: toppings, toggle1, toggle2 or toggle3
@@ -0,0 +1,17 @@
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime
+
+from config import dec_base
+
+
+class AttendeeShift(dec_base):
+    """
+    Local copy of one of an attendee's shifts from Uber.  Kept up to date by the shift sync job so order lists
+    can work out eligibility without asking Uber.  Times are UTC, end_time does not include the extra 15 minutes.
+    """
+    __tablename__ = "shift"
+
+    id = Column('id', Integer, primary_key=True)
+    attendee_id = Column(String, ForeignKey('attendee.public_id'), index=True)
+    start_time = Column('start_time', DateTime)
+    end_time = Column('end_time', DateTime)
+    extra15 = Column('extra15', Boolean, default=False)
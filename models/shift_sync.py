@@ -0,0 +1,25 @@
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Float
+
+from config import dec_base
+
+
+class ShiftSync(dec_base):
+    """
+    One per attendee in the local shift mirror.  Records when their shifts were last pulled from Uber
+    along with the rest of their Uber record that eligibility checks need.
+    """
+    __tablename__ = "shift_sync"
+
+    attendee_id = Column(String, ForeignKey('attendee.public_id'), primary_key=True)
+    badge_num = Column('badge_num', Integer)
+    synced = Column('synced', DateTime)  # blank means sync as soon as possible
+    checksum = Column('checksum', String)  # hash of the Uber data, shift rows are only rewritten when this changes
+    is_dept_head = Column('is_dept_head', Boolean, default=False)
+    assigned_depts = Column('assigned_depts', String, default='[]')  # JSON list of department labels
+    badge_type = Column('badge_type', String, default='')
+    worked_hours = Column('worked_hours', Float, default=0)
+    weighted_hours = Column('weighted_hours', Float, default=0)
+    food_restrictions = Column('food_restrictions', String, default='')  # JSON from Uber, blank if none
+
+    # below used for page display purposes
+    shifts = []
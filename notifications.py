@@ -0,0 +1,263 @@
+"""
+Sends Slack messages and webhook calls in the background instead of inside the request that caused them.
+Notifications are saved to the database in the same commit as the change they are about, then a small pool of
+worker threads delivers them.  Each destination (a Slack channel, or a webhook's host) only gets a few at once so
+one slow or dead host can't tie up every worker.  Failed sends are retried with a doubling wait, and after
+notify_max_attempts they are marked dead and listed on the notification page to be retried or deleted by hand.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import threading
+from urllib.parse import urlparse
+
+import cherrypy
+from sqlalchemy import and_, func, or_
+
+from config import cfg
+import models
+from models.notification import Notification
+import shared_functions
+import slack_bot
+
+
+def enqueue_slack(session, channels, message, description=''):
+    """
+    Queues a Slack message, one notification per channel so each is retried on its own.  Caller commits,
+    then calls notifier.wake() to have it sent straight away.
+    :param session: SQLAlchemy session
+    :param channels: comma separated list of channels
+    """
+    for channel in channels.split(','):
+        channel = channel.strip()
+        if channel:
+            session.add(Notification(kind='slack', destination=channel, payload=message, description=description))
+
+
+def enqueue_webhook(session, url, data, description=''):
+    """
+    Queues a webhook call.  Caller commits, then calls notifier.wake() to have it sent straight away.
+    :param data: JSON to post, as a string
+    """
+    session.add(Notification(kind='webhook', destination=url, payload=data or '{}', description=description))
+
+
+def destination_key(kind, destination):
+    """
+    What the per-destination limit counts against: Slack rate limits each channel on its own, so each channel is
+    its own destination, webhooks are grouped by host
+    """
+    if kind == 'slack':
+        return 'slack:' + destination.strip()
+    return urlparse(destination).netloc.lower() or destination
+
+
+class Notifier:
+    """
+    Finds notifications that are due and hands them to the worker threads
+    """
+
+    def __init__(self, workers, per_destination, timeout, max_attempts, backoff, poll_interval):
+        self.workers = workers
+        self.per_destination = per_destination
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        # failed sends since the server started, including ones that will be retried
+        self.failed = 0
+        self._in_flight = dict()
+        self._executor = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the sending thread.  Anything left 'sending' when the server last stopped is queued again.
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+
+            session = models.new_sesh()
+            try:
+                session.query(Notification).filter_by(status='sending').update({Notification.status: 'queued'},
+                                                                              synchronize_session=False)
+                session.commit()
+            finally:
+                session.close()
+
+            self._stop.clear()
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='notify')
+            self._thread = threading.Thread(target=self._run, name='notifier', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def wake(self):
+        """
+        Checks for due notifications now instead of at the next poll, call after committing new ones
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self.start()
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                self._dispatch()
+            except Exception:
+                # don't let one bad run kill the thread, it will try again next time
+                cherrypy.log('Error dispatching notifications', traceback=True)
+            self._wake.wait(self.poll_interval)
+
+    def _dispatch(self):
+        """
+        Hands due notifications to the workers, oldest first, until every worker is busy.
+        Destinations already at their limit are left out of the next page, so a backlog for one slow host
+        can't hide everything queued behind it.
+        """
+        session = models.new_sesh()
+        try:
+            now = datetime.utcnow()
+            saturated = set()
+            last = None
+            while True:
+                query = session.query(Notification).filter(Notification.status == 'queued',
+                                                            Notification.next_attempt <= now)
+                if saturated:
+                    query = query.filter(~Notification.destination.in_(list(saturated)))
+                if last is not None:
+                    query = query.filter(or_(Notification.next_attempt > last[0],
+                                             and_(Notification.next_attempt == last[0], Notification.id > last[1])))
+                page = query.order_by(Notification.next_attempt, Notification.id).limit(self.workers * 10).all()
+                if not page:
+                    return
+
+                for notification in page:
+                    last = (notification.next_attempt, notification.id)
+                    key = destination_key(notification.kind, notification.destination)
+                    with self._lock:
+                        if self._executor is None or sum(self._in_flight.values()) >= self.workers:
+                            return
+                        if self._in_flight.get(key, 0) >= self.per_destination:
+                            saturated.add(notification.destination)
+                            continue
+                        self._in_flight[key] = self._in_flight.get(key, 0) + 1
+
+                    notification.status = 'sending'
+                    notification.attempts += 1
+                    job = (notification.id, notification.kind, notification.destination, notification.payload,
+                           notification.attempts, key)
+                    session.commit()
+                    if not self._submit(job):
+                        # stop() ran since the check above, put it back for the next start
+                        notification.status = 'queued'
+                        notification.attempts -= 1
+                        session.commit()
+                        return
+        finally:
+            session.close()
+
+    def _submit(self, job):
+        """
+        :return: False if the workers have been shut down, the job's in-flight count is given back
+        """
+        with self._lock:
+            try:
+                if self._executor is not None:
+                    self._executor.submit(self._deliver, *job)
+                    return True
+            except RuntimeError:
+                # the executor was shut down
+                pass
+            self._in_flight[job[-1]] -= 1
+            return False
+
+    def retry_delay(self, attempts):
+        """
+        How long to wait before the next try, doubling after each failure up to an hour
+        """
+        return timedelta(seconds=min(self.backoff * 2 ** (attempts - 1), 3600))
+
+    def _send(self, kind, destination, payload):
+        if kind == 'slack':
+            slack_bot.post_message(destination, payload, timeout=self.timeout)
+        else:
+            shared_functions.send_webhook(destination, payload, timeout=self.timeout)
+
+    def _deliver(self, notification_id, kind, destination, payload, attempts, key):
+        error = ''
+        retry_after = None
+        try:
+            self._send(kind, destination, payload)
+        except slack_bot.SlackRateLimited as e:
+            # not a failure, just too soon, so it doesn't count as one of its tries
+            error = str(e)
+            retry_after = e.retry_after
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+            print('Notification {} to {} attempt {} failed: {}'.format(notification_id, destination, attempts, error))
+
+        session = models.new_sesh()
+        try:
+            notification = session.query(Notification).filter_by(id=notification_id).one_or_none()
+            # it may have been deleted from the notification page while sending
+            if notification is not None:
+                now = datetime.utcnow()
+                if not error:
+                    notification.status = 'sent'
+                    notification.sent_time = now
+                    notification.last_error = ''
+                elif retry_after is not None:
+                    notification.status = 'queued'
+                    notification.attempts = attempts - 1
+                    notification.last_error = error
+                    notification.next_attempt = now + timedelta(seconds=retry_after)
+                elif attempts >= self.max_attempts:
+                    notification.status = 'dead'
+                    notification.last_error = error
+                else:
+                    notification.status = 'queued'
+                    notification.last_error = error
+                    notification.next_attempt = now + self.retry_delay(attempts)
+                session.commit()
+        except Exception:
+            cherrypy.log('Error saving notification {} result'.format(notification_id), traceback=True)
+        finally:
+            session.close()
+            with self._lock:
+                self._in_flight[key] -= 1
+                if error and retry_after is None:
+                    self.failed += 1
+            # another notification for the same destination may be waiting on this one
+            self._wake.set()
+
+    def stats(self):
+        session = models.new_sesh()
+        try:
+            counts = dict(session.query(Notification.status, func.count(Notification.id))
+                          .group_by(Notification.status))
+        finally:
+            session.close()
+        with self._lock:
+            return {'queued': counts.get('queued', 0),
+                    'sending': counts.get('sending', 0),
+                    'sent': counts.get('sent', 0),
+                    'dead': counts.get('dead', 0),
+                    'in_flight': dict((key, count) for key, count in self._in_flight.items() if count),
+                    'failures': self.failed,
+                    'workers': self.workers}
+
+
+notifier = Notifier(cfg.notify_workers, cfg.notify_per_destination, cfg.notify_timeout, cfg.notify_max_attempts,
+                    cfg.notify_retry_backoff, cfg.notify_poll_interval)
@@ -0,0 +1,426 @@
+"""
+Sends labels straight to label printers as raw printer commands, no PDF and nobody clicking print.
+Each printer has its own queue and sending thread, so a slow or jammed printer only holds up its own labels.
+Printers are reached over the network (tcp://host:9100, the usual raw printing port) or through a device file
+such as /dev/usb/lp0, and speak either ZPL (Zebra style label printers) or ESC/POS (receipt style printers).
+
+For testing without a printer, run a fake one that prints whatever it is sent:
+    python print_spooler.py fake 9100
+and point a printer's target at tcp://127.0.0.1:9100
+"""
+from collections import deque
+import itertools
+import os
+import queue
+import socket
+from sys import argv
+import textwrap
+import threading
+import time
+
+
+# ZPL printers at 203 dpi, 2" x 4" labels
+ZPL_WIDTH = 812
+ZPL_HEIGHT = 406
+ZPL_MARGIN = 30
+ZPL_FONT = 26
+ZPL_CHARS = 52
+
+# ESC/POS printers with 80mm paper fit 48 characters a line in the normal font, leave a little room
+ESCPOS_CHARS = 42
+ESC = b'\x1b'
+GS = b'\x1d'
+
+LANGUAGES = ('zpl', 'escpos')
+
+
+def label_lines(label):
+    """
+    The lines of text under the badge and department on a label, in the order print_labels.html shows them
+    :param label: dict from labels.label_fields
+    :return: list of (bold, text)
+    """
+    lines = list()
+    if label['allergies']:
+        lines.append((True, 'Allergies: ' + label['allergies']))
+    if label['toggles']:
+        lines.append((False, ', '.join(label['toggles'])))
+    if label['toppings']:
+        lines.append((False, ', '.join('no ' + topping for topping in label['toppings'])))
+    if label['notes']:
+        lines.append((False, label['notes']))
+    return lines
+
+
+def zpl_text(text):
+    # ^ and ~ start ZPL commands, they can't appear in field data
+    return str(text).replace('^', ' ').replace('~', ' ')
+
+
+def zpl_label(label):
+    """
+    :param label: dict from labels.label_fields
+    :return: ZPL for one label, as a string
+    """
+    commands = ['^XA', '^CI28', '^PW{}'.format(ZPL_WIDTH), '^LL{}'.format(ZPL_HEIGHT)]
+    width = ZPL_WIDTH - 2 * ZPL_MARGIN
+
+    if label.get('separator'):
+        commands.append('^FO10,10^GB{},{},6^FS'.format(ZPL_WIDTH - 20, ZPL_HEIGHT - 20))
+        commands.append('^FO{},140^A0N,60,60^FB{},1,0,C^FD{}^FS'.format(ZPL_MARGIN, width,
+                                                                         zpl_text(label['dept_name'])))
+        commands.append('^FO{},230^A0N,{},{}^FB{},1,0,C^FD{} - {} labels^FS'.format(
+            ZPL_MARGIN, ZPL_FONT, ZPL_FONT, width, zpl_text(label['meal_name']), label['count']))
+        commands.append('^XZ')
+        return '\n'.join(commands) + '\n'
+
+    if label['border']:
+        commands.append('^FO10,10^GB{},{},4^FS'.format(ZPL_WIDTH - 20, ZPL_HEIGHT - 20))
+    commands.append('^FO{},25^A0N,32,32^FD# {}^FS'.format(ZPL_MARGIN, zpl_text(label['badge'])))
+    commands.append('^FO{},25^A0N,32,32^FB{},1,0,R^FD{}^FS'.format(ZPL_MARGIN, width, zpl_text(label['dept_name'])))
+
+    y = 75
+    for bold, text in label_lines(label):
+        height = ZPL_FONT + 4 if bold else ZPL_FONT
+        for line in textwrap.wrap(zpl_text(text), ZPL_CHARS):
+            if y + height > ZPL_HEIGHT - ZPL_MARGIN:
+                break
+            commands.append('^FO{},{}^A0N,{},{}^FD{}^FS'.format(ZPL_MARGIN, y, height, height, line))
+            y += height + 4
+        y += 8
+    commands.append('^XZ')
+    return '\n'.join(commands) + '\n'
+
+
+def escpos_label(label):
+    """
+    :param label: dict from labels.label_fields
+    :return: ESC/POS commands for one label, as bytes, ending with a paper cut
+    """
+    def text(value):
+        return str(value).encode('ascii', errors='replace')
+
+    data = ESC + b'@'
+    if label.get('separator'):
+        data += ESC + b'a\x01' + GS + b'!\x11' + text(label['dept_name']) + b'\n'
+        data += GS + b'!\x00' + text('{} - {} labels'.format(label['meal_name'], label['count'])) + b'\n'
+        data += ESC + b'a\x00'
+    else:
+        # receipt printers can't draw a box, mark labels with allergies or notes with a line of stars instead
+        if label['border']:
+            data += b'*' * ESCPOS_CHARS + b'\n'
+        header = '# {}'.format(label['badge'])
+        header += label['dept_name'].rjust(ESCPOS_CHARS - len(header))
+        data += ESC + b'E\x01' + text(header) + ESC + b'E\x00' + b'\n'
+        for bold, line_text in label_lines(label):
+            if bold:
+                data += ESC + b'E\x01'
+            for line in textwrap.wrap(line_text, ESCPOS_CHARS):
+                data += text(line) + b'\n'
+            if bold:
+                data += ESC + b'E\x00'
+        if label['border']:
+            data += b'*' * ESCPOS_CHARS + b'\n'
+    # feed past the cutter and cut
+    data += GS + b'V\x42\x03'
+    return data
+
+
+def label_stream(labels, language):
+    """
+    Turns a list of labels into one stream of printer commands
+    :param labels: list of dicts from labels.label_fields
+    :param language: 'zpl' or 'escpos'
+    :return: bytes to send to the printer
+    """
+    if language == 'zpl':
+        return ''.join(zpl_label(label) for label in labels).encode('utf-8')
+    if language == 'escpos':
+        return b''.join(escpos_label(label) for label in labels)
+    raise ValueError('Unknown printer language ' + str(language))
+
+
+def parse_target(target):
+    """
+    :param target: tcp://host:port for a network printer, or the full path of a device file
+    :return: (host, port) for a network printer, (path, None) for a device file
+    :raises ValueError: if the target isn't one of those
+    """
+    if not isinstance(target, str) or not target.strip():
+        raise ValueError('No printer target given')
+    target = target.strip()
+    if target.startswith('tcp://'):
+        host, separator, port = target[len('tcp://'):].rpartition(':')
+        if not separator or not host:
+            raise ValueError('Printer target {} should look like tcp://host:9100'.format(target))
+        try:
+            port = int(port)
+        except ValueError:
+            raise ValueError('Printer target {} has a port that is not a number'.format(target))
+        if not 0 < port < 65536:
+            raise ValueError('Printer target {} has a port out of range'.format(target))
+        # IPv6 addresses are written in brackets, tcp://[fe80::1]:9100
+        return host.strip('[]'), port
+    if '://' in target:
+        raise ValueError('Printer target {} is not tcp://host:port or a device path'.format(target))
+    if not os.path.isabs(target):
+        raise ValueError('Printer device {} should be a full path, like /dev/usb/lp0'.format(target))
+    return target, None
+
+
+def send_to_printer(target, data, timeout):
+    """
+    Sends raw printer commands
+    :param target: tcp://host:port for a network printer, or a device file path
+    """
+    host, port = parse_target(target)
+    if port is not None:
+        with socket.create_connection((host, port), timeout=timeout) as connection:
+            connection.sendall(data)
+    else:
+        with open(host, 'ab') as device:
+            device.write(data)
+
+
+class PrintJob:
+    _ids = itertools.count(1)
+
+    def __init__(self, printer, description, data, labels):
+        self.id = next(self._ids)
+        self.printer = printer
+        self.description = description
+        self.data = data
+        self.labels = labels
+        self.status = 'queued'
+        self.attempts = 0
+        self.error = ''
+        self.queued_time = time.time()
+        self.finished_time = None
+
+
+class PrinterQueue:
+    """
+    Jobs waiting for one printer, sent in order by a single thread.
+    A failed send is retried with a growing wait in between before the job is given up on.
+    """
+
+    def __init__(self, name, target, language, retries=3, backoff=2.0, timeout=10.0):
+        """
+        :raises ValueError: if the target or language isn't usable
+        """
+        parse_target(target)
+        if language not in LANGUAGES:
+            raise ValueError('Printer language {} is not one of {}'.format(language, ', '.join(LANGUAGES)))
+        self.name = name
+        self.target = target
+        self.language = language
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.last_error = ''
+        # jobs not finished yet, including the one being sent
+        self.waiting = 0
+        # recent jobs, for the status pages
+        self.jobs = deque(maxlen=50)
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, labels, description=''):
+        """
+        Queues labels to be printed, returns straight away
+        :param labels: list of dicts from labels.label_fields
+        :return: PrintJob
+        """
+        job = PrintJob(self.name, description, label_stream(labels, self.language), len(labels))
+        with self._lock:
+            self.jobs.append(job)
+            self.waiting += 1
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='printer-' + self.name, daemon=True)
+                self._thread.start()
+        self._queue.put(job)
+        return job
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                job = self._queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            # None is only put there by stop() to wake this up
+            if job is None:
+                continue
+            try:
+                self._send(job)
+            except Exception as e:
+                # whatever went wrong, it's only this job that failed, keep going with the next one
+                print('Printer {} could not send {}: {}: {}'.format(self.name, job.description, type(e).__name__, e))
+                job.error = '{}: {}'.format(type(e).__name__, e)
+                self._finish(job, 'failed')
+
+    def _send(self, job):
+        job.status = 'sending'
+        for attempt in range(self.retries + 1):
+            if attempt:
+                with self._lock:
+                    self.retried += 1
+                # wait longer each time, but stop waiting straight away if the spooler is shutting down
+                if self._stop.wait(self.backoff * 2 ** (attempt - 1)):
+                    break
+            job.attempts += 1
+            try:
+                send_to_printer(self.target, job.data, self.timeout)
+            except Exception as e:
+                print('Printer {} attempt {} failed for {}: {}'.format(self.name, job.attempts, job.description, e))
+                job.error = str(e) if isinstance(e, OSError) else '{}: {}'.format(type(e).__name__, e)
+                continue
+            job.error = ''
+            self._finish(job, 'sent')
+            return
+
+        self._finish(job, 'failed')
+
+    def _finish(self, job, status):
+        with self._lock:
+            # already counted
+            if job.finished_time is not None:
+                return
+            job.status = status
+            job.finished_time = time.time()
+            self.waiting -= 1
+            if status == 'sent':
+                self.sent += 1
+            else:
+                self.failed += 1
+                self.last_error = job.error
+
+    def stop(self):
+        self._stop.set()
+        self._queue.put(None)
+
+    def stats(self):
+        with self._lock:
+            return {'target': self.target,
+                    'language': self.language,
+                    'depth': self.waiting,
+                    'sent': self.sent,
+                    'failed': self.failed,
+                    'retried': self.retried,
+                    'last_error': self.last_error}
+
+
+class PrintSpooler:
+    """
+    All the configured printers, by name
+    """
+
+    def __init__(self, printers, retries=3, backoff=2.0, timeout=10.0):
+        """
+        Printers that aren't set up right are left out, with the reason kept in errors for the config page
+        :param printers: dict of name to {'target': 'tcp://host:port' or device path, 'language': 'zpl' or 'escpos'}
+        """
+        self.printers = dict()
+        self.errors = dict()
+        for name, printer in printers.items():
+            try:
+                if not isinstance(printer, dict):
+                    raise ValueError('Printer settings should be {"target": ..., "language": ...}')
+                self.printers[name] = PrinterQueue(name, printer.get('target'), printer.get('language', 'zpl'),
+                                                   retries=retries, backoff=backoff, timeout=timeout)
+            except ValueError as e:
+                print('Printer {} is not set up right and will not be used: {}'.format(name, e))
+                self.errors[name] = str(e)
+
+    def submit(self, printer, labels, description=''):
+        """
+        :raises KeyError: if there is no printer with that name
+        """
+        return self.printers[printer].submit(labels, description)
+
+    def stats(self):
+        return dict((name, printer.stats()) for name, printer in sorted(self.printers.items()))
+
+    def stop(self):
+        for printer in self.printers.values():
+            printer.stop()
+
+
+class FakePrinter:
+    """
+    Pretends to be a network label printer: listens on a local port and keeps everything sent to it.
+    offline() refuses connections like an unplugged printer until online() is called, for testing retries.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, echo=False):
+        self.host = host
+        self.port = port
+        self.echo = echo
+        # everything received, one entry per connection
+        self.received = list()
+        self._server = None
+        self._thread = None
+        self.online()
+
+    @property
+    def target(self):
+        return 'tcp://{}:{}'.format(self.host, self.port)
+
+    def online(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((self.host, self.port))
+        self.port = server.getsockname()[1]
+        server.listen(5)
+        # closing a socket doesn't wake a thread waiting in accept, so check for offline() every so often
+        server.settimeout(0.2)
+        self._server = server
+        self._thread = threading.Thread(target=self._serve, args=(server,), name='fake-printer', daemon=True)
+        self._thread.start()
+
+    def offline(self):
+        server = self._server
+        self._server = None
+        if server is not None:
+            self._thread.join()
+            server.close()
+
+    def _serve(self, server):
+        while self._server is server:
+            try:
+                connection, address = server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            connection.settimeout(None)
+            with connection:
+                data = b''
+                while True:
+                    chunk = connection.recv(65536)
+                    if not chunk:
+                        break
+                    data += chunk
+            self.received.append(data)
+            if self.echo:
+                print('--- {} bytes from {} ---'.format(len(data), address[0]))
+                print(data.decode('utf-8', errors='replace'))
+
+    def close(self):
+        self.offline()
+
+
+if __name__ == '__main__':
+    if len(argv) > 1 and argv[1] == 'fake':
+        fake = FakePrinter(port=int(argv[2]) if len(argv) > 2 else 9100, echo=True)
+        print('Fake printer listening on ' + fake.target)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            fake.close()
@@ -0,0 +1,443 @@
+"""
+Everything the dine-in checkin kiosk needs to answer a scan, held in memory.
+Checking a badge used to take several trips to Uber per scan (barcode, attendee, allergies, eligibility), which is
+slow and falls over when Uber does.  The roster is loaded from the local shift mirror when the checkin page opens a
+meal: who each badge belongs to, whether they are eligible, exempt or a department head, their allergies, who has a
+delivery order for the meal and who has already checked in.  It is reloaded in the background every
+checkin_roster_refresh seconds, and Uber is only asked about badges and barcodes the roster has never seen.
+"""
+from datetime import datetime, timedelta
+import threading
+import time
+
+import cherrypy
+
+from checkin_metrics import CheckinMetrics
+from config import cfg
+import models
+from models.attendee import Attendee
+from models.checkin import Checkin
+from models.meal import Meal
+from models.order import Order
+from models.shift_sync import ShiftSync
+import shared_functions
+
+
+class RosterEntry:
+    """
+    One attendee's checkin details, built from their shift mirror row
+    """
+
+    def __init__(self, attendee, sync):
+        self.public_id = attendee.public_id
+        self.badge_num = attendee.badge_num
+        self.full_name = attendee.full_name
+        self.is_dept_head = bool(sync.is_dept_head)
+        self.exempt = shared_functions.mirror_exempt(sync)
+        self.ss_eligible = shared_functions.mirror_ss_eligible(sync)
+
+        allergies = shared_functions.mirror_allergies(sync)
+        self.allergy_msg = ''
+        if allergies:
+            for allergy in allergies['standard_labels']:
+                self.allergy_msg += allergy + '<br>'
+            self.allergy_msg += allergies['freeform']
+
+
+class MealRoster:
+    """
+    Who has a delivery order for one meal, and who has checked in for it
+    """
+
+    def __init__(self, meal, delivery, checked_in):
+        self.meal_id = meal.id
+        self.start_time = meal.start_time
+        self.end_time = meal.end_time
+        # public_ids of attendees whose order for this meal gets delivered, they can't also eat in
+        self.delivery = delivery
+        # public_id to checkin time of attendees already checked in for this meal
+        self.checked_in = checked_in
+
+
+class CheckinRoster:
+    """
+    Badge and barcode lookups for the checkin kiosk, answered from memory.
+    Open meals stay loaded until an hour after they end.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.barcode_hits = 0
+        self.barcode_misses = 0
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.loaded_time = None
+        self._people = dict()
+        self._barcodes = dict()
+        self._meals = dict()
+        # only one load at a time, the refresh job and a kiosk opening a meal could otherwise both build one
+        self._load_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    def _load_people(self, session):
+        people = dict()
+        rows = session.query(Attendee, ShiftSync)\
+            .join(ShiftSync, ShiftSync.attendee_id == Attendee.public_id)\
+            .filter(Attendee.badge_num != None, ShiftSync.checksum != None).all()
+        for attendee, sync in rows:
+            people[attendee.badge_num] = RosterEntry(attendee, sync)
+        return people
+
+    def _load_meal(self, session, meal):
+        ordered = session.query(Attendee).join(Order, Order.attendee_id == Attendee.public_id)\
+            .filter(Order.meal_id == meal.id).all()
+        mirror = shared_functions.load_shift_mirror(session, ordered)
+
+        delivery = set()
+        for attendee in ordered:
+            sync = mirror.get(attendee.public_id)
+            if sync is None:
+                continue
+            if sync.is_dept_head or shared_functions.mirror_exempt(sync) or \
+                    shared_functions.carryout_eligible(sync.shifts, meal.start_time, meal.end_time):
+                delivery.add(attendee.public_id)
+
+        checked_in = dict(session.query(Checkin.attendee_id, Checkin.timestamp).filter(Checkin.meal_id == meal.id))
+        return MealRoster(meal, delivery, checked_in)
+
+    def open_meal(self, session, meal):
+        """
+        Loads a meal into the roster, and everyone's details with it the first time.  Does nothing if already loaded.
+        :param session: SQLAlchemy session
+        :param meal: Meal object
+        :return: MealRoster
+        """
+        meal_roster = self._meals.get(meal.id)
+        if meal_roster is not None:
+            return meal_roster
+
+        with self._load_lock:
+            if meal.id in self._meals:
+                return self._meals[meal.id]
+            start = time.perf_counter()
+            people = self._people if self.loaded_time else self._load_people(session)
+            meal_roster = self._load_meal(session, meal)
+            with self._lock:
+                self._people = people
+                self._meals[meal.id] = meal_roster
+                self.loaded_time = shared_functions.now_utc()
+                self.loads += 1
+                self.load_seconds = time.perf_counter() - start
+        return meal_roster
+
+    def meal(self, session, meal_id):
+        """
+        :return: MealRoster for this meal, loading it if the kiosk was opened before a restart.  None if no such meal
+        """
+        try:
+            meal_roster = self._meals.get(int(meal_id))
+        except (TypeError, ValueError):
+            return None
+        if meal_roster is not None:
+            return meal_roster
+
+        meal = session.query(Meal).filter_by(id=meal_id).one_or_none()
+        if not meal:
+            return None
+        return self.open_meal(session, meal)
+
+    def refresh(self):
+        """
+        Background job that reloads everyone's details and every open meal, so orders, shift changes and
+        checkins from elsewhere show up.  Meals that ended more than an hour ago are dropped.
+        """
+        if not self._meals:
+            return
+
+        session = models.new_sesh()
+        try:
+            with self._load_lock:
+                start = time.perf_counter()
+                cutoff = shared_functions.now_utc() - timedelta(hours=1)
+                meals = session.query(Meal).filter(Meal.id.in_(list(self._meals.keys())),
+                                                   Meal.end_time > cutoff).all()
+                people = self._load_people(session)
+                meal_rosters = dict((meal.id, self._load_meal(session, meal)) for meal in meals)
+                with self._lock:
+                    # anyone checked in while this was loading is in the old set but might not be in the new one
+                    for meal_id, meal_roster in meal_rosters.items():
+                        if meal_id in self._meals:
+                            for public_id, timestamp in self._meals[meal_id].checked_in.items():
+                                meal_roster.checked_in.setdefault(public_id, timestamp)
+                    # keep anyone added from Uber during the load
+                    for badge_num, entry in self._people.items():
+                        people.setdefault(badge_num, entry)
+                    self._people = people
+                    self._meals = meal_rosters
+                    self.loaded_time = shared_functions.now_utc()
+                    self.loads += 1
+                    self.load_seconds = time.perf_counter() - start
+        except Exception:
+            # keep answering from the last load, it will try again next time
+            cherrypy.log('Error refreshing checkin roster', traceback=True)
+        finally:
+            session.close()
+
+    def badge_for_barcode(self, barcode):
+        """
+        Barcodes never change, so each one is only looked up in Uber once
+        :return: badge number, or None if Uber doesn't know the barcode
+        """
+        badge_num = self._barcodes.get(barcode)
+        if badge_num is not None:
+            self.barcode_hits += 1
+            return badge_num
+
+        self.barcode_misses += 1
+        start = time.perf_counter()
+        badge_num = shared_functions.barcode_to_badge(barcode)
+        checkin_metrics.record_time('uber', time.perf_counter() - start)
+        if badge_num:
+            self._barcodes[barcode] = badge_num
+        return badge_num
+
+    def person(self, badge_num):
+        """
+        :return: RosterEntry, or None if the badge isn't in Uber either
+        """
+        entry = self._people.get(badge_num)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        start = time.perf_counter()
+        response = shared_functions.lookup_attendee(badge_num, full=True)
+        checkin_metrics.record_time('uber', time.perf_counter() - start)
+        if 'error' in response:
+            return None
+
+        # separate session so a batch of checkins is still saved in one transaction
+        session = models.new_sesh()
+        try:
+            attendee = session.query(Attendee).filter_by(public_id=response['result']['public_id']).one_or_none()
+            if not attendee:
+                attendee = Attendee()
+                attendee.public_id = response['result']['public_id']
+                session.add(attendee)
+            attendee.badge_num = response['result']['badge_num']
+            attendee.full_name = response['result']['full_name']
+            shared_functions.update_shift_mirror(session, [(attendee.public_id, response)])
+            session.commit()
+
+            sync = session.query(ShiftSync).filter_by(attendee_id=attendee.public_id).one()
+            entry = RosterEntry(attendee, sync)
+        finally:
+            session.close()
+        with self._lock:
+            self._people[badge_num] = entry
+        return entry
+
+    def claim(self, meal_roster, public_id, timestamp):
+        """
+        Marks an attendee as checked in for a meal, so two kiosks scanning the same badge can't both let them in.
+        :return: False if they were already checked in
+        """
+        with self._lock:
+            if public_id in meal_roster.checked_in:
+                return False
+            meal_roster.checked_in[public_id] = timestamp
+            return True
+
+    def release(self, meal_roster, public_id):
+        """
+        Undoes claim() if saving the checkin failed
+        """
+        with self._lock:
+            meal_roster.checked_in.pop(public_id, None)
+            # a refresh may have swapped in a new copy of the meal since it was claimed
+            current = self._meals.get(meal_roster.meal_id)
+            if current is not None:
+                current.checked_in.pop(public_id, None)
+
+    def check_in(self, session, scans):
+        """
+        Checks in a batch of badge scans and saves them in one transaction.
+        Scans are safe to send again, one matching an existing checkin's time is reported as a success
+        without adding another, so a kiosk can replay its queue after losing a response.
+        A scan that can't be read, or errors while being checked, gets a failed result of its own instead of
+        failing the whole batch.  Ones that errored also have retry set, since they may work if sent again.
+        :param session: SQLAlchemy session, committed here
+        :param scans: list of dicts with badge (number or ~barcode), meal_id (blank or None outside meals),
+        and optionally scanned_at (milliseconds since the epoch, when the badge was scanned) and id (sent back as is)
+        :return: list of dicts with success, badge, reason and allergies for each scan, in the same order
+        """
+        batch_start = time.perf_counter()
+        results = list()
+        codes = list()
+        claims = list()
+        for scan in scans:
+            if not isinstance(scan, dict):
+                results.append({"success": False, "badge": "", "reason": "Could not read this scan."})
+                codes.append((None, 'unreadable'))
+                continue
+            
+            start = time.perf_counter()
+            claimed = len(claims)
+            try:
+                code, result = self._check_in_scan(session, scan, claims)
+            except Exception:
+                cherrypy.log('Error checking in scan {!r}'.format(scan), traceback=True)
+                # nothing was added for this scan, so let go of its claim and let the kiosk send it again
+                for meal_roster, public_id in claims[claimed:]:
+                    self.release(meal_roster, public_id)
+                del claims[claimed:]
+                code, result = 'error', {"success": False, "badge": str(scan.get('badge') or ''), "retry": True,
+                                         "reason": "Error checking in, will try again."}
+            checkin_metrics.record_time('scan', time.perf_counter() - start)
+            if 'id' in scan:
+                result['id'] = scan['id']
+            results.append(result)
+            codes.append((scan_meal_id(scan), code))
+
+        start = time.perf_counter()
+        try:
+            session.commit()
+        except Exception:
+            for meal_roster, public_id in claims:
+                self.release(meal_roster, public_id)
+            raise
+        checkin_metrics.record_time('db', time.perf_counter() - start)
+        checkin_metrics.record_time('batch', time.perf_counter() - batch_start)
+        # only counted once saved, a batch that fails to save will be sent again
+        for meal_id, code in codes:
+            checkin_metrics.record_scan(meal_id, code)
+        return results
+
+    def _check_in_scan(self, session, scan, claims):
+        """
+        :return: result code for the metrics, and the result to send back
+        """
+        badge = str(scan.get('badge') or '').strip()
+        if badge.startswith("~"):
+            start = time.perf_counter()
+            badge = self.badge_for_barcode(badge)
+            checkin_metrics.record_time('barcode', time.perf_counter() - start)
+        else:
+            try:
+                badge = int(badge)
+            except ValueError:
+                return 'not_a_number', {"success": False, "badge": badge, "reason": "Not a number?"}
+
+        if not badge:
+            return 'badge_not_found', {"success": False, "badge": badge, "reason": "Could not locate badge."}
+
+        start = time.perf_counter()
+        meal_id = scan_meal_id(scan)
+        meal_roster = self.meal(session, meal_id) if meal_id else None
+        checkin_metrics.record_time('meal', time.perf_counter() - start)
+
+        start = time.perf_counter()
+        attend = self.person(badge)
+        checkin_metrics.record_time('attendee', time.perf_counter() - start)
+        if not attend:
+            return 'not_in_reggie', {"success": False, "badge": badge,
+                                     "reason": "Badge # {} is not found in Reggie".format(badge)}
+
+        start = time.perf_counter()
+        try:
+            return self._check_attendee(session, scan, claims, badge, meal_roster, attend)
+        finally:
+            checkin_metrics.record_time('checks', time.perf_counter() - start)
+
+    def _check_attendee(self, session, scan, claims, badge, meal_roster, attend):
+        # if their order is eligible for carryout, they get kicked out
+        if meal_roster and attend.public_id in meal_roster.delivery:
+            return 'delivery_order', {"success": False, "badge": badge,
+                                      "reason": "Attendee {} has placed a delivery order for this meal.".format(badge)}
+
+        timestamp = scan_time(scan.get('scanned_at'))
+        allergy_msg = attend.allergy_msg
+        if meal_roster and attend.public_id in meal_roster.checked_in:
+            if meal_roster.checked_in[attend.public_id] == timestamp:
+                # the same scan sent again
+                return 'replayed', {"success": True, "badge": badge, "reason": "", "allergies": allergy_msg}
+            return 'already_checked_in', {"success": False, "badge": badge,
+                                          "reason": "Badge is already checked in for this meal.",
+                                          "allergies": allergy_msg}
+
+        if not attend.ss_eligible:
+            return 'not_eligible', {"success": False, "badge": badge,
+                                    "reason": "Badge is not eligible for food. Please see STOPS."}
+
+        if meal_roster:
+            # another kiosk may have scanned the same badge since the check above
+            if not self.claim(meal_roster, attend.public_id, timestamp):
+                return 'already_checked_in', {"success": False, "badge": badge,
+                                              "reason": "Badge is already checked in for this meal.",
+                                              "allergies": allergy_msg}
+            claims.append((meal_roster, attend.public_id))
+            session.add(Checkin(attendee_id=attend.public_id, meal_id=meal_roster.meal_id, timestamp=timestamp))
+            return 'checked_in', {"success": True, "badge": badge, "reason": "", "allergies": allergy_msg}
+
+        checkins = session.query(Checkin).filter(Checkin.attendee_id == attend.public_id,
+                                                 Checkin.meal_id == None).all()
+        for item in checkins:
+            # a previous checkin outside of meals within 2 hours of this one counts for this one too
+            if abs(item.timestamp - timestamp) < timedelta(hours=2):
+                return 'recent_checkin', {"success": True, "badge": badge, "reason": "", "allergies": allergy_msg}
+        session.add(Checkin(attendee_id=attend.public_id, meal_id=None, timestamp=timestamp))
+        return 'checked_in', {"success": True, "badge": badge, "reason": "", "allergies": allergy_msg}
+
+    def clear(self):
+        with self._load_lock, self._lock:
+            self._people = dict()
+            self._barcodes = dict()
+            self._meals = dict()
+            self.loaded_time = None
+
+    def stats(self):
+        with self._lock:
+            return {'people': len(self._people),
+                    'barcodes': len(self._barcodes),
+                    'meals': len(self._meals),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'barcode_hits': self.barcode_hits,
+                    'barcode_misses': self.barcode_misses,
+                    'loads': self.loads,
+                    'load_seconds': round(self.load_seconds, 2),
+                    'loaded_time': self.loaded_time}
+
+
+def scan_meal_id(scan):
+    """
+    :return: the meal a scan was for as an int, None outside of meals
+    """
+    try:
+        return int(scan.get('meal_id'))
+    except (TypeError, ValueError):
+        return None
+
+
+def scan_time(scanned_at):
+    """
+    When a badge was scanned, as naive UTC the way the DB stores it
+    :param scanned_at: milliseconds since the epoch from the kiosk's clock, blank for now
+    """
+    now = datetime.utcnow()
+    if not scanned_at:
+        return now
+    try:
+        timestamp = datetime.utcfromtimestamp(float(scanned_at) / 1000)
+    except (TypeError, ValueError, OverflowError):
+        return now
+    # a kiosk with its clock badly wrong gets the server's time instead
+    if abs(timestamp - now) > timedelta(days=1):
+        return now
+    return timestamp
+
+
+checkin_roster = CheckinRoster()
+checkin_metrics = CheckinMetrics(cfg.checkin_metrics_window, cfg.checkin_metrics_samples)
@@ -1,22 +1,35 @@
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import copy
+import hashlib
 import json
 import random
 import requests
+import threading
+import time
 from urllib.parse import quote, urlparse
 import uuid
 
 import cherrypy
-from datetime import datetime
+from datetime import datetime, timedelta
 from dateutil.parser import parse
 from dateutil.relativedelta import relativedelta
 from dateutil.tz import tzlocal
+import numpy as np
 import pytz
+from sqlalchemy import and_, cast, func, Integer, or_
+import sqlalchemy.exc
 import sqlalchemy.orm.exc
+from sqlalchemy.orm import joinedload
 
-from config import cfg, c
+from config import cfg, c, uber
 import models
 from models.ingredient import Ingredient
 from models.department import Department
+from models.order_selection import OrderSelection
+from models.shift import AttendeeShift
+from models.shift_sync import ShiftSync
 
 
 class HTTPRedirect(cherrypy.HTTPRedirect):
@@ -150,12 +163,8 @@ def api_login(first_name, last_name, email, zip_code):
     """
 
     #runs API request
-    REQUEST_HEADERS = {'X-Auth-Token': cfg.uber_authkey}
-    # data being sent to API
-    request_data = {'method': 'attendee.login',
-                    'params': [first_name.strip(), last_name.strip(), email.strip(), zip_code.strip()]}
-    request = requests.post(url=cfg.api_endpoint, json=request_data, headers=REQUEST_HEADERS)
-    response = json.loads(request.text)
+    response = uber.call('attendee.login',
+                         [first_name.strip(), last_name.strip(), email.strip(), zip_code.strip()])
 
     #print(response)
     return response
@@ -165,11 +174,7 @@ def barcode_to_badge(barcode):
     """
     Queries uber to get the badge number associated with a barcode
     """
-    REQUEST_HEADERS = {'X-Auth-Token': cfg.uber_authkey}
-    request_data = {'method': 'barcode.lookup_badge_number_from_barcode',
-                    'params': [barcode,]}
-    request = requests.post(url=cfg.api_endpoint, json=request_data, headers=REQUEST_HEADERS)
-    response = json.loads(request.text)
+    response = uber.call('barcode.lookup_badge_number_from_barcode', [barcode,])
     if "error" in response:
         return None
     return response['result']['badge_num']
@@ -234,12 +239,7 @@ def load_departments():
     Loads departments from connected Uber instance
     :return:
     """
-    REQUEST_HEADERS = {'X-Auth-Token': cfg.uber_authkey}
-    
-    # data being sent to API
-    request_data = {'method': 'dept.list'}
-    request = requests.post(url=cfg.api_endpoint, json=request_data, headers=REQUEST_HEADERS)
-    response = json.loads(request.text)
+    response = uber.call('dept.list')
     response = response['result'].items()
     # print('----------------------------')
     # print(response)
@@ -263,36 +263,204 @@ def load_departments():
     return
     
 
-def lookup_attendee(badge_num, full=False):
+class AttendeeCache:
+    """
+    Size bounded LRU cache of Uber attendee.lookup responses, keyed by badge number and the full flag.
+    Entries expire after ttl seconds.  Error responses are never cached so a missing badge gets retried.
+    Cached responses are shared between callers, do not modify them.
+    """
+    
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _key(badge_num, full):
+        return str(badge_num).strip(), bool(full)
+    
+    def get(self, badge_num, full=False):
+        """
+        Returns the cached response for this badge, or None if missing or expired.
+        A cached full lookup also answers a request for a non-full one since it has the same fields and more.
+        """
+        keys = [self._key(badge_num, full)]
+        if not full:
+            keys.append(self._key(badge_num, True))
+        
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                expires, response = entry
+                if expires < now:
+                    del self._entries[key]
+                    continue
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return response
+            
+            self.misses += 1
+            return None
+    
+    def put(self, badge_num, full, response):
+        if 'error' in response or self.ttl <= 0 or self.max_size <= 0:
+            return
+        
+        key = self._key(badge_num, full)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self, badge_num):
+        """
+        Drops both the full and non-full entries for a badge
+        """
+        with self._lock:
+            for full in (False, True):
+                self._entries.pop(self._key(badge_num, full), None)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self._entries),
+                    'max_size': self.max_size,
+                    'ttl': self.ttl}
+
+
+attendee_cache = AttendeeCache(cfg.attendee_cache_ttl, cfg.attendee_cache_size)
+
+
+def lookup_attendee(badge_num, full=False, cached=True):
     """
     Looks up an existing attendee by badge_num and returns the resulting json data
+    Goes through attendee_cache first, so repeated lookups for the same badge within one page
+    or within a few minutes only cost one request to Uber.
+    :param cached: set False to skip the cache and force a fresh lookup, the result still refreshes the cache
     """
-    REQUEST_HEADERS = {'X-Auth-Token': cfg.uber_authkey}
+    if cached:
+        response = attendee_cache.get(badge_num, full)
+        if response is not None:
+            return response
     
-    # data being sent to API
     if full:
-        request_data = {'method': 'attendee.lookup',
-                        'params': [badge_num, True]}
+        response = uber.call('attendee.lookup', [badge_num, True])
     else:
-        request_data = {'method': 'attendee.lookup',
-                        'params': [badge_num]}
-        
-    request = requests.post(url=cfg.api_endpoint, json=request_data, headers=REQUEST_HEADERS)
-    response = json.loads(request.text)
-    # todo: remove testing stuff here
+        response = uber.call('attendee.lookup', [badge_num])
+    attendee_cache.put(badge_num, full, response)
+
+    return response
+
+
+def prefetch_attendees(badge_nums, full=True, cached=True):
+    """
+    Looks up a whole list of attendees at once, running the lookups in parallel on a small thread pool.
+    Results also land in attendee_cache, so later lookups for these badges during the page load are free.
+    :param badge_nums: badge numbers to look up, duplicates and blanks are skipped
+    :param full: passed through to lookup_attendee
+    :param cached: passed through to lookup_attendee
+    :return: dict of badge number to lookup response
     """
-    date = response['result']['shifts'][0]['job']['start_time'] #date string
-    date = parse_utc(date) #convert to datetime object
+    badges = list()
+    for badge in badge_nums:
+        if badge is not None and badge not in badges:
+            badges.append(badge)
     
-    local_dt = con_tz(date)
-    fmt = '%Y-%m-%d %H:%M:%S %Z%z'
-    print(date.strftime(fmt))
-    print(date.tzinfo)
-    print(local_dt.strftime(fmt))
+    if not badges:
+        return dict()
+    
+    workers = max(1, min(cfg.prefetch_workers, len(badges)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        responses = pool.map(lambda badge: lookup_attendee(badge, full=full, cached=cached), badges)
+        return dict(zip(badges, responses))
+
+
+def ingredient_ids(id_string):
+    """
+    Splits a comma separated list of ingredient IDs, as stored on meals and orders, into ints
+    :param id_string: eg '3,12,7', may be blank or None
+    :return: list of ints, anything that isn't a number is skipped
     """
-    # end of testing stuff
+    if not id_string:
+        return []
+    return [int(item) for item in id_string.split(',') if item.strip().isdigit()]
 
-    return response
+
+class IngredientCatalog:
+    """
+    In memory copy of ingredient labels and descriptions, keyed by id.
+    Ingredients only change when a meal is saved, so order screens and labels can turn the ID lists on every order
+    into names without asking the database each time.  meal_edit invalidates a meal's ingredients once it saves.
+    """
+    
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._ingredients = dict()
+        self._lock = threading.Lock()
+    
+    def get(self, session, ids):
+        """
+        Looks up ingredients, loading any that aren't cached yet in one query
+        :param session: SQLAlchemy session, only used if something isn't cached
+        :param ids: list of ingredient IDs as ints
+        :return: dict of id to (id, label, description), IDs not in the database are left out
+        """
+        ids = set(ids)
+        with self._lock:
+            found = dict((ing_id, self._ingredients[ing_id]) for ing_id in ids if ing_id in self._ingredients)
+            self.hits += len(found)
+            missing = ids - set(found)
+            self.misses += len(missing)
+        
+        if missing:
+            rows = session.query(Ingredient.id, Ingredient.label, Ingredient.description)\
+                .filter(Ingredient.id.in_(list(missing))).all()
+            with self._lock:
+                for ing_id, label, description in rows:
+                    self._ingredients[ing_id] = (ing_id, label, description)
+                    found[ing_id] = self._ingredients[ing_id]
+        return found
+    
+    def load_meal(self, session, meal):
+        """
+        Makes sure every ingredient offered on a meal is cached, with at most one query.
+        Call before working through a list of orders for the meal.
+        """
+        ids = list()
+        for field in (meal.toppings, meal.toggle1, meal.toggle2, meal.toggle3):
+            ids.extend(ingredient_ids(field))
+        self.get(session, ids)
+    
+    def invalidate(self, ids):
+        with self._lock:
+            for ing_id in ids:
+                self._ingredients.pop(int(ing_id), None)
+    
+    def clear(self):
+        with self._lock:
+            self._ingredients.clear()
+    
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self._ingredients)}
+
+
+ingredient_catalog = IngredientCatalog()
 
 
 def order_split(session, choices, orders=""):
@@ -303,26 +471,16 @@ def order_split(session, choices, orders=""):
     :param choices: list of ingredient IDs that are available
     :return: list of tuple(checked, label, description)
     """
-    try:
-        choices_list = sorted(choices.split(','))
-    except ValueError:
-        # this happens if no toppings in list
-        return []
-    
-    choices_list = session.query(Ingredient).filter(Ingredient.id.in_(choices_list)).all()
+    choices_list = ingredient_catalog.get(session, ingredient_ids(choices))
+    selected = set(ingredient_ids(orders))
     tuple_list = []
     
-    if orders:
-        orders_id = sorted(orders.split(','))
-        orders_list = session.query(Ingredient).filter(Ingredient.id.in_(orders_id)).all()
-    else:
-        orders_list = []
-    
-    for choice in choices_list:
-        if choice in orders_list:
-            mytuple = (1, choice.label, choice.description, choice.id)
+    for ing_id in sorted(choices_list):
+        ing_id, label, description = choices_list[ing_id]
+        if ing_id in selected:
+            mytuple = (1, label, description, ing_id)
         else:
-            mytuple = ('', choice.label, choice.description, choice.id)
+            mytuple = ('', label, description, ing_id)
             
         tuple_list.append(mytuple)
     
@@ -399,68 +557,128 @@ def order_selections(field, params, is_toggle=False):
     return result
 
 
-def meal_join(session, params, field):
+SELECTION_GROUPS = ('toggle1', 'toggle2', 'toggle3', 'toppings')
+
+
+def selection_mappings(order_id, order):
     """
-    Goes through parameters and finds ingredients based upon which form field it is asked to look for.
-    Adds new ingredients if not in DB, loads then updates ingredients if they are already existing in DB
+    Turns the comma separated ingredient ID fields of an order into OrderSelection rows
+    :param order_id: id of the order the rows belong to
+    :param order: Order, or anything with toggle1, toggle2, toggle3 and toppings
+    :return: list of dicts with order_id, ingredient_id and group
+    """
+    mappings = list()
+    for group in SELECTION_GROUPS:
+        for ingredient_id in ingredient_ids(getattr(order, group)):
+            mappings.append({'order_id': order_id, 'ingredient_id': ingredient_id, 'group': group})
+    return mappings
+
+
+def set_order_selections(order):
+    """
+    Replaces the OrderSelection rows of an order to match its ID fields.  Call after setting toggles and toppings,
+    the rows get saved and the old ones removed along with the order.
+    """
+    order.selections = [OrderSelection(ingredient_id=mapping['ingredient_id'], group=mapping['group'])
+                        for mapping in selection_mappings(None, order)]
+
+
+def prep_report(session, meal):
+    """
+    Kitchen prep numbers for a meal, counted by the database from OrderSelection rows.
+    For each toggle choice how many orders picked it, and for each topping how many orders left it off.
+    Covers every order placed for the meal, whether or not it ends up eligible.
     :param session: SQLAlchemy session
-    :param params: web form parameters submitted
-    :param field: string name of form field to look for
-    :return: result is a string containing a comma separated list of ingredient IDs
+    :param meal: Meal
+    :return: dict with 'total' for the whole meal and 'departments', a list sorted by department name.
+             Each has 'name', 'orders', 'toggles' (list of (title, [(label, count)])) and 'excluded' ([(label, count)])
     """
-    result = []
-    count = 1
-    fieldid = ''
+    Order = models.order.Order
+    order_counts = dict(session.query(Order.department_id, func.count(Order.id))
+                        .filter(Order.meal_id == meal.id).group_by(Order.department_id).all())
+    
+    selected = dict()
+    rows = session.query(Order.department_id, OrderSelection.group, OrderSelection.ingredient_id,
+                         func.count(OrderSelection.id))\
+        .join(Order, Order.id == OrderSelection.order_id)\
+        .filter(Order.meal_id == meal.id)\
+        .group_by(Order.department_id, OrderSelection.group, OrderSelection.ingredient_id).all()
+    for dept_id, group, ingredient_id, count in rows:
+        selected[(dept_id, group, ingredient_id)] = count
+        selected[(None, group, ingredient_id)] = selected.get((None, group, ingredient_id), 0) + count
+    
+    names = dict(session.query(Department.id, Department.name)
+                 .filter(Department.id.in_(list(order_counts.keys()))).all())
+    ingredient_catalog.load_meal(session, meal)
+    
+    def ingredient_counts(dept_id, group):
+        choices = ingredient_catalog.get(session, ingredient_ids(getattr(meal, group)))
+        return [(choices[ing_id][1], selected.get((dept_id, group, ing_id), 0)) for ing_id in sorted(choices)]
+    
+    def section(dept_id, name, orders):
+        toggles = list()
+        for group in ('toggle1', 'toggle2', 'toggle3'):
+            if getattr(meal, group):
+                toggles.append((getattr(meal, group + '_title'), ingredient_counts(dept_id, group)))
+        excluded = [(label, orders - count) for label, count in ingredient_counts(dept_id, 'toppings')]
+        return {'name': name, 'orders': orders, 'toggles': toggles, 'excluded': excluded}
+    
+    departments = [section(dept_id, names.get(dept_id, 'No department'), orders)
+                   for dept_id, orders in order_counts.items()]
+    departments.sort(key=lambda item: item['name'])
+    return {'total': section(None, 'Whole meal', sum(order_counts.values())),
+            'departments': departments}
 
-    for param in params:
-        labelkey = field + str(count)
-        new_ing = False
-        # checks for relevant parameters and does stuff if found
-        try:
-            label = params[labelkey]
-            if not label == '':
-                try:
-                    idkey = field + 'id' + str(count)
-                    fieldid = params[idkey]
-                except KeyError:
-                    # marks this as a new ingredient if ID field is missing for this field number
-                    new_ing = True
-                    
-                # if the field is there sets contents, otherwise blank
-                try:
-                    desc = field + 'desc' + str(count)
-                    desc = params[desc]
-                except KeyError:
-                    desc = ''
-    
-                if new_ing or fieldid == '':
-                    ing = Ingredient()
-                    ing.label = label
-                    ing.description = desc
-                    session.add(ing)
-                    session.commit()
-                    # saves ing to DB so it gets an id, then puts result where it can be returned
-                    fieldid = ing.id
-                else:
-                    # if not a new ingredient, but the label and description are both blank
-                    # then it is one that was deleted from the meal.  do not load from DB, do not add to result.
-                    if label == '' and desc == '':
-                        count += 1
-                        break
-                        
-                    ing = session.query(Ingredient).filter_by(id=fieldid).one()
-                    # reduce unnecessary calls to DB
-                    if not (ing.label == label and ing.description == desc):
-                        ing.label = label
-                        ing.description = desc
-                        session.commit()
-                
-                result.append(str(fieldid))
-            count += 1
-        except KeyError:
-            count += 1
 
-    result = ','.join(result)
+def meal_join(session, params, fields):
+    """
+    Goes through parameters and finds ingredients for each form field it is asked to look for.
+    Adds new ingredients if not in DB, updates ingredients if they are already existing in DB.
+    All the existing ingredients are loaded in one query and the new ones get their IDs from a single flush,
+    nothing is committed here so the whole meal saves in one transaction.  Caller commits.
+    :param session: SQLAlchemy session
+    :param params: web form parameters submitted
+    :param fields: list of form field names to look for, eg ['toppings', 'toggle1']
+    :return: dict of field name to a string containing a comma separated list of ingredient IDs
+    """
+    # form boxes are named field + number, with field + 'id' + number and field + 'desc' + number alongside
+    entries = dict()
+    for field in fields:
+        boxes = list()
+        for key, label in params.items():
+            number = key[len(field):]
+            if key.startswith(field) and number.isdigit() and not label == '':
+                boxes.append((int(number), label, params.get(field + 'desc' + number, ''),
+                              str(params.get(field + 'id' + number, ''))))
+        entries[field] = sorted(boxes)
+    
+    existing_ids = [int(ing_id) for boxes in entries.values() for number, label, desc, ing_id in boxes
+                    if ing_id.isdigit()]
+    existing = dict()
+    if existing_ids:
+        for ing in session.query(Ingredient).filter(Ingredient.id.in_(existing_ids)):
+            existing[ing.id] = ing
+    
+    ingredients = dict()
+    for field, boxes in entries.items():
+        ingredients[field] = list()
+        for number, label, desc, ing_id in boxes:
+            ing = existing.get(int(ing_id)) if ing_id.isdigit() else None
+            if ing is None:
+                ing = Ingredient()
+                session.add(ing)
+            # only changes the row if something is different, so unchanged ingredients aren't written
+            if not (ing.label == label and ing.description == desc):
+                ing.label = label
+                ing.description = desc
+            ingredients[field].append(ing)
+    
+    # one flush gives every new ingredient its ID
+    session.flush()
+    
+    result = dict()
+    for field in fields:
+        result[field] = ','.join(str(ing.id) for ing in ingredients[field])
     return result
 
 
@@ -472,17 +690,10 @@ def meal_split(session, toppings):
     :return:
     """
     
-    try:
-        id_list = sorted(toppings.split(','))
-    except ValueError:
-        #this happens if no toppings in list
-        return []
-    
-    ing_list = session.query(Ingredient).filter(Ingredient.id.in_(id_list)).all()
+    ing_list = ingredient_catalog.get(session, ingredient_ids(toppings))
     tuple_list = []
-    for ing in ing_list:
-        mytuple = (ing.id, ing.label, ing.description)
-        tuple_list.append(mytuple)
+    for ing_id in sorted(ing_list):
+        tuple_list.append(ing_list[ing_id])
         
     return tuple_list
 
@@ -542,7 +753,69 @@ class Shift:
     
     def __lt__(self, other):
         return self.start < other.start
-       
+
+
+class StafferMeal:
+    """
+    One line of a staffer's meal list: the meal's details, times already converted to the con timezone,
+    and whether the staffer has an order for it.  Plain object so the page can be filled in without touching ORM rows
+    """
+    def __init__(self, meal, order_id=None, overridden=False):
+        self.id = meal.id
+        self.meal_name = meal.meal_name
+        self.start_time = con_tz(meal.start_time)
+        self.end_time = con_tz(meal.end_time)
+        self.cutoff = con_tz(meal.cutoff)
+        self.order_exists = order_id is not None
+        self.overridden = bool(overridden)
+        self.eligible = False
+
+
+class Display:
+    """
+    Read only stand-in for a database row on a page.  Values given here are shown instead of the row's own and
+    anything else is read from the row, so pages can show converted times without changing the row, and nothing
+    changed for display can be saved by the request's commit.
+    """
+    def __init__(self, row, **values):
+        self._row = row
+        self.__dict__.update(values)
+    
+    def __getattr__(self, name):
+        return getattr(self._row, name)
+
+
+def meal_display(meal):
+    """meal with its start, end and cutoff times in the con timezone"""
+    return Display(meal,
+                   start_time=con_tz(meal.start_time),
+                   end_time=con_tz(meal.end_time),
+                   cutoff=con_tz(meal.cutoff))
+
+
+def dept_order_display(dept_order):
+    """dept order with its start and completed times as con timezone text, if it has them"""
+    values = dict()
+    if dept_order.started:
+        values['start_time'] = con_tz(dept_order.start_time).strftime(cfg.date_format)
+    if dept_order.completed:
+        values['completed_time'] = con_tz(dept_order.completed_time).strftime(cfg.date_format)
+    return Display(dept_order, **values)
+
+
+def staffer_meals(session, attendee_id):
+    """
+    Loads every meal together with the given attendee's order for it, if any, in one query
+    :param session: SQLAlchemy session
+    :param attendee_id: attendee's public_id
+    :return: list of (Meal, order id or None, order overridden or None) tuples
+    """
+    Meal = models.meal.Meal
+    Order = models.order.Order
+    return session.query(Meal, Order.id, Order.overridden)\
+        .outerjoin(Order, and_(Order.meal_id == Meal.id, Order.attendee_id == attendee_id))\
+        .order_by(Meal.id).all()
+
 
 def ss_eligible(badge_num):
     """
@@ -587,16 +860,18 @@ def ss_eligible(badge_num):
     return False
 
 
-def combine_shifts(badge_num, full=False, no_combine=False):
+def combine_shifts(badge_num, full=False, no_combine=False, response=None):
     """
     Takes badge number and performs lookup against Uber API
     Gets list of shifts, sorts it, then combines any that are close together based on settings for allowable gaps
     :param badge_num: Staffer's badge number
     :param full: whether or not to also return entire response
+    :param response: full lookup response already fetched for this badge, eg by prefetch_attendees
     :return: returns sorted and merged list of shifts
     """
     
-    response = lookup_attendee(badge_num, full=True)
+    if response is None:
+        response = lookup_attendee(badge_num, full=True)
     shift_list = []
     # print('-------------------------------')
     # print(response)
@@ -654,68 +929,246 @@ def combine_shifts(badge_num, full=False, no_combine=False):
         return combined
 
 
+UNIX_EPOCH = datetime(1970, 1, 1)
+DAY_SECONDS = 86400
+
+
+def epoch_seconds(date):
+    """converts a UTC datetime object, with or without tzinfo, to whole seconds since 1970"""
+    return int((naive_utc(date) - UNIX_EPOCH).total_seconds())
+
+
+def _gap_minutes(seconds):
+    """
+    What relativedelta's minutes + hours * 60 works out to for a gap of this many seconds:
+    whole minutes left over after taking out whole days, keeping the sign of the gap
+    """
+    if seconds < 0:
+        return -((-seconds % DAY_SECONDS) // 60)
+    return (seconds % DAY_SECONDS) // 60
+
+
+def shift_meal_match(shift_start, shift_end, meal_start, meal_end):
+    """
+    Integer version of the per shift check in carryout_eligible, all times in epoch seconds.
+    Gives the same answer as the relativedelta comparisons, including their quirks for gaps over a day.
+    The only difference is gaps of a calendar month or more, which relativedelta counts in months;
+    those can't happen inside one event and just don't match here.
+    """
+    start_gap = meal_start - shift_start
+    # the relativedelta version requires ss_ms.days == 0 for every rule
+    if not -DAY_SECONDS < start_gap < DAY_SECONDS:
+        return False
+    
+    ss_ms = _gap_minutes(start_gap)
+    ss_me = _gap_minutes(meal_end - shift_start)
+    if ss_ms <= 0 and ss_me >= 0:
+        # shift starts during meal
+        return True
+    
+    se_ms = _gap_minutes(meal_start - shift_end)
+    se_me = _gap_minutes(meal_end - shift_end)
+    if se_ms <= 0 and se_me >= 0:
+        # shift ends during meal
+        return True
+    if ss_ms >= 0 and se_me <= 0:
+        # shift covers the whole meal
+        return True
+    return False
+
+
+class MealIndex:
+    """
+    Answers "which of these meals do this attendee's shifts overlap" for a whole list of meals at once.
+    Meal times are converted to epoch seconds once and kept sorted by start time, so each shift is only
+    checked against the meals starting within a day of it instead of against every meal.
+    Same rules as carryout_eligible.  Meal times must be UTC, like they are stored in the DB.
+    """
+    
+    def __init__(self, meals):
+        """
+        :param meals: list of Meal objects, or anything with id, start_time and end_time
+        """
+        entries = sorted((epoch_seconds(meal.start_time), epoch_seconds(meal.end_time), meal.id) for meal in meals)
+        self.starts = [entry[0] for entry in entries]
+        self.ends = [entry[1] for entry in entries]
+        self.ids = [entry[2] for entry in entries]
+    
+    def eligible_meals(self, shifts):
+        """
+        :param shifts: list of Shift objects, same as carryout_eligible takes
+        :return: set of IDs of the meals the shifts make the attendee eligible for
+        """
+        result = set()
+        for shift in shifts:
+            shift_start = epoch_seconds(shift.start)
+            shift_end = epoch_seconds(shift.end)
+            # only meals starting less than a day before or after the shift can match
+            first = bisect_right(self.starts, shift_start - DAY_SECONDS)
+            last = bisect_left(self.starts, shift_start + DAY_SECONDS)
+            for i in range(first, last):
+                if self.ids[i] not in result and \
+                        shift_meal_match(shift_start, shift_end, self.starts[i], self.ends[i]):
+                    result.add(self.ids[i])
+        return result
+
+
+def _gap_minutes_array(seconds):
+    """NumPy version of _gap_minutes, for a whole array of gaps at once"""
+    return np.sign(seconds) * ((np.abs(seconds) % DAY_SECONDS) // 60)
+
+
+def eligibility_matrix(attendee_shifts, meals, chunk_size=20000):
+    """
+    Works out carryout eligibility for every attendee against every meal at once with NumPy.
+    Same rules as carryout_eligible, see shift_meal_match, just done on arrays of every shift against every meal.
+    :param attendee_shifts: list with one list of Shift objects per attendee
+    :param meals: list of Meal objects, or anything with start_time and end_time
+    :param chunk_size: how many shifts to compare at once, keeps memory use bounded for big events
+    :return: numpy boolean array with one row per attendee and one column per meal, in the order given
+    """
+    counts = np.array([len(shifts) for shifts in attendee_shifts], dtype=np.int64)
+    matrix = np.zeros((len(attendee_shifts), len(meals)), dtype=bool)
+    total = int(counts.sum())
+    if total == 0 or len(meals) == 0:
+        return matrix
+    
+    shift_start = np.fromiter((epoch_seconds(shift.start) for shifts in attendee_shifts for shift in shifts),
+                              dtype=np.int64, count=total)
+    shift_end = np.fromiter((epoch_seconds(shift.end) for shifts in attendee_shifts for shift in shifts),
+                            dtype=np.int64, count=total)
+    meal_start = np.array([epoch_seconds(meal.start_time) for meal in meals], dtype=np.int64)
+    meal_end = np.array([epoch_seconds(meal.end_time) for meal in meals], dtype=np.int64)
+    
+    # one row per shift, one column per meal
+    match = np.empty((total, len(meals)), dtype=bool)
+    for first in range(0, total, chunk_size):
+        last = min(first + chunk_size, total)
+        ss = shift_start[first:last, None]
+        se = shift_end[first:last, None]
+        start_gap = meal_start - ss
+        ss_ms = _gap_minutes_array(start_gap)
+        ss_me = _gap_minutes_array(meal_end - ss)
+        se_ms = _gap_minutes_array(meal_start - se)
+        se_me = _gap_minutes_array(meal_end - se)
+        match[first:last] = (np.abs(start_gap) < DAY_SECONDS) & (((ss_ms <= 0) & (ss_me >= 0)) |
+                                                                  ((se_ms <= 0) & (se_me >= 0)) |
+                                                                  ((ss_ms >= 0) & (se_me <= 0)))
+    
+    # each attendee is eligible if any of their shift rows are, attendees without shifts stay all False
+    has_shifts = np.flatnonzero(counts)
+    offsets = (np.cumsum(counts) - counts)[has_shifts]
+    matrix[has_shifts] = np.logical_or.reduceat(match, offsets, axis=0)
+    return matrix
+
+
+def meal_eligibility_counts(session, meals):
+    """
+    Counts how many staffers in the local shift mirror are eligible for each meal, for the kitchen to plan with.
+    :param session: SQLAlchemy session
+    :param meals: list of Meal objects, times still in UTC
+    :return: dict of meal id to {'shifts': eligible by shifts alone,
+                                 'total': also counting Department Heads and shiftless departments}
+    """
+    rows = session.query(ShiftSync.attendee_id, ShiftSync.is_dept_head, ShiftSync.assigned_depts,
+                         AttendeeShift.start_time, AttendeeShift.end_time, AttendeeShift.extra15)\
+        .outerjoin(AttendeeShift, AttendeeShift.attendee_id == ShiftSync.attendee_id)\
+        .order_by(ShiftSync.attendee_id).all()
+    
+    attendee_shifts = list()
+    always_eligible = list()
+    last_id = None
+    for attendee_id, is_dept_head, assigned_depts, start_time, end_time, extra15 in rows:
+        if attendee_id != last_id:
+            last_id = attendee_id
+            attendee_shifts.append(list())
+            exempt = any(dept in cfg.exempt_depts for dept in json.loads(assigned_depts or '[]'))
+            always_eligible.append(bool(is_dept_head) or exempt)
+        if start_time is not None:
+            attendee_shifts[-1].append(Shift(start_time, end_time, extra_15=extra15))
+    
+    matrix = eligibility_matrix(attendee_shifts, meals)
+    always_eligible = np.array(always_eligible, dtype=bool)
+    by_shifts = matrix.sum(axis=0)
+    total = (matrix | always_eligible[:, None]).sum(axis=0) if len(always_eligible) else by_shifts
+    
+    counts = dict()
+    for i, meal in enumerate(meals):
+        counts[meal.id] = {'shifts': int(by_shifts[i]), 'total': int(total[i])}
+    return counts
+
+
+def meal_order_board(session, display_all=False):
+    """
+    Every meal with its order counts, in one grouped query.
+    Past meals are left out unless display_all, a meal counts as past once it ended more than
+    schedule_tolerance minutes ago.
+    :param session: SQLAlchemy session
+    :param display_all: include meals in the past
+    :return: list of (Meal, order count, overridden count, locked count) tuples, sorted by start time
+    """
+    Meal = models.meal.Meal
+    Order = models.order.Order
+    query = session.query(Meal, func.count(Order.id),
+                          func.coalesce(func.sum(cast(Order.overridden, Integer)), 0),
+                          func.coalesce(func.sum(cast(Order.locked, Integer)), 0))\
+        .outerjoin(Order, Order.meal_id == Meal.id)
+    if not display_all:
+        query = query.filter(Meal.end_time >= now_utc() - timedelta(minutes=cfg.schedule_tolerance))
+    return query.group_by(Meal.id).order_by(Meal.start_time).all()
+
+
+def eligible_order_counts(session, meals):
+    """
+    Counts orders for each meal whose attendee is eligible, using the same rules as the fulfilment order list.
+    Works from the local shift mirror in one query, so attendees the sync job hasn't reached yet aren't counted.
+    :param session: SQLAlchemy session
+    :param meals: list of Meal objects, times still in UTC
+    :return: dict of meal id to number of eligible orders
+    """
+    Order = models.order.Order
+    meals = dict((meal.id, meal) for meal in meals)
+    counts = dict((meal_id, 0) for meal_id in meals)
+    if not meals:
+        return counts
+    
+    rows = session.query(Order.meal_id, Order.attendee_id, ShiftSync.is_dept_head, ShiftSync.assigned_depts,
+                         AttendeeShift.start_time, AttendeeShift.end_time, AttendeeShift.extra15)\
+        .join(ShiftSync, ShiftSync.attendee_id == Order.attendee_id)\
+        .outerjoin(AttendeeShift, AttendeeShift.attendee_id == Order.attendee_id)\
+        .filter(Order.meal_id.in_(list(meals.keys())))\
+        .order_by(Order.meal_id, Order.attendee_id).all()
+    
+    orders = OrderedDict()
+    for meal_id, attendee_id, is_dept_head, assigned_depts, start_time, end_time, extra15 in rows:
+        key = (meal_id, attendee_id)
+        if key not in orders:
+            exempt = any(dept in cfg.exempt_depts for dept in json.loads(assigned_depts or '[]'))
+            orders[key] = (bool(is_dept_head) or exempt, list())
+        if start_time is not None:
+            orders[key][1].append(Shift(start_time, end_time, extra_15=extra15))
+    
+    for (meal_id, attendee_id), (always_eligible, shifts) in orders.items():
+        meal = meals[meal_id]
+        if always_eligible or carryout_eligible(sorted(shifts), meal.start_time, meal.end_time):
+            counts[meal_id] += 1
+    return counts
+
+
 def carryout_eligible(shifts, meal_start, meal_end):
     """
     Takes a list of shifts and checks if they overlap the given meal period
-    Uses rules for allowable gaps configured in system
+    Works on whole seconds instead of relativedelta objects, use MealIndex instead when checking many meals.
     :param shifts: List of shift objects. Concurrent shifts must already be merged or this will not work correctly!
     :param meal_start : date object for the meal start in python dateutil datetime format
     :param meal_end : date object for the meal end in python dateutil datetime format
     :return: returns True or False
     """
-    # need to check combined if shift starts within <<buffer>> after start of meal time or earlier
-    # AND ends within <<buffer>exc> before end of meal time or later
-    
-    # if there are no shifts, skip processing
-    
-    if len(shifts) == 0:
-        return False
-    """code section for buffer, commented out cause not using buffer for Super 2020
-    meal_buffer = relativedelta(minutes=cfg.schedule_tolerance)
-    # print("Meal start: {} Meal End {}".format(str(meal_start),str(meal_end)))
-    
+    meal_start = epoch_seconds(meal_start)
+    meal_end = epoch_seconds(meal_end)
     for shift in shifts:
-        # print("shift start : {} Shift end: {}".format(str(shift.start),str(shift.end)))
-        sdelta = relativedelta((meal_start + meal_buffer), shift.start)
-        start_delta = sdelta.minutes + (sdelta.hours * 60)
-        
-        edelta = relativedelta(shift.end, (meal_end - meal_buffer))
-        end_delta = edelta.minutes + (edelta.hours * 60)
-        
-        if start_delta >= 0 and end_delta >= 0 and sdelta.days == 0:
-            # start_delta.days being anything other than 0 means the shift is more than 24 hours from the meal
-            return True
-    """
-    # rd positive if first after second
-    # if ss after ms AND before me then good
-    # if se after ms AND before me then good
-    # if ss before ms AND se after me then good
-    # if the shift is more than a day before or after the meal days != 0
-    # print('-----------before loop--------------')
-    
-    for shift in shifts:
-        # print('---------------start loop------------')
-        ss_ms = relativedelta(meal_start, shift.start)
-        ss_ms_delta = ss_ms.minutes + (ss_ms.hours * 60)
-        ss_me = relativedelta(meal_end, shift.start)
-        ss_me_delta = ss_me.minutes + (ss_me.hours * 60)
-        if ss_ms_delta <= 0 and ss_me_delta >= 0 and ss_ms.days == 0:
-            # print('ss after ms AND before me then good')
-            return True
-
-        se_ms = relativedelta(meal_start, shift.end)
-        se_ms_delta = se_ms.minutes + (se_ms.hours * 60)
-        se_me = relativedelta(meal_end, shift.end)
-        se_me_delta = se_me.minutes + (se_me.hours * 60)
-        if se_ms_delta <= 0 and se_me_delta >= 0 and ss_ms.days == 0:
-            # print('se after ms AND before me then good')
-            return True
-        
-        if ss_ms_delta >= 0 and se_me_delta <= 0 and ss_ms.days == 0:
-            # print('if ss before ms AND se after me then good')
+        if shift_meal_match(epoch_seconds(shift.start), epoch_seconds(shift.end), meal_start, meal_end):
             return True
-    # print('none matched')
-    # if none of the shifts match the meal period, return false.
     return False
 
 
@@ -735,12 +1188,7 @@ def is_ss_staffer(staff_id):
 
 def is_dh(staff_id):
     # runs API request
-    REQUEST_HEADERS = {'X-Auth-Token': cfg.uber_authkey}
-    # data being sent to API
-    request_data = {'method': 'attendee.search',
-                    'params': [staff_id]}
-    request = requests.post(url=cfg.api_endpoint, json=request_data, headers=REQUEST_HEADERS)
-    response = json.loads(request.text)
+    response = uber.call('attendee.search', [staff_id])
     return response['result'][0]['is_dept_head']
 
 
@@ -760,6 +1208,193 @@ def allergy_info(badge_num):
     return allergies
 
 
+def naive_utc(date):
+    """converts a datetime object that may or may not have tzinfo to UTC without TZ info, the way the DB stores it"""
+    if date.tzinfo:
+        date = date.astimezone(pytz.utc).replace(tzinfo=None)
+    return date
+
+
+def update_shift_mirror(session, lookups):
+    """
+    Saves full Uber lookups into the local shift mirror (AttendeeShift and ShiftSync tables).
+    An attendee's shift rows are only rewritten if their Uber data changed since the last sync,
+    otherwise just the sync time gets bumped.  Failed lookups also bump the sync time so they wait
+    until they go stale again instead of being retried on every run.  Caller commits.
+    :param session: SQLAlchemy session
+    :param lookups: list of (attendee public_id, full lookup response) tuples
+    """
+    lookups = dict(lookups)
+    if not lookups:
+        return
+    
+    syncs = dict()
+    for sync in session.query(ShiftSync).filter(ShiftSync.attendee_id.in_(list(lookups.keys()))):
+        syncs[sync.attendee_id] = sync
+    
+    now = now_utc()
+    changed = list()
+    new_shifts = list()
+    for attendee_id, response in lookups.items():
+        sync = syncs.get(attendee_id)
+        if sync is None:
+            sync = ShiftSync(attendee_id=attendee_id)
+            session.add(sync)
+        sync.synced = now
+        
+        if 'error' in response:
+            continue
+        
+        result = response['result']
+        shifts = sorted((naive_utc(parse(shift['job']['start_time'])),
+                         naive_utc(parse(shift['job']['end_time'])),
+                         bool(shift['job']['extra15'])) for shift in result['shifts'])
+        details = {'badge_num': result['badge_num'],
+                   'is_dept_head': bool(result['is_dept_head']),
+                   'assigned_depts': json.dumps(result['assigned_depts_labels']),
+                   'badge_type': result['badge_type_label'],
+                   'worked_hours': result['worked_hours'],
+                   'weighted_hours': result['weighted_hours'],
+                   'food_restrictions': json.dumps(result['food_restrictions']) if result['food_restrictions'] else ''}
+        checksum = hashlib.sha1(json.dumps([shifts, details], sort_keys=True, default=str).encode()).hexdigest()
+        
+        if sync.checksum == checksum:
+            continue
+        
+        sync.checksum = checksum
+        for field, value in details.items():
+            setattr(sync, field, value)
+        changed.append(attendee_id)
+        for start, end, extra15 in shifts:
+            new_shifts.append(AttendeeShift(attendee_id=attendee_id, start_time=start, end_time=end, extra15=extra15))
+    
+    if changed:
+        session.query(AttendeeShift).filter(AttendeeShift.attendee_id.in_(changed)).delete(synchronize_session=False)
+        session.add_all(new_shifts)
+
+
+def flag_shift_sync(session, attendee_id):
+    """
+    Marks an attendee's mirrored shifts to be pulled again on the next sync run.  Caller commits.
+    """
+    session.query(ShiftSync).filter_by(attendee_id=attendee_id).update({ShiftSync.synced: None},
+                                                                       synchronize_session=False)
+
+
+def sync_stale_shifts():
+    """
+    Background job that keeps the local shift mirror fresh.
+    Only re-pulls attendees that were never synced, were flagged for a resync, or whose data is older
+    than shift_sync_stale minutes, at most shift_sync_batch attendees per run, oldest first.
+    """
+    session = models.new_sesh()
+    try:
+        cutoff = now_utc() - timedelta(minutes=cfg.shift_sync_stale)
+        stale = session.query(models.attendee.Attendee.public_id, models.attendee.Attendee.badge_num)\
+            .outerjoin(ShiftSync, ShiftSync.attendee_id == models.attendee.Attendee.public_id)\
+            .filter(models.attendee.Attendee.badge_num != None,
+                    or_(ShiftSync.synced == None, ShiftSync.synced < cutoff))\
+            .order_by(ShiftSync.synced).limit(cfg.shift_sync_batch).all()
+        
+        if stale:
+            responses = prefetch_attendees([badge_num for public_id, badge_num in stale], cached=False)
+            update_shift_mirror(session, [(public_id, responses[badge_num]) for public_id, badge_num in stale])
+            session.commit()
+    except Exception:
+        # don't let one bad run kill the background thread, it will try again next time
+        cherrypy.log('Error syncing shifts from Uber', traceback=True)
+        session.rollback()
+    finally:
+        session.close()
+
+
+def _query_shift_mirror(session, attendee_ids):
+    mirror = dict()
+    if not attendee_ids:
+        return mirror
+    
+    rows = session.query(ShiftSync, AttendeeShift)\
+        .outerjoin(AttendeeShift, AttendeeShift.attendee_id == ShiftSync.attendee_id)\
+        .filter(ShiftSync.attendee_id.in_(list(attendee_ids))).all()
+    for sync, shift in rows:
+        if sync.attendee_id not in mirror:
+            sync.shifts = list()
+            mirror[sync.attendee_id] = sync
+        if shift is not None:
+            sync.shifts.append(Shift(shift.start_time, shift.end_time, extra_15=shift.extra15))
+    
+    for sync in mirror.values():
+        sync.shifts.sort()
+    return mirror
+
+
+def load_shift_mirror(session, attendees):
+    """
+    Loads the mirrored Uber data for a list of attendees in one indexed query.
+    Anyone who has never been synced is looked up live (in parallel) and saved to the mirror first,
+    so once the sync job has caught up this does no network I/O at all.
+    :param session: SQLAlchemy session to load with
+    :param attendees: list of Attendee objects
+    :return: dict of attendee public_id to ShiftSync, with .shifts set to a sorted list of Shift objects
+    """
+    attendees = dict((attendee.public_id, attendee) for attendee in attendees)
+    mirror = _query_shift_mirror(session, attendees.keys())
+    
+    missing = [attendee for public_id, attendee in attendees.items() if public_id not in mirror]
+    if missing:
+        responses = prefetch_attendees([attendee.badge_num for attendee in missing])
+        no_badge = {'error': {'message': 'No badge number'}}
+        # separate session so committing doesn't expire the caller's objects
+        sync_session = models.new_sesh()
+        update_shift_mirror(sync_session, [(attendee.public_id, responses.get(attendee.badge_num, no_badge))
+                                           for attendee in missing])
+        sync_session.commit()
+        sync_session.close()
+        mirror.update(_query_shift_mirror(session, [attendee.public_id for attendee in missing]))
+    
+    return mirror
+
+
+def mirror_exempt(sync):
+    """
+    Whether a mirrored attendee is in a shiftless department, which makes them exempt from eligibility requirements
+    """
+    for dept in json.loads(sync.assigned_depts or '[]'):
+        if dept in cfg.exempt_depts:
+            return True
+    return False
+
+
+def mirror_ss_eligible(sync):
+    """
+    Mirrored equivalent of ss_eligible, whether an attendee can use Staff Suite at all
+    """
+    if sync.worked_hours >= cfg.ss_hours:
+        return True
+    if sync.badge_type == "Attendee" and sync.weighted_hours >= cfg.ss_hours and sync.worked_hours > 0:
+        return True
+    if sync.badge_type in ["Guest", "Contractor"]:
+        return True
+    if mirror_exempt(sync):
+        return True
+    if sync.is_dept_head:
+        return True
+    if sync.badge_type == "Staff" and sync.weighted_hours >= cfg.ss_hours:
+        return True
+    return False
+
+
+def mirror_allergies(sync):
+    """
+    Mirrored equivalent of allergy_info, except it returns '' if the attendee has no food restrictions in Uber
+    """
+    if not sync.food_restrictions:
+        return ''
+    restrictions = json.loads(sync.food_restrictions)
+    return {'standard_labels': restrictions['standard_labels'],
+            'freeform': restrictions['freeform']}
+
+
 def create_dept_order(dept_id, meal_id, session):
     dept = session.query(Department).filter_by(id=dept_id).one()
     dept_order = models.dept_order.DeptOrder()
@@ -777,14 +1412,121 @@ def create_dept_order(dept_id, meal_id, session):
     return dept_order
 
 
-def send_webhook(url, data):
+def create_missing_dept_orders(session, meal_id):
+    """
+    Creates DeptOrders for every department that doesn't have one yet for this meal, in one bulk insert.
+    Contact info is copied from each department's defaults, same as create_dept_order.
+    :param session: SQLAlchemy session
+    :param meal_id: meal the DeptOrders are for
+    :return: number of DeptOrders created
+    """
+    DeptOrder = models.dept_order.DeptOrder
+    existing = session.query(DeptOrder.dept_id).filter(DeptOrder.meal_id == meal_id)
+    missing = session.query(Department).filter(~Department.id.in_(existing)).all()
+    if not missing:
+        return 0
+    
+    session.bulk_insert_mappings(DeptOrder, [{'dept_id': dept.id,
+                                              'meal_id': meal_id,
+                                              'slack_contact': dept.slack_contact,
+                                              'slack_channel': dept.slack_channel,
+                                              'other_contact': dept.other_contact,
+                                              'text_contact': dept.text_contact,
+                                              'email_contact': dept.email_contact} for dept in missing])
+    try:
+        session.commit()
+    except sqlalchemy.exc.IntegrityError:
+        # someone else loaded the page at the same moment and created them first
+        session.rollback()
+        return 0
+    return len(missing)
+
+
+def bundle_orders(session, meal, dept_id):
+    """
+    Builds a department's bundle the way the fulfilment screen shows it and the labels print it.
+    Orders that are not eligible and not overridden are left out, the others get their ingredient IDs swapped for
+    names and their allergies filled in.  The orders themselves aren't changed, the names go on Display copies.
+    :param session: SQLAlchemy session
+    :param meal: Meal the bundle is for
+    :param dept_id: department ID of the bundle
+    :return: list of Display copies of Orders, in badge number order
+    """
+    Order = models.order.Order
+    orders = session.query(Order).filter_by(department_id=dept_id, meal_id=meal.id)\
+        .options(joinedload(Order.attendee)).all()
+    
+    # shifts come from the local mirror, one query for the whole list
+    mirror = load_shift_mirror(session, [order.attendee for order in orders])
+    # every order below is for this meal, one query gets all the ingredient names they can use
+    ingredient_catalog.load_meal(session, meal)
+    
+    order_list = list()
+    for order in orders:
+        attendee_mirror = mirror[order.attendee_id]
+        # checks for DH or exempt dept first, then if neither checks shifts
+        eligible = attendee_mirror.is_dept_head or mirror_exempt(attendee_mirror) or \
+            carryout_eligible(attendee_mirror.shifts, meal.start_time, meal.end_time)
+        # if not eligible and not overridden, remove from list for display/printing
+        if not (eligible or order.overridden):
+            continue
+        
+        order_list.append(Display(order,
+                                  eligible=eligible,
+                                  toggle1=return_selected_only(session, choices=meal.toggle1, orders=order.toggle1),
+                                  toggle2=return_selected_only(session, choices=meal.toggle2, orders=order.toggle2),
+                                  toggle3=return_selected_only(session, choices=meal.toggle3, orders=order.toggle3),
+                                  toppings=return_not_selected(session, choices=meal.toppings, orders=order.toppings),
+                                  allergies=mirror_allergies(attendee_mirror)))
+    
+    # badge order, so printed labels can be matched up with the list on screen
+    order_list.sort(key=lambda order: order.attendee.badge_num or 0)
+    return order_list
+
+
+def lock_orders(session, meal_id, dept_ids=None, locked=True):
+    """
+    Locks or unlocks orders for a meal in one UPDATE statement.  Caller commits.
+    :param session: SQLAlchemy session
+    :param meal_id: meal the orders are for
+    :param dept_ids: list of department IDs, or a query that selects them, None for every department
+    :param locked: True to lock, False to unlock
+    :return: number of orders changed
+    """
+    Order = models.order.Order
+    query = session.query(Order).filter(Order.meal_id == meal_id)
+    if dept_ids is not None:
+        query = query.filter(Order.department_id.in_(dept_ids))
+    return query.update({Order.locked: locked}, synchronize_session=False)
+
+
+def dept_order_board(session, meal_id):
+    """
+    Order count and bundle status for every department for one meal, in one grouped query
+    :param session: SQLAlchemy session
+    :param meal_id: meal to count orders for
+    :return: list of (dept id, dept name, bundle completed, order count) tuples, sorted by department name
+    """
+    DeptOrder = models.dept_order.DeptOrder
+    Order = models.order.Order
+    return session.query(Department.id, Department.name, DeptOrder.completed, func.count(Order.id))\
+        .outerjoin(DeptOrder, and_(DeptOrder.dept_id == Department.id, DeptOrder.meal_id == meal_id))\
+        .outerjoin(Order, and_(Order.department_id == Department.id, Order.meal_id == meal_id))\
+        .group_by(Department.id, Department.name, DeptOrder.completed)\
+        .order_by(Department.name).all()
+
+
+def send_webhook(url, data, timeout=None):
     """
     Sends webhook request
     :param url:
     :param data: JSON format data
-    :return:
+    :param timeout: seconds to wait for the webhook's server
+    :return: response text
+    :raises requests.RequestException: if the request fails or gets an error status back
     """
-    request = requests.post(url=url, json=json.loads(data))
+    request = requests.post(url=url, json=json.loads(data), timeout=timeout)
+    request.raise_for_status()
     
     return request.text
 
@@ -814,6 +1556,7 @@ def dummy_data(count, startorder):
         
         dept = random.choice(depts)
         order.department_id = dept.id
+        set_order_selections(order)
         
         session.add(order)
         i += 1
@@ -1,16 +1,314 @@
-import requests
+"""
+Posts messages to Slack.
+Connections to Slack are kept open and reused, and each channel gets at most slack_rate messages a second
+(with short bursts of up to slack_burst), which is what Slack allows for chat.postMessage.  When Slack says to slow
+down anyway (HTTP 429) the channel waits as long as its Retry-After asks before anything else is sent to it.
+Every send is recorded so the notification page can show how delivery to each channel is going.
+
+slack_api_url can point at a local stub instead of Slack, for testing:
+    python slack_bot.py stub 8089
+and set slack_api_url to http://127.0.0.1:8089/api/
+"""
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import math
+from sys import argv
+import threading
+import time
+from urllib.parse import parse_qs
 
+import requests
+from requests.adapters import HTTPAdapter
 
 from config import cfg
 
+# seconds to hold off a channel when Slack says to slow down without a Retry-After we can read
+DEFAULT_RETRY_AFTER = 30.0
 
-def send_message(channel, message):
-    channel_list = channel.split(',')
-    for chan in channel_list:
-        chan.strip()
-        data = {'token': cfg.slack_authkey,
+
+def retry_after_seconds(value, default=DEFAULT_RETRY_AFTER):
+    """
+    Reads a Retry-After header, which is either a number of seconds or an HTTP date
+    :param value: the header, None if there wasn't one
+    :return: seconds to wait, never negative, default if the header is missing or can't be read
+    """
+    if value is None:
+        return default
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError, IndexError):
+            return default
+        # older Pythons return None instead of raising
+        if when is None:
+            return default
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        seconds = (when - datetime.now(timezone.utc)).total_seconds()
+    if not math.isfinite(seconds):
+        return default
+    return max(seconds, 0.0)
+
+
+class SlackError(Exception):
+    """
+    Slack answered but didn't post the message
+    """
+    pass
+
+
+class SlackRateLimited(Exception):
+    """
+    The channel can't take another message yet
+    """
+
+    def __init__(self, channel, retry_after):
+        super().__init__('Rate limited on {} for {:.1f} seconds'.format(channel, retry_after))
+        self.channel = channel
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Allows rate sends a second on average, and up to burst at once after a quiet spell
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self, max_wait):
+        """
+        Takes a token if one is free now or will be within max_wait seconds.  Caller holds the lock.
+        :return: seconds to wait before sending, the token is only taken if this is no more than max_wait
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = max(0.0, (1 - self.tokens) / self.rate)
+        if wait <= max_wait:
+            # may go below zero, so senders waiting on the same channel line up behind each other
+            self.tokens -= 1
+        return wait
+
+
+class SlackSender:
+    """
+    Sends chat.postMessage requests over a shared pool of connections, within each channel's rate limit
+    """
+
+    def __init__(self, api_url, token, rate=1.0, burst=3, max_wait=5.0, pool_size=4, timeout=10.0):
+        """
+        :param api_url: Slack Web API base URL, ending in /
+        :param rate: messages a second allowed per channel
+        :param burst: messages that can go to a channel at once after it has been quiet
+        :param max_wait: longest a send waits for its channel, longer than that raises SlackRateLimited
+        """
+        self.api_url = api_url
+        self.token = token
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._buckets = dict()
+        # monotonic time each channel's Retry-After runs out
+        self._blocked = dict()
+        self._channels = dict()
+        self.recent = deque(maxlen=100)
+        self._lock = threading.Lock()
+
+    def _wait_for_channel(self, channel):
+        with self._lock:
+            blocked = self._blocked.get(channel, 0) - time.monotonic()
+            if blocked > self.max_wait:
+                self._record(channel, 'rate_limited', '')
+                raise SlackRateLimited(channel, blocked)
+            bucket = self._buckets.get(channel)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+                self._buckets[channel] = bucket
+            wait = bucket.take(self.max_wait - max(blocked, 0))
+            if wait > self.max_wait - max(blocked, 0):
+                self._record(channel, 'rate_limited', '')
+                raise SlackRateLimited(channel, wait)
+        wait = max(wait, blocked)
+        if wait > 0:
+            time.sleep(wait)
+
+    def post_message(self, channel, message, timeout=None):
+        """
+        Posts a message to one channel, waiting for the channel's rate limit if it's only a short wait
+        :param timeout: seconds to wait for Slack, defaults to the sender's timeout
+        :return: Slack's response
+        :raises SlackRateLimited: if the channel can't take a message for longer than max_wait, or Slack said to
+        slow down, with how long to wait before trying again
+        :raises requests.RequestException: if Slack can't be reached or returns an error status
+        :raises SlackError: if Slack refuses the message, with Slack's error code
+        """
+        channel = channel.strip()
+        self._wait_for_channel(channel)
+
+        data = {'token': self.token,
                 'link_names': 'true',
-                'channel': chan,
+                'channel': channel,
                 'text': message}
-        headers = {'Content-type': 'application/json'}
-        response = requests.post('https://slack.com/api/chat.postMessage', data, headers)
+        try:
+            response = self.session.post(self.api_url + 'chat.postMessage', data=data,
+                                         timeout=timeout or self.timeout)
+            if response.status_code == 429:
+                retry_after = retry_after_seconds(response.headers.get('Retry-After'))
+                with self._lock:
+                    self._blocked[channel] = time.monotonic() + retry_after
+                raise SlackRateLimited(channel, retry_after)
+            response.raise_for_status()
+            result = response.json()
+            if not result.get('ok'):
+                raise SlackError(result.get('error', 'unknown error'))
+        except SlackRateLimited:
+            with self._lock:
+                self._record(channel, 'rate_limited', 'HTTP 429')
+            raise
+        except (requests.RequestException, SlackError, ValueError) as e:
+            with self._lock:
+                self._record(channel, 'failed', '{}: {}'.format(type(e).__name__, e))
+            raise
+
+        with self._lock:
+            self._record(channel, 'sent', '')
+        return result
+
+    def _record(self, channel, outcome, error):
+        """
+        Caller holds the lock
+        """
+        stats = self._channels.get(channel)
+        if stats is None:
+            stats = {'sent': 0, 'failed': 0, 'rate_limited': 0, 'last_error': '', 'last_sent': None}
+            self._channels[channel] = stats
+        stats[outcome] += 1
+        if outcome == 'sent':
+            stats['last_sent'] = time.time()
+        if error:
+            stats['last_error'] = error
+        self.recent.append({'time': time.time(), 'channel': channel, 'outcome': outcome, 'error': error})
+
+    def stats(self):
+        with self._lock:
+            return dict((channel, dict(stats)) for channel, stats in sorted(self._channels.items()))
+
+
+def post_message(channel, message, timeout=None):
+    return slack.post_message(channel, message, timeout)
+
+
+def send_message(channel, message):
+    """
+    Posts a message to each channel in a comma separated list
+    :return: dict of channel to Slack's response, or the exception if that channel failed
+    """
+    results = dict()
+    for chan in channel.split(','):
+        chan = chan.strip()
+        if not chan:
+            continue
+        try:
+            results[chan] = post_message(chan, message)
+        except (requests.RequestException, SlackError, SlackRateLimited) as e:
+            print('Slack message to {} failed: {}'.format(chan, e))
+            results[chan] = e
+    return results
+
+
+class SlackStub:
+    """
+    Pretends to be Slack's chat.postMessage for testing: keeps every message posted to it.
+    rate_limit() makes the next few posts get a 429 with a Retry-After, fail() makes them get ok: false.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, echo=False):
+        stub = self
+        self.messages = list()
+        self.echo = echo
+        self._rate_limited = 0
+        self._retry_after = 1
+        self._failures = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                form = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+                fields = dict((key, values[0]) for key, values in form.items())
+                status, headers, body = stub.answer(fields)
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='slack-stub', daemon=True)
+        self._thread.start()
+
+    @property
+    def api_url(self):
+        return 'http://{}:{}/api/'.format(self.host, self.port)
+
+    def rate_limit(self, count=1, retry_after=1):
+        self._rate_limited = count
+        self._retry_after = retry_after
+
+    def fail(self, count=1):
+        self._failures = count
+
+    def answer(self, fields):
+        if self._rate_limited > 0:
+            self._rate_limited -= 1
+            return 429, {'Retry-After': str(self._retry_after)}, {'ok': False, 'error': 'ratelimited'}
+        if self._failures > 0:
+            self._failures -= 1
+            return 200, {}, {'ok': False, 'error': 'channel_not_found'}
+        self.messages.append((fields.get('channel'), fields.get('text')))
+        if self.echo:
+            print('#{}: {}'.format(fields.get('channel'), fields.get('text')))
+        return 200, {}, {'ok': True, 'channel': fields.get('channel'), 'ts': '{:.6f}'.format(time.time())}
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+slack = SlackSender(cfg.slack_api_url, cfg.slack_authkey,
+                    rate=cfg.slack_rate,
+                    burst=cfg.slack_burst,
+                    max_wait=cfg.slack_max_wait,
+                    pool_size=cfg.slack_pool_size)
+
+
+if __name__ == '__main__':
+    if len(argv) > 1 and argv[1] == 'stub':
+        stub = SlackStub(port=int(argv[2]) if len(argv) > 2 else 8089, echo=True)
+        print('Slack stub listening on ' + stub.api_url)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            stub.close()
@@ -0,0 +1,73 @@
+"""
+Sets up what the site's modules need to be imported in a test: the config files in a scratch folder and a stand in
+for Uber that answers config.info.  Call start() before importing config, shared_functions and so on.
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import sys
+import tempfile
+import threading
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+EVENT_INFO = {'EVENT_NAME': 'Test Event',
+              'URL_ROOT': 'http://localhost',
+              'EVENT_TIMEZONE': 'US/Eastern',
+              'EPOCH': '2020-03-06 08:00'}
+
+_started = None
+
+
+class FakeUber(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        if request['method'] == 'config.info':
+            response = {'result': EVENT_INFO}
+        else:
+            response = {'error': {'message': 'Not available in tests: ' + request['method']}}
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start():
+    """
+    Writes config files to a scratch folder, changes to it and starts the fake Uber.  Only does anything the first
+    time it's called.
+    :return: the scratch folder
+    """
+    global _started
+    if _started is not None:
+        return _started
+
+    server = HTTPServer(('127.0.0.1', 0), FakeUber)
+    threading.Thread(target=server.serve_forever, name='fake-uber', daemon=True).start()
+
+    folder = tempfile.mkdtemp(prefix='staffsuite-test-')
+    with open(os.path.join(PROJECT_DIR, 'config_example.json'), 'r') as configfile:
+        cdata = json.load(configfile)
+    cdata['api_endpoint'] = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    cdata['database_location'] = 'sqlite:///' + os.path.join(folder, 'test.db')
+    cdata['local_print'] = 1
+    cdata['remote_print'] = 0
+    cdata['printers'] = {}
+    cdata['cherrypy'] = {'global': {}, '/': {}}
+    with open(os.path.join(folder, 'config.json'), 'w') as configfile:
+        json.dump(cdata, configfile)
+    for filename in ['admin_list.cfg', 'ss_staffer_list.cfg', 'food_managers.cfg', 'exempt_depts.cfg',
+                     'uber_auth.cfg', 'slack_auth.cfg']:
+        with open(os.path.join(folder, filename), 'w') as cfgfile:
+            cfgfile.write('')
+
+    os.chdir(folder)
+    if PROJECT_DIR not in sys.path:
+        sys.path.insert(0, PROJECT_DIR)
+    _started = folder
+    return folder
@@ -0,0 +1,187 @@
+"""
+Checks carryout_eligible and MealIndex give exactly the same answers as the original relativedelta version of
+carryout_eligible, which is kept here as the reference.
+Run from the project folder with either
+    python -m pytest tests
+    python -m unittest discover tests
+"""
+from datetime import datetime, timedelta
+import random
+import unittest
+
+from dateutil.parser import parse
+from dateutil.relativedelta import relativedelta
+import pytz
+
+from tests import app_env
+
+app_env.start()
+
+from shared_functions import Shift, MealIndex, carryout_eligible  # noqa: E402
+
+
+def carryout_eligible_relativedelta(shifts, meal_start, meal_end):
+    """
+    Original relativedelta version of carryout_eligible
+    Takes a list of shifts and checks if they overlap the given meal period
+    :param shifts: List of shift objects. Concurrent shifts must already be merged or this will not work correctly!
+    :param meal_start : date object for the meal start in python dateutil datetime format
+    :param meal_end : date object for the meal end in python dateutil datetime format
+    :return: returns True or False
+    """
+    if len(shifts) == 0:
+        return False
+
+    # rd positive if first after second
+    # if ss after ms AND before me then good
+    # if se after ms AND before me then good
+    # if ss before ms AND se after me then good
+    # if the shift is more than a day before or after the meal days != 0
+    for shift in shifts:
+        ss_ms = relativedelta(meal_start, shift.start)
+        ss_ms_delta = ss_ms.minutes + (ss_ms.hours * 60)
+        ss_me = relativedelta(meal_end, shift.start)
+        ss_me_delta = ss_me.minutes + (ss_me.hours * 60)
+        if ss_ms_delta <= 0 and ss_me_delta >= 0 and ss_ms.days == 0:
+            return True
+
+        se_ms = relativedelta(meal_start, shift.end)
+        se_ms_delta = se_ms.minutes + (se_ms.hours * 60)
+        se_me = relativedelta(meal_end, shift.end)
+        se_me_delta = se_me.minutes + (se_me.hours * 60)
+        if se_ms_delta <= 0 and se_me_delta >= 0 and ss_ms.days == 0:
+            return True
+
+        if ss_ms_delta >= 0 and se_me_delta <= 0 and ss_ms.days == 0:
+            return True
+    return False
+
+
+class FakeMeal:
+    def __init__(self, id, start_time, end_time):
+        self.id = id
+        self.start_time = start_time
+        self.end_time = end_time
+
+
+# Sunday 8 March 2020, 2am US/Eastern, clocks go forward an hour
+DST_START = datetime(2020, 3, 8, 7, 0)
+# Sunday 1 November 2020, 2am US/Eastern, clocks go back an hour
+DST_END = datetime(2020, 11, 1, 6, 0)
+EASTERN = pytz.timezone('US/Eastern')
+
+
+class CarryoutEligibleTest(unittest.TestCase):
+
+    def assertAgree(self, shifts, meals):
+        """
+        Every meal gets the same answer from the reference, carryout_eligible and MealIndex
+        """
+        shifts = sorted(shifts)
+        eligible = MealIndex(meals).eligible_meals(shifts)
+        for meal in meals:
+            expected = carryout_eligible_relativedelta(shifts, meal.start_time, meal.end_time)
+            description = 'meal {} to {}, shifts {}'.format(meal.start_time, meal.end_time,
+                                                            [(str(shift.start), str(shift.end)) for shift in shifts])
+            self.assertEqual(carryout_eligible(shifts, meal.start_time, meal.end_time), expected,
+                             'carryout_eligible: ' + description)
+            self.assertEqual(meal.id in eligible, expected, 'MealIndex: ' + description)
+
+    def test_no_shifts(self):
+        meal = FakeMeal(1, datetime(2020, 3, 6, 17), datetime(2020, 3, 6, 19))
+        self.assertFalse(carryout_eligible([], meal.start_time, meal.end_time))
+        self.assertAgree([], [meal])
+
+    def test_shifts_touching_meal_boundary(self):
+        meal_start = datetime(2020, 3, 6, 17)
+        meal_end = datetime(2020, 3, 6, 19)
+        meals = [FakeMeal(1, meal_start, meal_end)]
+        for edge in [meal_start, meal_end]:
+            for offset in [-61, -60, -1, 0, 1, 60, 61]:
+                point = edge + timedelta(seconds=offset)
+                # ending at, starting at, and zero length shifts sitting on the boundary
+                self.assertAgree([Shift(point - timedelta(hours=2), point)], meals)
+                self.assertAgree([Shift(point, point + timedelta(hours=2))], meals)
+                self.assertAgree([Shift(point, point)], meals)
+                self.assertAgree([Shift(point - timedelta(minutes=15), point, extra_15=True)], meals)
+        # exactly covering the meal, and a zero length meal
+        self.assertAgree([Shift(meal_start, meal_end)], meals)
+        self.assertAgree([Shift(meal_start, meal_end)], [FakeMeal(2, meal_start, meal_start)])
+
+    def test_zero_length_gaps(self):
+        meal_start = datetime(2020, 3, 6, 17)
+        meals = [FakeMeal(1, meal_start, meal_start + timedelta(hours=1))]
+        for split in [-60, -30, 0, 30, 60, 90]:
+            middle = meal_start + timedelta(minutes=split)
+            # back to back shifts that haven't been merged, split before, inside and after the meal
+            self.assertAgree([Shift(middle - timedelta(hours=3), middle),
+                              Shift(middle, middle + timedelta(hours=3))], meals)
+            self.assertAgree([Shift(middle - timedelta(hours=3), middle - timedelta(minutes=15), extra_15=True),
+                              Shift(middle, middle + timedelta(hours=3))], meals)
+
+    def test_midnight_crossing(self):
+        midnight = datetime(2020, 3, 7)
+        meals = [FakeMeal(1, midnight - timedelta(hours=1), midnight + timedelta(hours=1)),
+                 FakeMeal(2, midnight + timedelta(hours=6), midnight + timedelta(hours=7)),
+                 FakeMeal(3, midnight - timedelta(hours=20), midnight - timedelta(hours=19))]
+        for start_hour in range(-26, 3):
+            for length in [1, 2, 4, 23, 24, 25, 26]:
+                start = midnight + timedelta(hours=start_hour)
+                self.assertAgree([Shift(start, start + timedelta(hours=length))], meals)
+
+    def test_dst_crossing(self):
+        for change in [DST_START, DST_END]:
+            meals = [FakeMeal(i, change + timedelta(minutes=minutes), change + timedelta(minutes=minutes + 90))
+                     for i, minutes in enumerate(range(-300, 301, 45))]
+            # the reference only compares calendar fields correctly when both sides are in the same timezone,
+            # see test_mixed_timezones_across_month_end
+            eastern_meals = [FakeMeal(meal.id, pytz.utc.localize(meal.start_time).astimezone(EASTERN),
+                                      pytz.utc.localize(meal.end_time).astimezone(EASTERN)) for meal in meals]
+            for start_minutes in range(-360, 361, 30):
+                for length in [60, 180, 1440, 1500]:
+                    start = change + timedelta(minutes=start_minutes)
+                    end = start + timedelta(minutes=length)
+                    # stored in the DB as naive UTC
+                    self.assertAgree([Shift(start, end)], meals)
+                    # in event time either side of the change, like shifts shown to staffers
+                    eastern = Shift(pytz.utc.localize(start).astimezone(EASTERN),
+                                    pytz.utc.localize(end).astimezone(EASTERN))
+                    self.assertAgree([eastern], eastern_meals)
+                    # parsed from Uber's ISO strings with fixed offsets
+                    parsed = Shift(parse(eastern.start.isoformat()), parse(eastern.end.isoformat()), extra_15=True)
+                    self.assertAgree([parsed], eastern_meals)
+
+    def test_mixed_timezones_across_month_end(self):
+        # relativedelta works out months from each side's own calendar, so a UTC meal on the 1st and an event time
+        # shift still on the 31st come out a month apart and the reference says no.  The DB keeps everything in
+        # UTC so the site never compared these, and carryout_eligible gets it right.
+        meal = FakeMeal(1, pytz.utc.localize(datetime(2020, 11, 1, 1)), pytz.utc.localize(datetime(2020, 11, 1, 2, 30)))
+        shift = Shift(pytz.utc.localize(datetime(2020, 11, 1, 1, 30)).astimezone(EASTERN),
+                      pytz.utc.localize(datetime(2020, 11, 1, 2, 30)).astimezone(EASTERN))
+        self.assertFalse(carryout_eligible_relativedelta([shift], meal.start_time, meal.end_time))
+        self.assertTrue(carryout_eligible([shift], meal.start_time, meal.end_time))
+        self.assertEqual(MealIndex([meal]).eligible_meals([shift]), {1})
+
+    def test_generated_shifts(self):
+        generator = random.Random(2020)
+        event_start = datetime(2020, 3, 5, 12)
+        meals = list()
+        for i in range(40):
+            meal_start = event_start + timedelta(minutes=15 * generator.randrange(4 * 96))
+            meals.append(FakeMeal(i, meal_start, meal_start + timedelta(minutes=generator.choice([30, 60, 90, 180]))))
+
+        for attendee in range(500):
+            shifts = list()
+            for i in range(generator.randrange(6)):
+                # mostly lined up on 15 minutes so plenty touch exactly, some off by a few seconds
+                shift_start = event_start + timedelta(minutes=15 * generator.randrange(4 * 96))
+                if generator.random() < 0.2:
+                    shift_start += timedelta(seconds=generator.randrange(-90, 91))
+                length = generator.choice([0, 60, 120, 180, 240, 360, 1440, 1455, 1800])
+                shifts.append(Shift(shift_start, shift_start + timedelta(minutes=length),
+                                    extra_15=generator.random() < 0.3))
+            self.assertAgree(shifts, meals)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class UberClient:
+    """
+    Shared client for the Uber/Reggie JSON-RPC API.
+    Keeps a pool of keep-alive connections so calls don't pay for a new TCP/TLS handshake every time,
+    puts a timeout on every call so a slow Reggie can't tie up a CherryPy thread forever,
+    and retries read-only lookups a few times with backoff.
+    Failures are returned in the same {'error': {'message': ...}} format Uber itself uses,
+    so callers only have one kind of error to check for.
+    """
+    # read only methods, safe to send again if an attempt failed or timed out
+    IDEMPOTENT_METHODS = {'attendee.lookup',
+                          'attendee.search',
+                          'barcode.lookup_badge_number_from_barcode',
+                          'dept.list',
+                          'config.info'}
+
+    def __init__(self, endpoint, authkey, pool_size=10, connect_timeout=3.05, read_timeout=10.0,
+                 retries=2, backoff=0.5):
+        self.endpoint = endpoint
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        self.session.headers.update({'X-Auth-Token': authkey})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._stats = dict()
+        self._lock = threading.Lock()
+
+    def call(self, method, params=None, retry=None):
+        """
+        Sends one JSON-RPC request and returns the decoded response
+        :param method: Uber API method name, eg 'attendee.lookup'
+        :param params: list of parameters for the method, left out of the request if None
+        :param retry: whether failed attempts are retried, defaults to True for methods in IDEMPOTENT_METHODS
+        :return: response dict, containing 'error' if Uber returned one or could not be reached
+        """
+        request_data = {'method': method}
+        if params is not None:
+            request_data['params'] = params
+
+        if retry is None:
+            retry = method in self.IDEMPOTENT_METHODS
+        attempts = self.retries + 1 if retry else 1
+
+        start = time.monotonic()
+        error = ''
+        response = None
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                request = self.session.post(url=self.endpoint, json=request_data, timeout=self.timeout)
+                if request.status_code >= 500:
+                    error = 'HTTP ' + str(request.status_code)
+                    continue
+                response = request.json()
+                break
+            except (requests.ConnectionError, requests.Timeout, ValueError) as e:
+                # ValueError is from a response that isn't JSON, like a proxy error page
+                error = str(e)
+
+        if response is None:
+            response = {'error': {'message': 'Could not reach Uber for ' + method + ': ' + error}}
+
+        self._record(method, time.monotonic() - start, attempt, 'error' in response)
+        return response
+
+    def _record(self, method, elapsed, retries, failed):
+        with self._lock:
+            stat = self._stats.setdefault(method, {'calls': 0, 'errors': 0, 'retries': 0,
+                                                   'total_time': 0.0, 'max_time': 0.0})
+            stat['calls'] += 1
+            stat['retries'] += retries
+            if failed:
+                stat['errors'] += 1
+            stat['total_time'] += elapsed
+            stat['max_time'] = max(stat['max_time'], elapsed)
+
+    def stats(self):
+        """
+        Per method latency stats since startup
+        :return: dict of method name to dict of calls, errors, retries, avg_ms, max_ms
+        """
+        with self._lock:
+            result = dict()
+            for method, stat in self._stats.items():
+                result[method] = {'calls': stat['calls'],
+                                  'errors': stat['errors'],
+                                  'retries': stat['retries'],
+                                  'avg_ms': round(stat['total_time'] * 1000 / stat['calls'], 1),
+                                  'max_ms': round(stat['max_time'] * 1000, 1)}
+            return result
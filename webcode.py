@@ -1,6 +1,7 @@
 # sections of this are copied from https://github.com/magfest/ubersystem/blob/master/uber/site_sections/signups.py
 # then modified for my needs.
 import json
+import os
 import requests
 
 import cherrypy
@@ -8,29 +9,36 @@ from datetime import datetime
 from dateutil.parser import parse
 from dateutil.relativedelta import relativedelta
 from dateutil.tz import tzlocal
-import pdfkit
 import pytz
 import sqlalchemy.orm.exc
 from sqlalchemy.orm import joinedload, subqueryload
 
-from config import env, cfg, c
+from config import env, cfg, c, uber, spooler
 from decorators import *
+import labels
 import models
+import notifications
+from notifications import notifier
+from roster import checkin_metrics, checkin_roster
 from models.attendee import Attendee
 from models.meal import Meal
 from models.order import Order
 from models.department import Department
 from models.dept_order import DeptOrder
 from models.checkin import Checkin
+from models.notification import Notification
 import shared_functions
 from shared_functions import api_login, HTTPRedirect, order_split, order_selections, allergy_info, \
                      meal_join, meal_split, meal_blank_toppings, department_split, create_dept_order, \
                      ss_eligible, carryout_eligible, combine_shifts, return_selected_only, \
-                     con_tz, utc_tz, now_utc, now_contz, is_admin, is_ss_staffer, is_dh, return_not_selected
+                     con_tz, utc_tz, now_utc, now_contz, is_admin, is_ss_staffer, is_dh, return_not_selected, \
+                     set_order_selections
 import slack_bot
 
 
 class Root:
+    # one database session per request, available as cherrypy.request.db
+    _cp_config = {'tools.db.on': True}
     
     @restricted
     @cherrypy.expose
@@ -86,6 +94,8 @@ class Root:
                 # ensure_csrf_token_exists()
                 cherrypy.session['staffer_id'] = response['result']['public_id']
                 cherrypy.session['badge_num'] = response['result']['badge_num']
+                # logging in is when people tend to have just changed their shifts, make sure we see the changes
+                shared_functions.attendee_cache.invalidate(cherrypy.session['badge_num'])
                 
                 if is_ss_staffer(cherrypy.session['staffer_id']):
                     cherrypy.session['is_ss_staffer'] = True
@@ -120,7 +130,7 @@ class Root:
                                                    + con_tz(c.EPOCH).strftime(cfg.date_format) + ' ID: ' +
                                                    str(cherrypy.session['staffer_id']))
 
-                session = models.new_sesh()
+                session = cherrypy.request.db
                 # print('succesful login, updating record')
                 # add or update attendee record in DB
                 try:
@@ -141,8 +151,9 @@ class Root:
                     attendee.full_name = response['result']['full_name']
                     session.add(attendee)
                     session.commit()
-                    
-                session.close()
+                
+                shared_functions.flag_shift_sync(session, attendee.public_id)
+                session.commit()
 
                 raise HTTPRedirect(original_location)
         
@@ -164,18 +175,14 @@ class Root:
             text = message
             messages.append(text)
             
-        session = models.new_sesh()
+        session = cherrypy.request.db
         
         # this should be triggered if an edit button is clicked from the list
         if id:
-            session.close()
             raise HTTPRedirect('meal_edit?meal_id='+id)
 
-        meallist = session.query(Meal).order_by(models.meal.Meal.start_time).all()
-        session.close()
-        
-        for meal in meallist:
-            meal.start_time = con_tz(meal.start_time)
+        meallist = [shared_functions.Display(meal, start_time=con_tz(meal.start_time))
+                    for meal in session.query(Meal).order_by(models.meal.Meal.start_time)]
 
         session_info = {
             'is_dh': cherrypy.session['is_dh'],
@@ -189,17 +196,50 @@ class Root:
                                session=session_info,
                                c=c)
 
+    @cherrypy.expose
+    @admin_req
+    def meal_eligibility(self, display_all=False):
+        """
+        Shows how many staffers are eligible for each meal, worked out from everyone's shifts in the local mirror
+        """
+        session = cherrypy.request.db
+        meals = session.query(Meal).order_by(Meal.start_time).all()
+        counts = shared_functions.meal_eligibility_counts(session, meals)
+        synced = session.query(models.shift_sync.ShiftSync).count()
+        
+        now = now_utc()
+        meal_list = list()
+        for meal in meals:
+            # hides meals in the past by default
+            if meal.end_time < now and not display_all:
+                continue
+            meal_list.append({'id': meal.id, 'name': meal.meal_name, 'start': con_tz(meal.start_time),
+                              'shifts': counts[meal.id]['shifts'], 'total': counts[meal.id]['total']})
+        
+        session_info = {
+            'is_dh': cherrypy.session['is_dh'],
+            'is_admin': cherrypy.session['is_admin'],
+            'is_ss_staffer': cherrypy.session['is_ss_staffer']
+        }
+        
+        template = env.get_template('meal_eligibility.html')
+        return template.render(meallist=meal_list,
+                               synced=synced,
+                               session=session_info,
+                               c=c)
+
     @cherrypy.expose
     @ss_staffer
     def dinein_checkin(self):
-        session = models.new_sesh()
+        session = cherrypy.request.db
         now = now_utc()
         current_meals = session.query(Meal).filter(Meal.start_time < now, Meal.end_time > now).order_by(Meal.end_time).all()
         if not current_meals:
             current_meal = None
         else:
             current_meal = current_meals[-1]
-        session.close()
+            # load everything scans need up front, so they are answered from memory
+            checkin_roster.open_meal(session, current_meal)
 
         template = env.get_template("dinin_checkin.html")
 
@@ -214,94 +254,115 @@ class Root:
     @cherrypy.expose
     @ss_staffer
     def checkin_badge(self, meal_id='', badge=''):
-        if badge[0] == "~":
-            badge = shared_functions.barcode_to_badge(badge)
-        else:
-            try:
-                badge = int(badge)
-            except ValueError:
-                return json.dumps({"success": False, "badge": badge, "reason": "Not a number?"})
-            
-        if not badge:
-            return json.dumps({"success": False, "badge": badge, "reason": "Could not locate badge."})
+        session = cherrypy.request.db
+        # answered from the in-memory roster, Uber is only asked about badges it hasn't seen before
+        result = checkin_roster.check_in(session, [{'badge': badge, 'meal_id': meal_id}])[0]
+        return json.dumps(result)
+
+    @cherrypy.expose
+    @ss_staffer
+    def checkin_batch(self, scans='[]'):
+        """
+        Checks in a batch of scans queued up by the checkin kiosk, saved in one transaction.
+        :param scans: JSON list of {"id", "badge", "meal_id", "scanned_at"}, scanned_at in milliseconds since the epoch
+        :return: JSON list of results, one per scan with its id, see CheckinRoster.check_in
+        """
+        try:
+            scans = json.loads(scans)
+        except ValueError:
+            return json.dumps({"success": False, "reason": "Could not read scans."})
+        if not isinstance(scans, list):
+            return json.dumps({"success": False, "reason": "Could not read scans."})
+        
+        session = cherrypy.request.db
+        return json.dumps(checkin_roster.check_in(session, scans))
+
+    @cherrypy.expose
+    @admin_req
+    def checkin_stats(self, clear=False):
+        """
+        How fast the dine-in line is moving and where the time goes in answering a scan, over the last
+        checkin_metrics_window minutes
+        """
+        if clear:
+            checkin_metrics.clear()
+            raise HTTPRedirect('checkin_stats')
         
-        #if not meal_id:
-         #   return json.dumps({"success": False, "badge": badge, "reason": ""})
+        session = cherrypy.request.db
+        stats = checkin_metrics.stats()
+        meal_names = dict(session.query(Meal.id, Meal.meal_name).filter(Meal.id.in_(
+            [meal_id for meal_id in stats['meals'] if meal_id is not None])))
         
-        session = models.new_sesh()
-        meal = session.query(Meal).filter(Meal.id == meal_id).one_or_none()
-        #if not meal:
-        #    session.close()
-        #    return json.dumps({"success": False, "badge": badge, "reason": "Could not find meal {}.".format(meal_id)})
+        session_info = {
+            'is_dh': cherrypy.session['is_dh'],
+            'is_admin': cherrypy.session['is_admin'],
+            'is_ss_staffer': cherrypy.session['is_ss_staffer']
+        }
         
-        try:
-            attend = session.query(Attendee).filter_by(badge_num=badge).one()
-        except sqlalchemy.orm.exc.NoResultFound:
-            response = shared_functions.lookup_attendee(badge)
-            if 'error' in response:
-                session.close()
-                return json.dumps({"success": False, "badge": badge, "reason": "Badge # {} is not found in Reggie".format(badge)})
-            attend = Attendee()
-            attend.badge_num = response['result']['badge_num']
-            attend.public_id = response['result']['public_id']
-            attend.full_name = response['result']['full_name']
-            session.add(attend)
+        template = env.get_template("checkin_stats.html")
+        return template.render(stats=stats,
+                               meal_names=meal_names,
+                               roster=checkin_roster.stats(),
+                               c=c,
+                               session=session_info)
+    
+    @cherrypy.expose
+    @admin_req
+    def notification_list(self, retry_id='', delete_id='', retry_dead=False, message=''):
+        """
+        Slack messages and webhook calls waiting to go out, and the dead ones that gave up after too many tries,
+        which can be sent again or deleted from here
+        """
+        session = cherrypy.request.db
+        
+        if retry_id or retry_dead:
+            query = session.query(Notification).filter(Notification.status == 'dead')
+            if retry_id:
+                query = query.filter(Notification.id == retry_id)
+            count = query.update({Notification.status: 'queued', Notification.attempts: 0,
+                                  Notification.next_attempt: datetime.utcnow()}, synchronize_session=False)
             session.commit()
-            
-        if meal:
-            order = session.query(Order).filter(Order.attendee_id == attend.public_id,
-                                                Order.meal_id == meal.id).one_or_none()
-            if order:
-                sorted_shifts, response = combine_shifts(attend.badge_num, full=True, no_combine=True)
-                user_exempt = False
-                for dept in response['result']['assigned_depts_labels']:
-                    if dept in cfg.exempt_depts:
-                        user_exempt = True
-
-                if cherrypy.session['is_dh'] or user_exempt:
-                    eligible = True
-                else:
-                    eligible = carryout_eligible(sorted_shifts, meal.start_time, meal.end_time)
-                
-                # if their order is eligible for carryout, they get kicked out
-                if eligible or user_exempt:
-                    session.close()
-                    return json.dumps({"success": False, "badge": badge, "reason": "Attendee {} has placed a delivery order for this meal.".format(badge)})
-        
-        allergy_msg = ""
-        allergies = allergy_info(badge)
-        for allergy in allergies['standard_labels']:
-            allergy_msg += allergy+"<br>"
-        allergy_msg += allergies['freeform']
-        if meal:
-            checkin = session.query(Checkin).filter(Checkin.attendee_id == attend.public_id, Checkin.meal_id == meal.id).all()
-        else:
-            checkin = session.query(Checkin).filter(Checkin.attendee_id == attend.public_id,
-                                                    Checkin.meal_id == None).all()
-        if checkin and meal:
-            session.close()
-            return json.dumps({"success": False, "badge": badge, "reason": "Badge is already checked in for this meal.", "allergies": allergy_msg})
-        
-        if not shared_functions.ss_eligible(badge):
-            session.close()
-            return json.dumps({"success": False, "badge": badge, "reason": "Badge is not eligible for food. Please see STOPS."})
-        
-        if meal:
-            checkin = Checkin(attendee_id=attend.public_id, meal_id=meal.id)
-        else:
-            if checkin:
-                # if not meal, but checkin.  ie if attempting checkin not during meal AND this has one or more checkins.
-                for item in checkin:
-                    delta = relativedelta(item.timestamp, datetime.utcnow())
-                    # if a previously received checkin NOT associated with a meal is with 2 hours of current non meal checkin
-                    if not item.meal_id and abs(delta.hours) <= 1 and abs(delta.days) == 0:
-                        session.close()
-                        return json.dumps({"success": True, "badge": badge, "reason": "", "allergies": allergy_msg})
-            checkin = Checkin(attendee_id=attend.public_id, meal_id=None)
-        session.add(checkin)
-        session.commit()
-        session.close()
-        return json.dumps({"success": True, "badge": badge, "reason": "", "allergies": allergy_msg})
+            notifier.wake()
+            raise HTTPRedirect('notification_list?message=Queued ' + str(count) + ' notifications to send again.')
+        
+        if delete_id:
+            session.query(Notification).filter(Notification.id == delete_id).delete(synchronize_session=False)
+            session.commit()
+            raise HTTPRedirect('notification_list?message=Notification deleted.')
+        
+        pending = session.query(Notification).filter(Notification.status.in_(['queued', 'sending']))\
+            .order_by(Notification.next_attempt).limit(100).all()
+        dead = session.query(Notification).filter(Notification.status == 'dead')\
+            .order_by(Notification.created.desc()).all()
+        sent = session.query(Notification).filter(Notification.status == 'sent')\
+            .order_by(Notification.sent_time.desc()).limit(20).all()
+        
+        session_info = {
+            'is_dh': cherrypy.session['is_dh'],
+            'is_admin': cherrypy.session['is_admin'],
+            'is_ss_staffer': cherrypy.session['is_ss_staffer']
+        }
+        
+        template = env.get_template("notification_list.html")
+        return template.render(pending=pending,
+                               dead=dead,
+                               sent=sent,
+                               stats=notifier.stats(),
+                               slack_stats=slack_bot.slack.stats(),
+                               message=message,
+                               c=c,
+                               session=session_info)
+    
+    @cherrypy.expose
+    @admin_req
+    def checkin_stats_json(self):
+        """
+        The checkin_stats numbers as JSON, for dashboards and monitoring scripts
+        """
+        stats = checkin_metrics.stats()
+        # JSON object keys have to be strings, scans outside of meals are under "none"
+        stats['meals'] = dict((str(meal_id).lower(), meal) for meal_id, meal in stats['meals'].items())
+        return json.dumps(stats)
 
     @cherrypy.expose
     @admin_req
@@ -314,7 +375,7 @@ class Root:
             
         # save new / updated meal
         if 'meal_name' in params:
-            session = models.new_sesh()
+            session = cherrypy.request.db
             try:
                 # tries to load id from params, if not there or blank does new meal
                 id = params['id']
@@ -334,28 +395,29 @@ class Root:
             thismeal.cutoff = utc_tz(params['cutoff'])
             thismeal.description = params['description']
             thismeal.toppings_title = params['toppings_title']
-            thismeal.toppings = meal_join(session, params, field='toppings')
             thismeal.toggle1_title = params['toggle1_title']
-            thismeal.toggle1 = meal_join(session, params, field='toggle1')
             thismeal.toggle2_title = params['toggle2_title']
-            thismeal.toggle2 = meal_join(session, params, field='toggle2')
             thismeal.toggle3_title = params['toggle3_title']
-            thismeal.toggle3 = meal_join(session, params, field='toggle3')
+            ingredients = meal_join(session, params, ['toppings', 'toggle1', 'toggle2', 'toggle3'])
+            thismeal.toppings = ingredients['toppings']
+            thismeal.toggle1 = ingredients['toggle1']
+            thismeal.toggle2 = ingredients['toggle2']
+            thismeal.toggle3 = ingredients['toggle3']
             # thismeal.detail_link = params['detail_link']
 
             session.add(thismeal)
             session.commit()
-            session.close()
+            # labels might have been edited, next page to use them loads fresh copies
+            for id_list in ingredients.values():
+                shared_functions.ingredient_catalog.invalidate(shared_functions.ingredient_ids(id_list))
+            labels.orders_changed(session, thismeal.id)
             raise HTTPRedirect('meal_setup_list?message='+message)
 
         if meal_id:
             # load existing meal
             try:
-                session = models.new_sesh()
-                thismeal = session.query(Meal).filter_by(id=meal_id).one()
-                thismeal.start_time = con_tz(thismeal.start_time)
-                thismeal.end_time = con_tz(thismeal.end_time)
-                thismeal.cutoff = con_tz(thismeal.cutoff)
+                session = cherrypy.request.db
+                thismeal = shared_functions.meal_display(session.query(Meal).filter_by(id=meal_id).one())
                 # loads list of existing toppings, adds blank toppings to list up to configured quantity
                 toppings = meal_blank_toppings(meal_split(session, thismeal.toppings), cfg.multi_select_count)
                 toggles1 = meal_blank_toppings(meal_split(session, thismeal.toggle1), cfg.radio_select_count)
@@ -363,11 +425,8 @@ class Root:
                 toggles3 = meal_blank_toppings(meal_split(session, thismeal.toggle3), cfg.radio_select_count)
             except sqlalchemy.orm.exc.NoResultFound:
                 message = 'Requested Meal ID '+meal_id+' not found'
-                session.close()
                 raise HTTPRedirect('meal_setup_list?message='+message)
             
-            session.close()
-            
         else:
             thismeal = Meal()
             thismeal.meal_name = ''
@@ -422,7 +481,7 @@ class Root:
         if delete_order:
             raise HTTPRedirect('order_delete_comfirm?order_id=' + str(delete_order))
 
-        session = models.new_sesh()
+        session = cherrypy.request.db
         
         # parameter save_order should only be present if submit clicked
         if save_order:
@@ -441,7 +500,6 @@ class Root:
                 if not thisorder.attendee.public_id == cherrypy.session['staffer_id']:
                     if not shared_functions.is_dh(cherrypy.session['staffer_id']):
                         if not shared_functions.is_admin(cherrypy.session['staffer_id']):
-                            session.close()
                             raise HTTPRedirect("staffer_meal_list?message=This isn't your order.")
                         
                 try:
@@ -456,44 +514,45 @@ class Root:
                     
                 # todo: do I actually set the locked field anywhere?
                 if dept_order_started or thisorder.locked:
-                    session.close()
                     raise HTTPRedirect("staffer_meal_list?message=This order has already been started by Staff Suite")
                     
             except sqlalchemy.orm.exc.NoResultFound:
-                thisorder = Order()
-                thismeal = session.query(Meal).filter_by(id=save_order).one()
-                thisorder.meal = thismeal
+                thisorder = None
 
+            thismeal = session.query(Meal).filter_by(id=save_order).one()
             hour = relativedelta(hours=1)
             now = datetime.utcnow() + hour
-            rd = relativedelta(now, thisorder.meal.end_time)
+            rd = relativedelta(now, thismeal.end_time)
             
             if rd.minutes > 0 or rd.hours > 0 or rd.days > 0:
                 raise HTTPRedirect("staffer_meal_list?message=Pickup orders for this meal time are closed")
             
+            # actually verifies you are admin and not just you edited URL
+            if dh_edit and not (is_dh(cherrypy.session['staffer_id']) or is_admin(cherrypy.session['staffer_id'])):
+                raise HTTPRedirect('staffer_meal_list?message=You must be DH or admin to use this feature')
+            
             if dh_edit:
-                # actually verifies you are admin and not just you edited URL
                 # print('starting dh_edit')
-                if is_dh(cherrypy.session['staffer_id']) or is_admin(cherrypy.session['staffer_id']):
-                    # print('is actualy dh or admin')
-                    try:
-                        attend = session.query(Attendee).filter_by(badge_num=params['badge_number']).one()
-                        thisorder.attendee_id = attend.public_id
-                    except sqlalchemy.orm.exc.NoResultFound:
-                        response = shared_functions.lookup_attendee(params['badge_number'])
-                        attend = Attendee()
-                        attend.badge_num = response['result']['badge_num']
-                        attend.public_id = response['result']['public_id']
-                        attend.full_name = response['result']['full_name']
-                        session.add(attend)
-                        thisorder.attendee_id = attend.public_id
-                        session.commit()
-                else:
-                    session.close()
-                    raise HTTPRedirect('staffer_meal_list?message=You must be DH or admin to use this feature')
+                try:
+                    attend = session.query(Attendee).filter_by(badge_num=params['badge_number']).one()
+                except sqlalchemy.orm.exc.NoResultFound:
+                    response = shared_functions.lookup_attendee(params['badge_number'])
+                    attend = Attendee()
+                    attend.badge_num = response['result']['badge_num']
+                    attend.public_id = response['result']['public_id']
+                    attend.full_name = response['result']['full_name']
+                    session.add(attend)
+                    session.commit()
+                attendee_id = attend.public_id
             else:
                 # print('not dh_edit')
-                thisorder.attendee_id = cherrypy.session['staffer_id']
+                attendee_id = cherrypy.session['staffer_id']
+            
+            # only built once everything above has passed, setting the meal puts it in the session
+            if thisorder is None:
+                thisorder = Order()
+                thisorder.meal = thismeal
+            thisorder.attendee_id = attendee_id
              
             thisorder.department_id = params['department']
             thisorder.meal_id = save_order  # save order kinda wonky, data will be meal id if 'Submit' is clicked
@@ -502,6 +561,7 @@ class Root:
             thisorder.toggle3 = order_selections(field='toggle3', params=params, is_toggle=True)
             thisorder.toppings = order_selections(field='toppings', params=params)
             thisorder.notes = notes
+            set_order_selections(thisorder)
             
             if dh_edit:  # if the order is being created by the DH Edit method, mark overridden so it will be made.
                 thisorder.overridden = True
@@ -509,8 +569,11 @@ class Root:
                 shared_functions.dummy_data(params['dummycount'], thisorder)
             else:
                 session.add(thisorder)
+                # get a fresh copy of their shifts before fulfilment needs them
+                shared_functions.flag_shift_sync(session, thisorder.attendee_id)
             session.commit()
-            session.close()
+            # a new order can still go into a bundle that is already locked
+            labels.orders_changed(session, save_order, [params['department']])
             
             raise HTTPRedirect('staffer_meal_list?message=Succesfully saved order')
         
@@ -522,9 +585,9 @@ class Root:
             now = datetime.utcnow() + hour
             rd = relativedelta(now, thisorder.meal.end_time)
 
-            if rd.minutes > 0 or rd.hours > 0 or rd.days > 0:
+            orders_closed = rd.minutes > 0 or rd.hours > 0 or rd.days > 0
+            if orders_closed:
                 messages.append('Pickup orders are closed for this meal.')
-                thisorder.locked = True
                 
             if dh_edit:
                 try:
@@ -545,15 +608,14 @@ class Root:
                 attend = session.query(Attendee).filter_by(public_id=cherrypy.session['staffer_id']).one()
                 allergies = allergy_info(cherrypy.session['badge_num'])
                 
-            session.close()
+            if orders_closed:
+                thisorder = shared_functions.Display(thisorder, locked=True)
             if not attend.public_id == cherrypy.session['staffer_id']:
                 if not shared_functions.is_dh(cherrypy.session['staffer_id']):
                     if not shared_functions.is_admin(cherrypy.session['staffer_id']):
                         raise HTTPRedirect("staffer_meal_list?message=This isn't your order.")
                     
-            thismeal.start_time = con_tz(thismeal.start_time)
-            thismeal.end_time = con_tz(thismeal.end_time)
-            thismeal.cutoff = con_tz(thismeal.cutoff)
+            thismeal = shared_functions.meal_display(thismeal)
             toppings = order_split(session, choices=thismeal.toppings, orders=thisorder.toppings)
             toggles1 = order_split(session, choices=thismeal.toggle1, orders=thisorder.toggle1)
             toggles2 = order_split(session, choices=thismeal.toggle2, orders=thisorder.toggle2)
@@ -599,7 +661,6 @@ class Root:
                     # check if order already exists, DH edit
                     thisorder = session.query(Order).filter_by(attendee_id=attend.public_id, meal_id=meal_id).one()
 
-                    session.close()
                     raise HTTPRedirect('order_edit?dh_edit=True&badge_number=' + str(params['badge_number']) +
                                        '&order_id=' + str(thisorder.id) +
                                        '&message=An order already exists for this Meal, previously created '
@@ -611,7 +672,6 @@ class Root:
                     # check if order already exists, non DH edit
                     thisorder = session.query(Order).filter_by(attendee_id=cherrypy.session['staffer_id'],
                                                                meal_id=meal_id).one()
-                    session.close()
                     raise HTTPRedirect('order_edit?order_id=' + str(thisorder.id) +
                                        '&message=An order already exists for this Meal, previously created order '
                                        'selections loaded.')
@@ -638,12 +698,7 @@ class Root:
                 attend = session.query(Attendee).filter_by(public_id=cherrypy.session['staffer_id']).one()
                 allergies = allergy_info(cherrypy.session['badge_num'])
 
-            thismeal = session.query(Meal).filter_by(id=meal_id).one()
-            session.close()
-            
-            thismeal.start_time = con_tz(thismeal.start_time)
-            thismeal.end_time = con_tz(thismeal.end_time)
-            thismeal.cutoff = con_tz(thismeal.cutoff)
+            thismeal = shared_functions.meal_display(session.query(Meal).filter_by(id=meal_id).one())
             thisorder = Order()
             thisorder.attendee_id = cherrypy.session['staffer_id']
             toppings = order_split(session, thismeal.toppings)
@@ -677,7 +732,7 @@ class Root:
     @cherrypy.expose
     @restricted
     def order_delete_confirm(self, order_id='', confirm=False):
-        session = models.new_sesh()
+        session = cherrypy.request.db
         
         session_info = {
             'is_dh': cherrypy.session['is_dh'],
@@ -689,12 +744,12 @@ class Root:
         
         if confirm:
             if thisorder.attendee_id == cherrypy.session['staffer_id']:
+                meal_id, dept_id = thisorder.meal_id, thisorder.department_id
                 session.delete(thisorder)
                 session.commit()
-                session.close()
+                labels.orders_changed(session, meal_id, [dept_id])
                 raise HTTPRedirect('staffer_meal_list?message=Order Deleted.')
             else:
-                session.close()
                 raise HTTPRedirect('staffer_meal_list?message=Order does not belong to you?')
         
         template = env.get_template('order_delete_confirm.html')
@@ -710,7 +765,7 @@ class Root:
         # todo: something to block malicious users from doctoring links and tricking admins into deleting meals.
         #       perhaps check if meal_delete_confirm is in link at login page?
         
-        session = models.new_sesh()
+        session = cherrypy.request.db
         session_info = {
             'is_dh': cherrypy.session['is_dh'],
             'is_admin': cherrypy.session['is_admin'],
@@ -723,12 +778,9 @@ class Root:
             redir = 'meal_setup_list?message=Meal ' + thismeal.meal_name + ' has been Deleted.'
             session.delete(thismeal)
             session.commit()
-            session.close()
             raise HTTPRedirect(redir)
         
-        session.close()
-        
-        thismeal.start_time = con_tz(thismeal.start_time)
+        thismeal = shared_functions.Display(thismeal, start_time=con_tz(thismeal.start_time))
             
         template = env.get_template('meal_delete_confirm.html')
         return template.render(
@@ -757,7 +809,7 @@ class Root:
             text = message
             messages.append(text)
             
-        session = models.new_sesh()
+        session = cherrypy.request.db
         
         eligible = ss_eligible(cherrypy.session['badge_num'])
         
@@ -772,32 +824,37 @@ class Root:
                 # save webhook data
                 attendee.webhook_url = params['webhook_url']
                 attendee.webhook_data = params['webhook_data']
+                # sends a test call to the new webhook
+                notifications.enqueue_webhook(session, params['webhook_url'], params['webhook_data'],
+                                              'Test webhook for badge {}'.format(attendee.badge_num))
                 session.commit()
-                shared_functions.send_webhook(params['webhook_url'], params['webhook_data'])
+                notifier.wake()
                 junk = attendee.badge_num  # gets SQLAlchemy to reload attendee from database since needed for page display
         
-        meals = session.query(Meal).all()
+        # every meal along with this staffer's order for it, if they have one
+        rows = shared_functions.staffer_meals(session, cherrypy.session['staffer_id'])
+        meals = [row[0] for row in rows]
         sorted_shifts, response = combine_shifts(cherrypy.session['badge_num'], no_combine=True, full=True)
         allergies = allergy_info(cherrypy.session['badge_num'])
 
         meal_display = list()
         
-        session.close()
-        
         user_exempt = False
         for dept in response['result']['assigned_depts_labels']:
             if dept in cfg.exempt_depts:
                 user_exempt = True
             
+        eligible_meals = shared_functions.MealIndex(meals).eligible_meals(sorted_shifts)
         now = datetime.utcnow()
-        for meal in meals:
+        for meal, order_id, overridden in rows:
             # print("checking meal")
+            listing = shared_functions.StafferMeal(meal, order_id, overridden)
             if cherrypy.session['is_dh'] or user_exempt:
-                meal.eligible = True
+                listing.eligible = True
             else:
-                meal.eligible = carryout_eligible(sorted_shifts, meal.start_time, meal.end_time)
+                listing.eligible = meal.id in eligible_meals
             
-            if meal.eligible or display_all or meal.order_exists:
+            if listing.eligible or display_all or listing.order_exists:
                 delta = relativedelta(meal.end_time, now)
                 # rd is negative if first item is before second
                 rd = 0
@@ -806,31 +863,12 @@ class Root:
                 rd += delta.days * 1440
                 # hides meals in the past by default
                 if rd >= 0 or display_all:
-                    meal_display.append(meal)
+                    meal_display.append(listing)
         
         if len(meal_display) == 0:
             messages.append('You are not signed up for any shifts that overlap with meal times. '
                             'If you work in a non-shift capacity, please click the "Show all meals" button below '
                             'to submit a carryout order.')
-        
-        for thismeal in meals:
-            thismeal.start_time = con_tz(thismeal.start_time)
-            thismeal.end_time = con_tz(thismeal.end_time)
-            thismeal.cutoff = con_tz(thismeal.cutoff)
-            try:
-                orders = session.query(Order).filter_by(meal_id=thismeal.id,
-                                                           attendee_id=cherrypy.session['staffer_id']).all()
-                # print('0------------------printing matching orders-----------------')
-                # for order in orders:
-                    # print(str(order.meal_id) + ', ' + str(order.id))
-                # todo: more efficient code for this, I think there's a way to load orders for all meals in one query request
-                thisorder = session.query(Order).filter_by(meal_id=thismeal.id,
-                                                           attendee_id=cherrypy.session['staffer_id']).one()
-                thismeal.order_exists = True
-                if thisorder.overridden:
-                    thismeal.overridden = True
-            except sqlalchemy.orm.exc.NoResultFound:
-                pass
             
         template = env.get_template('staffer_meal_list.html')
         return template.render(messages=messages,
@@ -856,11 +894,12 @@ class Root:
         }
         
         if delete_order:
-            session = models.new_sesh()
+            session = cherrypy.request.db
             thisorder = session.query(Order).filter_by(id=delete_order).one()
+            meal_id, dept_id = thisorder.meal_id, thisorder.department_id
             session.delete(thisorder)
             session.commit()
-            session.close()
+            labels.orders_changed(session, meal_id, [dept_id])
             raise HTTPRedirect('config?dangerouse=true&message=order ' + delete_order + ' deleted.')
         
         if 'radio_select_count' in params:
@@ -906,7 +945,7 @@ class Root:
 
         if badge:
             # print('------------looking up attendee------------------')
-            attendee = shared_functions.lookup_attendee(badge, True)
+            attendee = shared_functions.lookup_attendee(badge, True, cached=False)
             attendee = json.dumps(attendee, indent=2)
             # print(attendee)
             template = env.get_template('config.html')
@@ -917,6 +956,14 @@ class Root:
                                    exempt_depts=exempt_depts,
                                    dangerous=True,
                                    attendee=attendee,
+                                   attendee_cache=shared_functions.attendee_cache.stats(),
+                                   ingredient_catalog=shared_functions.ingredient_catalog.stats(),
+                                   label_stats=labels.label_queue.stats(),
+                                   label_cache=labels.label_cache.stats(),
+                                   checkin_roster=checkin_roster.stats(),
+                                   printers=spooler.stats(),
+                                   printer_errors=spooler.errors,
+                                   uber_stats=uber.stats(),
                                    c=c,
                                    cfg=cfg)
         
@@ -927,16 +974,25 @@ class Root:
                                staffer_list=staffer_list,
                                exempt_depts=exempt_depts,
                                dangerous=dangerous,
+                               attendee_cache=shared_functions.attendee_cache.stats(),
+                               ingredient_catalog=shared_functions.ingredient_catalog.stats(),
+                               label_stats=labels.label_queue.stats(),
+                               label_cache=labels.label_cache.stats(),
+                               checkin_roster=checkin_roster.stats(),
+                               printers=spooler.stats(),
+                               printer_errors=spooler.errors,
+                               uber_stats=uber.stats(),
                                c=c,
                                cfg=cfg)
 
     @cherrypy.expose
     @admin_req
-    def dangerous(self, reset_dept_list=False, reset_checkin_list=False):
+    def dangerous(self, reset_dept_list=False, reset_checkin_list=False, clear_attendee_cache=False,
+                  clear_ingredient_catalog=False, clear_label_cache=False, clear_checkin_roster=False):
         """
         For hidden buttons to do potentially very dangerous things
         """
-        session = models.new_sesh()
+        session = cherrypy.request.db
         
         if reset_dept_list:
             depts = session.query(Department).all()
@@ -949,9 +1005,21 @@ class Root:
             checkins = session.query(Checkin).all()
             for checkin in checkins:
                 session.delete(checkin)
+            checkin_roster.clear()
             session.commit()
         
-        session.close()
+        if clear_attendee_cache:
+            shared_functions.attendee_cache.clear()
+        
+        if clear_ingredient_catalog:
+            shared_functions.ingredient_catalog.clear()
+        
+        if clear_label_cache:
+            labels.label_cache.clear()
+        
+        if clear_checkin_roster:
+            checkin_roster.clear()
+        
         raise HTTPRedirect("config")
     
     @cherrypy.expose
@@ -977,18 +1045,12 @@ class Root:
         if 'meal_id' in params:
             raise HTTPRedirect('dept_order?meal_id=' + str(params['meal_id']) + '&dept_id=' + str(params['dept_id']))
         
-        session = models.new_sesh()
+        session = cherrypy.request.db
         departments = department_split(session)
         
         # todo: filter by future meals, by end time of meal
-        meal_list = session.query(Meal).all()
-        
-        for meal in meal_list:
-            meal.start_time = con_tz(meal.start_time)
-            meal.end_time = con_tz(meal.end_time)
-            meal.cutoff = con_tz(meal.cutoff)
+        meal_list = [shared_functions.meal_display(meal) for meal in session.query(Meal)]
             
-        session.close()
         template = env.get_template("dept_order_selection.html")
         return template.render(depts=departments,
                                meals=meal_list,
@@ -1033,7 +1095,7 @@ class Root:
                 raise HTTPRedirect('dept_order?meal_id=' + str(meal_id) + '&dept_id=' + str(dept_id) +
                                    '&skip=true&message=Food Manager Succesfully Added')
             else:
-                session = models.new_sesh()
+                session = cherrypy.request.db
                 attend = session.query(Attendee).filter_by(badge_num=params['food_manager']).one()
                 if attend.public_id in cfg.food_managers:
                     raise HTTPRedirect('dept_order?meal_id=' + str(meal_id) + '&dept_id=' + str(dept_id) +
@@ -1042,7 +1104,7 @@ class Root:
                     raise HTTPRedirect('dept_order?meal_id=' + str(meal_id) + '&dept_id=' + str(dept_id) +
                                        '&skip=true&message=Error adding food manager')
         
-        session = models.new_sesh()
+        session = cherrypy.request.db
         
         dept = session.query(Department).filter_by(id=dept_id).one()
         
@@ -1052,7 +1114,6 @@ class Root:
         if not skip:
             if not dept.slack_channel and not dept.slack_contact and not dept.other_contact and not dept.text_contact \
                     and not dept.email_contact:
-                session.close()
                 raise HTTPRedirect('dept_contact?dept_id=' + str(dept_id) +
                                    '&message=Please add default contact info for your department.  '
                                    'This will be used when beginning new meal bundles for your department '
@@ -1093,30 +1154,22 @@ class Root:
             
             messages.append('Department order contact info successfully updated.')
 
-        order_list = session.query(Order).filter_by(meal_id=meal_id, department_id=dept_id).options(
+        orders = session.query(Order).filter_by(meal_id=meal_id, department_id=dept_id).options(
             subqueryload(Order.attendee)).all()
-        # todo: check each order to see if the attendee is eligible for this meal, highlight in html if not
-        for order in order_list:
-            # print("checking meal")
-            sorted_shifts = combine_shifts(order.attendee.badge_num, no_combine=True)
-            if is_dh(order.attendee_id):
-                order.eligible = True
-            else:
-                order.eligible = carryout_eligible(sorted_shifts, thismeal.start_time, thismeal.end_time)
+        # shifts come from the local mirror, one query for the whole list
+        mirror = shared_functions.load_shift_mirror(session, [order.attendee for order in orders])
+        order_list = list()
+        for order in orders:
+            attendee_mirror = mirror[order.attendee_id]
+            eligible = attendee_mirror.is_dept_head or \
+                carryout_eligible(attendee_mirror.shifts, thismeal.start_time, thismeal.end_time)
+            order_list.append(shared_functions.Display(order, eligible=eligible))
             
         if len(order_list) == 0:
             messages.append('Your department does not have any orders for this meal.')
 
-        thismeal.start_time = con_tz(thismeal.start_time)
-        thismeal.end_time = con_tz(thismeal.end_time)
-        thismeal.cutoff = con_tz(thismeal.cutoff)
-        
-        session.close()
-        
-        if this_dept_order.started:
-            this_dept_order.start_time = con_tz(this_dept_order.start_time).strftime(cfg.date_format)
-        if this_dept_order.completed:
-            this_dept_order.completed_time = con_tz(this_dept_order.completed_time).strftime(cfg.date_format)
+        thismeal = shared_functions.meal_display(thismeal)
+        this_dept_order = shared_functions.dept_order_display(this_dept_order)
 
         departments = department_split(session, dept_id)
             
@@ -1132,27 +1185,42 @@ class Root:
         
     @cherrypy.expose
     @dh_or_admin
-    def order_override(self, order_id, meal_id, dept_id, remove_override=False):
+    def order_override(self, meal_id, dept_id, order_id=None, remove_override=False):
         """
-        Override or remove override on an order
+        Override or remove override on one order, or on every order ticked on the dept_order page
         """
-        session = models.new_sesh()
+        session = cherrypy.request.db
         dept_order = session.query(DeptOrder).filter_by(meal_id=meal_id, dept_id=dept_id).one()
         # todo: check for if order started or completed for admin user and do extra warnings?
         if dept_order.started and not cherrypy.session['is_admin']:
-            session.close()
             raise HTTPRedirect('dept_order_selection?message=The order for your department for this meal has already been started.')
-        order = session.query(Order).filter_by(id=order_id).options(subqueryload(Order.attendee)).one()
-        if remove_override:
-            order.overridden = False
-            message = 'Override removed for ' + str(order.attendee.badge_num)
+        
+        # a single order from a link, or a list when several boxes are ticked
+        if not order_id:
+            order_ids = []
+        elif isinstance(order_id, list):
+            order_ids = order_id
         else:
-            order.overridden = True
-            message = 'Override added for ' + str(order.attendee.badge_num)
+            order_ids = [order_id]
+        if not order_ids:
+            raise HTTPRedirect('dept_order?meal_id=' + str(meal_id) + '&dept_id=' + str(dept_id) +
+                               '&message=No orders were selected.')
+        
+        # only orders in this department's bundle, so the started check above covers all of them
+        orders = session.query(Order).filter(Order.id.in_(order_ids), Order.meal_id == meal_id,
+                                             Order.department_id == dept_id)
+        badges = [str(badge_num) for badge_num, in orders.join(Order.attendee).with_entities(Attendee.badge_num)]
+        orders.update({Order.overridden: not remove_override}, synchronize_session=False)
         session.commit()
-        session.close()
+        # an admin can override after the bundle is locked, the printed labels need to match
+        labels.orders_changed(session, meal_id, [dept_id])
+        
+        if remove_override:
+            message = 'Override removed for ' + ', '.join(badges)
+        else:
+            message = 'Override added for ' + ', '.join(badges)
         raise HTTPRedirect('dept_order?meal_id=' + str(meal_id) + '&dept_id=' + str(dept_id) +
-                           '&message=' + message + str(cherrypy.session['badge_num']))
+                           '&message=' + message)
            
     
     @cherrypy.expose
@@ -1168,35 +1236,17 @@ class Root:
             'is_ss_staffer': cherrypy.session['is_ss_staffer']
         }
         
-        session = models.new_sesh()
+        session = cherrypy.request.db
         
-        meals = session.query(Meal).all()
-        shift_buffer = relativedelta(minutes=cfg.schedule_tolerance)
+        # past meals are filtered out in the query unless display_all
+        board = shared_functions.meal_order_board(session, display_all)
+        eligible = shared_functions.eligible_order_counts(session, [row[0] for row in board])
         meal_list = []
-        now = datetime.now()
-        now = now.replace(tzinfo=tzlocal())
-        now = now.astimezone(pytz.utc)
-        now = now.replace(tzinfo=None)
         
-        for meal in meals:
-            # rd is positive if first item is after second.
-            """ removed during testing cause West is in past
-            rd = relativedelta(meal.end_time + shift_buffer, now)
-            # skips adding to list if item is in past
-            
-            if rd.days < 0 and not display_all:
-                continue
-            if rd.hours < 0 and not display_all:
-                continue
-            if rd.minutes < 0 and not display_all:
-                continue
-            """
-            # only runs these two lines if meal is in future or display_all is True
-            count = session.query(Order).filter_by(meal_id=meal.id).count()
-            session.close()
-            # todo: figure out how to count just ones that are still in future
+        for meal, count, overridden, locked in board:
             meal_list.append({'id': meal.id, 'name': meal.meal_name, 'start': con_tz(meal.start_time),
-                              'end': con_tz(meal.end_time), 'count': count})
+                              'end': con_tz(meal.end_time), 'count': count, 'eligible': eligible[meal.id],
+                              'overridden': overridden, 'locked': locked})
         
         template = env.get_template('ssf_meal_list.html')
         return template.render(meallist=meal_list,
@@ -1205,46 +1255,45 @@ class Root:
 
     @cherrypy.expose
     @ss_staffer
-    def ssf_dept_list(self, meal_id):
+    def ssf_dept_list(self, meal_id, message=[]):
         """
         For chosen meal, shows list of departments with how many orders are currently submitted for that department
         Fulfilment staff can select a department to view order details.
         """
         
+        messages = []
+        if message:
+            text = message
+            messages.append(text)
+        
         session_info = {
             'is_dh': cherrypy.session['is_dh'],
             'is_admin': cherrypy.session['is_admin'],
             'is_ss_staffer': cherrypy.session['is_ss_staffer']
         }
         
-        session = models.new_sesh()
+        session = cherrypy.request.db
+        
+        shared_functions.create_missing_dept_orders(session, meal_id)
         
-        depts = session.query(models.department.Department).all()
         dept_list = list()
         completed_depts = list()
         total_orders = 0
         remaining_orders = 0
         
-        for dept in depts:
-            count = session.query(Order).filter_by(department_id=dept.id, meal_id=meal_id).count()
-            
-            try:
-                dept_order = session.query(DeptOrder).filter_by(dept_id=dept.id, meal_id=meal_id).one()
-            except sqlalchemy.orm.exc.NoResultFound:
-                dept_order = create_dept_order(dept.id, meal_id, session)
-                
-            if not dept_order.completed:
-                dept_list.append((dept.name, count, dept.id))
+        for dept_id, name, completed, count in shared_functions.dept_order_board(session, meal_id):
+            if not completed:
+                dept_list.append((name, count, dept_id))
                 remaining_orders += count
             else:
-                completed_depts.append((dept.name, count, dept.id))
+                completed_depts.append((name, count, dept_id))
                 
             total_orders += count
         
-        # print(dept_list)
-        session.close()
         template = env.get_template('ssf_dept_list.html')
-        return template.render(depts=dept_list,
+        return template.render(messages=messages,
+                               label_job=labels.label_queue.status(meal_id),
+                               depts=dept_list,
                                completed_depts=completed_depts,
                                meal_id=meal_id,
                                total=total_orders,
@@ -1253,6 +1302,33 @@ class Root:
                                c=c)
         
         
+    @cherrypy.expose
+    @ss_staffer
+    def ssf_prep_report(self, meal_id):
+        """
+        Kitchen prep numbers for a meal: how many of each toggle choice and how many orders without each topping,
+        for the whole meal and for each department
+        """
+        
+        session_info = {
+            'is_dh': cherrypy.session['is_dh'],
+            'is_admin': cherrypy.session['is_admin'],
+            'is_ss_staffer': cherrypy.session['is_ss_staffer']
+        }
+        
+        session = cherrypy.request.db
+        thismeal = session.query(Meal).filter_by(id=meal_id).one()
+        report = shared_functions.prep_report(session, thismeal)
+        
+        template = env.get_template('ssf_prep_report.html')
+        return template.render(report=report,
+                               meal_name=thismeal.meal_name,
+                               meal_start=con_tz(thismeal.start_time),
+                               meal_id=meal_id,
+                               toppings_title=thismeal.toppings_title,
+                               session=session_info,
+                               c=c)
+    
     @cherrypy.expose
     @ss_staffer
     def ssf_orders(self, meal_id, dept_id, message=[]):
@@ -1274,86 +1350,27 @@ class Root:
             text = message
             messages.append(text)
 
-        session = models.new_sesh()
+        session = cherrypy.request.db
         try:
             dept_order = session.query(DeptOrder).filter_by(dept_id=dept_id, meal_id=meal_id).one()
         except sqlalchemy.orm.exc.NoResultFound:
             dept_order = create_dept_order(dept_id, meal_id, session)
         
-        orders = session.query(Order).filter_by(department_id=dept_id, meal_id=meal_id)\
-            .options(joinedload(Order.attendee)).all()
-        
         thismeal = session.query(Meal).filter_by(id=meal_id).one()
         
         dept = session.query(Department).filter_by(id=dept_id).one()
         dept_name = dept.name
         
-        session.close()  # this has to be before the order loop below.  don't know why, seems like it should be after.
+        orders = shared_functions.bundle_orders(session, thismeal, dept_id)
         
-        order_list = list()
-        for order in orders:
-            sorted_shifts, response = combine_shifts(order.attendee.badge_num, full=True, no_combine=True)
-            if response['result']['is_dept_head']:
-                order.eligible = True
-            else:
-                for dept in response['result']['assigned_depts_labels']:
-                    if dept in cfg.exempt_depts:
-                        order.eligible = True
-                if not order.eligible:  # checks for exempt dept first, then if not exempt checks shifts
-                    order.eligible = carryout_eligible(sorted_shifts, thismeal.start_time, thismeal.end_time)
-            # if not eligible and not overridden, remove from list for display/printing
-            
-            order.toggle1 = return_selected_only(session, choices=thismeal.toggle1, orders=order.toggle1)
-            order.toggle2 = return_selected_only(session, choices=thismeal.toggle2, orders=order.toggle2)
-            order.toggle3 = return_selected_only(session, choices=thismeal.toggle3, orders=order.toggle3)
-            order.toppings = return_not_selected(session, choices=thismeal.toppings, orders=order.toppings)
-
-            if response['result']['food_restrictions']:
-                order.allergies = {'standard_labels': response['result']['food_restrictions']['standard_labels'],
-                                   'freeform': response['result']['food_restrictions']['freeform']}
-            if order.eligible or order.overridden:
-                order_list.append(order)
-                
-        orders = order_list
-        
-        if dept_order.started:
-            dept_order.start_time = con_tz(dept_order.start_time).strftime(cfg.date_format)
-            # generate labels
-            if cfg.local_print:
-                labels = env.get_template('print_labels.html')
-                options = {
-                    'page-height': '2.0in',
-                    'page-width': '4.0in',
-                    'margin-top': '0.0in',
-                    'margin-right': '0.0in',
-                    'margin-bottom': '0.0in',
-                    'margin-left': '0.0in',
-                    'encoding': "UTF-8",
-                    'print-media-type': None
-                }
-                if cfg.devenv:  # todo: change this to detect OS instead
-                    # for some reason the silly system decided to not find it automatically anymore
-                    path_wkhtmltopdf = r'C:\Program Files\wkhtmltopdf\bin\wkhtmltopdf.exe'
-                    config = pdfkit.configuration(wkhtmltopdf=path_wkhtmltopdf)
-                    pdfkit.from_string(labels.render(orders=orders,
-                                                     meal=thismeal,
-                                                     dept_name=dept_name),
-                                       'pdfs\\' + dept_name + '.pdf',
-                                       options=options,
-                                       configuration=config)
-                else:
-                    #path_wkhtmltopdf = r'/usr/local/bin/wkhtmltopdf'
-                    #config = pdfkit.configuration(wkhtmltopdf=path_wkhtmltopdf)
-                    pdfkit.from_string(labels.render(orders=orders,
-                                                     meal=thismeal,
-                                                     dept_name=dept_name),
-                                       'pdfs/' + dept_name + '.pdf',
-                                       options=options)
-        if dept_order.completed:
-            dept_order.completed_time = con_tz(dept_order.completed_time).strftime(cfg.date_format)
+        # only shows how the labels are coming along, they are queued by locking the bundle and by changes to its
+        # orders, see labels.orders_changed
+        label_job = labels.label_queue.status(meal_id, dept_id)
         
         template = env.get_template('ssf_orders.html')
-        return template.render(dept_order=dept_order,
+        return template.render(dept_order=shared_functions.dept_order_display(dept_order),
+                               label_job=label_job,
+                               printers=spooler.stats() if cfg.remote_print else {},
                                dept_name=dept_name,
                                dept_id=dept_id,
                                order_list=orders,
@@ -1362,39 +1379,166 @@ class Root:
                                session=session_info,
                                c=c)
     
+    @cherrypy.expose
+    @ss_staffer
+    def ssf_labels(self, meal_id, dept_id, regenerate=False):
+        """
+        Serves a bundle's label PDF once it has been rendered in the background.
+        With regenerate, asks for the labels to be rendered again, eg after an order in a locked bundle was edited.
+        """
+        if regenerate:
+            session = cherrypy.request.db
+            started = session.query(DeptOrder.started).filter_by(meal_id=meal_id, dept_id=dept_id).scalar()
+            if not started:
+                raise HTTPRedirect('ssf_orders?meal_id=' + str(meal_id) + '&dept_id=' + str(dept_id) +
+                                   '&message=You must start this bundle before you can print labels!')
+            labels.label_queue.submit(meal_id, dept_id)
+            raise HTTPRedirect('ssf_orders?meal_id=' + str(meal_id) + '&dept_id=' + str(dept_id) +
+                               '&message=Labels are being generated.')
+        
+        label_job = labels.label_queue.status(meal_id, dept_id)
+        if not label_job or not label_job.path:
+            raise HTTPRedirect('ssf_orders?meal_id=' + str(meal_id) + '&dept_id=' + str(dept_id) +
+                               '&message=Labels are not ready yet.')
+        if not os.path.exists(label_job.path):
+            # cleaned out of the label cache since it was rendered
+            labels.label_queue.submit(meal_id, dept_id)
+            raise HTTPRedirect('ssf_orders?meal_id=' + str(meal_id) + '&dept_id=' + str(dept_id) +
+                               '&message=Labels are being generated.')
+        return cherrypy.lib.static.serve_file(os.path.abspath(label_job.path), content_type='application/pdf',
+                                              disposition='inline', name=label_job.name)
+    
+    @cherrypy.expose
+    @ss_staffer
+    def ssf_send_labels(self, meal_id, dept_id, printer):
+        """
+        Sends a bundle's labels straight to a label printer as raw printer commands, the printer's queue sends them
+        in the background
+        """
+        if not cfg.remote_print:
+            raise HTTPRedirect('ssf_orders?meal_id=' + str(meal_id) + '&dept_id=' + str(dept_id) +
+                               '&message=Remote printing is turned off.')
+        if printer not in spooler.printers:
+            raise HTTPRedirect('ssf_orders?meal_id=' + str(meal_id) + '&dept_id=' + str(dept_id) +
+                               '&message=There is no printer called ' + printer)
+        
+        session = cherrypy.request.db
+        started = session.query(DeptOrder.started).filter_by(meal_id=meal_id, dept_id=dept_id).scalar()
+        if not started:
+            raise HTTPRedirect('ssf_orders?meal_id=' + str(meal_id) + '&dept_id=' + str(dept_id) +
+                               '&message=You must start this bundle before you can print labels!')
+        
+        thismeal = session.query(Meal).filter_by(id=meal_id).one()
+        dept = session.query(Department).filter_by(id=dept_id).one()
+        orders = shared_functions.bundle_orders(session, thismeal, dept_id)
+        job = spooler.submit(printer, labels.label_fields(orders, thismeal, dept.name),
+                             dept.name + ' ' + thismeal.meal_name)
+        
+        raise HTTPRedirect('ssf_orders?meal_id=' + str(meal_id) + '&dept_id=' + str(dept_id) +
+                           '&message=Sent ' + str(job.labels) + ' labels to ' + printer + ', ' +
+                           str(spooler.printers[printer].waiting) + ' jobs waiting for that printer.')
+    
+    @cherrypy.expose
+    @ss_staffer
+    def ssf_meal_labels(self, meal_id, regenerate=False):
+        """
+        Serves one PDF with every department's labels for a meal, made in the background.
+        With regenerate, asks for it to be made again.
+        """
+        if regenerate:
+            labels.label_queue.submit(meal_id)
+            raise HTTPRedirect('ssf_dept_list?meal_id=' + str(meal_id) +
+                               '&message=Labels for all departments are being generated.')
+        
+        label_job = labels.label_queue.status(meal_id)
+        if not label_job or not label_job.path:
+            raise HTTPRedirect('ssf_dept_list?meal_id=' + str(meal_id) + '&message=Labels are not ready yet.')
+        if not os.path.exists(label_job.path):
+            # cleaned out of the label cache since it was rendered
+            labels.label_queue.submit(meal_id)
+            raise HTTPRedirect('ssf_dept_list?meal_id=' + str(meal_id) +
+                               '&message=Labels for all departments are being generated.')
+        return cherrypy.lib.static.serve_file(os.path.abspath(label_job.path), content_type='application/pdf',
+                                              disposition='inline', name=label_job.name)
+    
+    @cherrypy.expose
+    @ss_staffer
+    def ssf_label_status(self, meal_id, dept_id=''):
+        """
+        Label rendering status as JSON, for a bundle or with no dept_id for the whole meal.
+        Polled by the ssf_orders and ssf_dept_list pages
+        """
+        label_job = labels.label_queue.status(meal_id, dept_id)
+        if not label_job:
+            return json.dumps({'status': 'new', 'ready': False, 'seconds': 0, 'error': '', 'report': {}})
+        return json.dumps({'status': label_job.status,
+                           'ready': bool(label_job.path),
+                           'seconds': label_job.seconds,
+                           'error': label_job.error,
+                           'report': label_job.report})
+    
     @cherrypy.expose
     @ss_staffer
     def ssf_lock_order(self, meal_id, dept_id, unlock_order=False):
         """
         Locks or unlocks dept_order and individual orders for selected meal and department
         """
-        session = models.new_sesh()
+        session = cherrypy.request.db
         dept_order = session.query(DeptOrder).filter_by(meal_id=meal_id, dept_id=dept_id).one()
-        orders = session.query(Order).filter_by(meal_id=meal_id, department_id=dept_id).all()
 
         if not unlock_order:
             dept_order.started = True
             dept_order.start_time = now_utc()
-            for order in orders:
-                order.locked = True
+            shared_functions.lock_orders(session, meal_id, [dept_id], locked=True)
             session.commit()
-            session.close()
+            if cfg.local_print:
+                labels.label_queue.submit(meal_id, dept_id)
             raise HTTPRedirect('ssf_orders?meal_id=' + str(meal_id) + '&dept_id=' + str(dept_id) +
                                '&message=This Bundle is now locked.')
         else:
             if dept_order.completed:
-                session.close()
                 raise HTTPRedirect('ssf_orders?meal_id=' + str(meal_id) + '&dept_id=' + str(dept_id) +
                                    '&message=You cannot un-lock an Bundle that is marked Completed.')
             
             dept_order.started = False
             dept_order.start_time = None
-            for order in orders:
-                order.locked = False
+            shared_functions.lock_orders(session, meal_id, [dept_id], locked=False)
             session.commit()
-            session.close()
             raise HTTPRedirect('ssf_orders?meal_id=' + str(meal_id) + '&dept_id=' + str(dept_id) +
                                '&message=This Bundle is now un-locked.')
+    
+    @cherrypy.expose
+    @ss_staffer
+    def ssf_lock_meal(self, meal_id, unlock_meal=False):
+        """
+        Locks or unlocks every department's bundle for a meal at once.
+        Bundles already marked Completed are left alone when unlocking.
+        """
+        session = cherrypy.request.db
+        
+        if not unlock_meal:
+            shared_functions.create_missing_dept_orders(session, meal_id)
+            bundles = session.query(DeptOrder).filter(DeptOrder.meal_id == meal_id, DeptOrder.started.isnot(True))\
+                .update({DeptOrder.started: True, DeptOrder.start_time: now_utc()}, synchronize_session=False)
+            orders = shared_functions.lock_orders(session, meal_id, locked=True)
+            session.commit()
+            if cfg.local_print:
+                # departments with no orders have no labels to print
+                for dept_id, in session.query(Order.department_id).filter_by(meal_id=meal_id).distinct():
+                    labels.label_queue.submit(meal_id, dept_id)
+                labels.label_queue.submit(meal_id)
+            raise HTTPRedirect('ssf_dept_list?meal_id=' + str(meal_id) + '&message=Locked ' + str(bundles) +
+                               ' Bundles, ' + str(orders) + ' orders are now locked.')
+        else:
+            open_bundles = session.query(DeptOrder.dept_id).filter(DeptOrder.meal_id == meal_id,
+                                                                   DeptOrder.completed.isnot(True))
+            orders = shared_functions.lock_orders(session, meal_id, open_bundles, locked=False)
+            bundles = session.query(DeptOrder).filter(DeptOrder.meal_id == meal_id, DeptOrder.completed.isnot(True))\
+                .update({DeptOrder.started: False, DeptOrder.start_time: None}, synchronize_session=False)
+            session.commit()
+            raise HTTPRedirect('ssf_dept_list?meal_id=' + str(meal_id) + '&message=Un-locked ' + str(bundles) +
+                               ' Bundles, ' + str(orders) + ' orders are now un-locked.  Completed Bundles were not '
+                               'changed.')
         
     @cherrypy.expose
     @ss_staffer
@@ -1402,45 +1546,47 @@ class Root:
         """
         Marks or unmarks department order as complete for selected meal and department
         """
-        session = models.new_sesh()
+        session = cherrypy.request.db
         dept_order = session.query(DeptOrder).filter_by(meal_id=meal_id, dept_id=dept_id).one()
         
         if not uncomplete_order:
             if not dept_order.started:
-                session.close()
                 raise HTTPRedirect('ssf_orders?meal_id=' + str(meal_id) + '&dept_id=' + str(dept_id) +
                                    '&message=The Bundle must be Locked before it can be marked Complete.')
             dept_order.completed = True
             dept_order.completed_time = now_utc()
             dept = session.query(Department).filter_by(id=dept_id).one()
             
+            description = '{} bundle ready for meal {}'.format(dept.name, meal_id)
+            
+            # saved with the bundle and sent in the background, so a slow Slack or webhook can't hold up this page
             if dept_order.slack_channel:
                 message = 'Your food order bundle for ' + dept.name + ' ' \
                           'is ready, please pickup from Staff Suite.  ' + now_contz().strftime(cfg.date_format) + \
                           '  ' + dept_order.slack_contact
-                slack_bot.send_message(dept_order.slack_channel, message)
+                notifications.enqueue_slack(session, dept_order.slack_channel, message, description)
                 
             orders = session.query(Order).filter_by(department_id=dept_order.dept_id, meal_id=dept_order.meal_id) \
                 .options(subqueryload(Order.attendee)).all()
             for order in orders:
                 if order.attendee.webhook_url:
-                    shared_functions.send_webhook(order.attendee.webhook_url, order.attendee.webhook_data)
+                    notifications.enqueue_webhook(session, order.attendee.webhook_url, order.attendee.webhook_data,
+                                                  description + ', badge {}'.format(order.attendee.badge_num))
                 
             if dept_order.other_contact:
                 session.commit()
-                session.close()
+                notifier.wake()
                 raise HTTPRedirect('dept_order_details?dept_order_id=' + str(dept_order.id) +
                                    '&message=This department has requested manual contact.  '
                                    'Please contact them as listed in the Other Contact Info box.')
             session.commit()
-            session.close()
+            notifier.wake()
             raise HTTPRedirect('ssf_orders?meal_id=' + str(meal_id) + '&dept_id=' + str(dept_id) +
                                '&message=This Bundle is now marked Complete.')
         else:
             dept_order.completed = False
             dept_order.completed_time = None
             session.commit()
-            session.close()
             raise HTTPRedirect('ssf_orders?meal_id=' + str(meal_id) + '&dept_id=' + str(dept_id) +
                                '&message=This Bundle is now un-marked Complete.')
 
@@ -1460,7 +1606,7 @@ class Root:
             'is_ss_staffer': cherrypy.session['is_ss_staffer']
         }
 
-        session = models.new_sesh()
+        session = cherrypy.request.db
         dept_order = session.query(DeptOrder).filter_by(id=dept_order_id).one()
         
         if 'slack_channel' in params:
@@ -1471,13 +1617,11 @@ class Root:
             #dept_order.email_contact = params['email_contact']
             dept_order.other_contact = params['other_contact']
             session.commit()
-            session.close()
             raise HTTPRedirect('dept_order_details?dept_order_id=' + str(dept_order_id))
         
         # load record
         meal = session.query(Meal).filter_by(id=dept_order.meal_id).one()
         dept = session.query(Department).filter_by(id=dept_order.dept_id).one()
-        session.close()
         template = env.get_template('dept_order_details.html')
         return template.render(dept_order=dept_order,
                                meal=meal,
@@ -1503,7 +1647,7 @@ class Root:
 
         original_location = shared_functions.create_valid_user_supplied_redirect_url(original_location,
                                                                                      default_url='staffer_meal_list')
-        session = models.new_sesh()
+        session = cherrypy.request.db
         dept = session.query(Department).filter_by(id=dept_id).one()
         
         if 'slack_channel' in params:
@@ -1526,10 +1670,8 @@ class Root:
                     #do.email_contact = dept.email_contact
             
             session.commit()
-            session.close()
             raise HTTPRedirect(original_location)
             
-        session.close()
         template = env.get_template('dept_contact.html')
         return template.render(dept=dept,
                                original_location=original_location,